@@ -14,6 +14,7 @@ from pylib.mvffasphy import fasta2mvf, mvf2fasta, mvf2phy
 from pylib.mvfmaf import maf2mvf
 from pylib import mvfanalysis
 from pylib.mvfargo import MvfArgumentParser, mutex_check
+from pylib.mvfbase import MultiVariantFile
 from pylib.mvfcheck import check_mvf
 from pylib.mvfwindowtree import infer_window_tree
 from pylib.mvftranslate import annotate_mvf, translate_mvf
@@ -57,6 +58,7 @@ class MVFcall(object):
             prog="mvftools.py",
             usage="""Choose from the following commands:
             AnnotateMVF
+            BuildIndex
             CalcCharacterCount
             CalcDstatCombinations
             CalcPairwiseDistances
@@ -115,6 +117,8 @@ class MVFcall(object):
                       "positions that are this number of bp away "
                       "from an annotated region boundary"))
             parser.addarg_linebuffer()
+            parser.addarg_bgzf()
+            parser.addarg_compresslevel()
             parser.addarg_overwrite()
             return parser
         parser = generate_argparser()
@@ -124,6 +128,30 @@ class MVFcall(object):
         annotate_mvf(args)
         return ''
 
+    def BuildIndex(self):
+        """Builds a .mvfi contig/position index for an uncompressed
+           or BGZF-compressed MVF file, used by all readers to seek
+           directly to requested contigs and regions.
+        """
+
+        def generate_argparser():
+            """Generate argparse parser
+            """
+            parser = MvfArgumentParser()
+            parser.addarg_mvf()
+            parser.add_argument(
+                "--index-interval", "--indexinterval",
+                type=int, default=1000,
+                help="Number of entries between position checkpoints.")
+            return parser
+        parser = generate_argparser()
+        if self.selfdoc is True:
+            return parser
+        args = parser.parse_args(self.arguments[1:])
+        mvf = MultiVariantFile(args.mvf, 'read')
+        mvf.build_index(interval=args.index_interval)
+        return ''
+
     def ConvertFasta2MVF(self):
         """Converts a FastA file to MVF format"""
 
@@ -183,6 +211,17 @@ class MVFcall(object):
                 help=("manually specify reference coordinates "
                       "for each file in the format "
                       "CONTIGID:START..STOP, ..."))
+            parser.add_argument(
+                "--stream", action="store_true",
+                help=("read sequences from disk through .fai indexes "
+                      "(written next to the FASTA files if missing) "
+                      "instead of loading whole files into memory"))
+            parser.add_argument(
+                "--chunk-size", "--chunksize", type=int, default=100000,
+                help=("number of alignment columns read from every "
+                      "sample at a time"))
+            parser.addarg_bgzf()
+            parser.addarg_compresslevel()
             parser.addarg_overwrite()
             return parser
         parser = generate_argparser()
@@ -217,6 +256,8 @@ class MVFcall(object):
                       "NEW and TAG must each be unique."))
 
             parser.addarg_linebuffer()
+            parser.addarg_bgzf()
+            parser.addarg_compresslevel()
             parser.addarg_overwrite()
             return parser
         parser = generate_argparser()
@@ -236,9 +277,12 @@ class MVFcall(object):
             parser = MvfArgumentParser()
             parser.addarg_mvf()
             parser.add_argument("--out", type=os.path.abspath,
-                                help="Output path of FASTA file.",
+                                help=("Output path of FASTA file "
+                                      "(output directory with "
+                                      "--region-table)."),
                                 required=True)
             parser.addarg_regions()
+            parser.addarg_region_table()
             parser.addarg_sample_indices()
             parser.addarg_sample_labels()
             parser.add_argument(
@@ -249,12 +293,17 @@ class MVFcall(object):
                 "--output-data", "--outputdata",
                 choices=("dna", "rna", "prot"),
                 help="Output dna, rna or prot data.")
+            parser.add_argument(
+                "--max-memory", "--maxmemory", type=int, default=1024,
+                help=("memory (MB) for sequences held before spilling "
+                      "to a temporary file in --temp-dir (shared by all "
+                      "open regions with --region-table)"))
             parser.add_argument(
                 "--buffer", type=int, default=10,
-                help="size (Mbp) of write buffer for each sample")
+                help="(deprecated, use --max-memory)")
             parser.add_argument(
-                "--temp_dir", "--tempdir", default=".",
-                help="directory to write temporary fasta files")
+                "--temp-dir", "--temp_dir", "--tempdir", default=".",
+                help="directory to write temporary sequence data")
             return parser
         parser = generate_argparser()
         if self.selfdoc is True:
@@ -273,8 +322,11 @@ class MVFcall(object):
             parser = MvfArgumentParser()
             parser.addarg_mvf()
             parser.add_argument("--out", type=os.path.abspath,
-                                help="Output Phylip file.", required=True)
+                                help=("Output Phylip file (output "
+                                      "directory with --region-table)."),
+                                required=True)
             parser.addarg_regions()
+            parser.addarg_region_table()
             parser.add_argument(
                 "--label-type", "--labeltype",
                 choices=('long', 'short'), default='short',
@@ -285,12 +337,17 @@ class MVFcall(object):
                 help="Output dna, rna or prot data.")
             parser.addarg_sample_indices()
             parser.addarg_sample_labels()
+            parser.add_argument(
+                "--max-memory", "--maxmemory", type=int, default=1024,
+                help=("memory (MB) for sequences held before spilling "
+                      "to a temporary file in --temp-dir (shared by all "
+                      "open regions with --region-table)"))
             parser.add_argument(
                 "--buffer", type=int, default=100000,
-                help="size (bp) of write buffer for each sample")
+                help="(deprecated, use --max-memory)")
             parser.add_argument(
-                "--temp_dir", "--tempdir", default=".",
-                help="directory to write temporary fasta files")
+                "--temp-dir", "--temp_dir", "--tempdir", default=".",
+                help="directory to write temporary sequence data")
             parser.add_argument(
                 "--partition", action="store_true",
                 help=("Output a CSV partitions file with RAxML"
@@ -315,8 +372,13 @@ class MVFcall(object):
             """
             parser = MvfArgumentParser()
             parser.add_argument(
-                "--vcf", type=os.path.abspath,
-                help="VCF input file")
+                "--vcf", type=os.path.abspath, nargs='+', required=True,
+                help=("VCF input file(s); multiple coordinate-sorted "
+                      "VCFs are merged by position, with gaps for "
+                      "samples that have no record at a position; "
+                      "a sample label found in more than one VCF gets "
+                      "the VCF file name appended (e.g. SAMPLE_file1 "
+                      "for file1.vcf.gz)"))
             parser.add_argument(
                 "--out", required=True,
                 help="output MVF file")
@@ -366,7 +428,37 @@ class MVFcall(object):
             parser.addarg_linebuffer()
             parser.add_argument(
                 "--no-autoindex", "--noautoindex", action="store_true",
-                help="do not automatically index contigs from the VCF")
+                help=("do not read contig names from a .tbi/.csi index "
+                      "when the VCF header has no ##contig lines "
+                      "(contigs are added in order of appearance)"))
+            parser.add_argument(
+                "--shards", action="store_true",
+                help=("treat multiple --vcf inputs as shards (e.g. one "
+                      "per chromosome) with the same samples; shards are "
+                      "converted in parallel with --threads and their "
+                      "entries concatenated in --vcf order"))
+            parser.add_argument(
+                "--gvcf", action="store_true",
+                help=("read gVCF input: <NON_REF>/<*> alleles are "
+                      "accepted and reference blocks (END= records) "
+                      "are expanded using --gvcf-reference"))
+            parser.add_argument(
+                "--gvcf-reference", "--gvcfreference",
+                type=os.path.abspath,
+                help=("uncompressed reference FASTA (optionally with a "
+                      ".fai index) for the bases inside gVCF reference "
+                      "blocks; without it, positions covered only by "
+                      "blocks are not written (blocks still supply "
+                      "reference calls at positions where any input "
+                      "has a record)"))
+            parser.add_argument(
+                "--regions", nargs='*',
+                help=("only convert records in these regions, given as "
+                      "CONTIG, CONTIG:START-END (1-based, inclusive) "
+                      "or BED file paths; a bgzipped VCF with a "
+                      ".tbi/.csi index is only read at these regions; "
+                      "--gvcf blocks overlapping a region are written "
+                      "from its start to its end"))
             parser.add_argument(
                 "--field-sep", "--fieldsep", default="TAB",
                 choices=['TAB', 'SPACE', 'DBLSPACE', 'COMMA', 'MIXED'],
@@ -374,6 +466,13 @@ class MVFcall(object):
             parser.add_argument(
                 "--qual", action="store_true",
                 help="""Include Phred genotype quality (GQ) scores""")
+            parser.addarg_threads(helptext=(
+                "Number of processes to run in parallel. VCF lines are "
+                "parsed in buffers of --line-buffer lines by a process "
+                "pool; with --shards, each shard is converted by its "
+                "own process."))
+            parser.addarg_bgzf()
+            parser.addarg_compresslevel()
             parser.addarg_overwrite()
             return parser
         parser = generate_argparser()
@@ -407,6 +506,7 @@ class MVFcall(object):
             parser.add_argument(
                 "--base-total", "--basetotal",
                 help="String of bases for total (i.e. denominator).")
+            parser.addarg_threads()
             return parser
         parser = generate_argparser()
         if self.selfdoc is True:
@@ -433,6 +533,7 @@ class MVFcall(object):
             parser.addarg_outgroup_labels()
             parser.addarg_contig_ids()
             parser.addarg_contig_labels()
+            parser.addarg_threads()
             return parser
         parser = generate_argparser()
         if self.selfdoc is True:
@@ -457,6 +558,7 @@ class MVFcall(object):
             parser.addarg_sample_labels(nmin=2)
             parser.addarg_windowsize()
             parser.addarg_mincoverage()
+            parser.addarg_threads()
             return parser
         parser = generate_argparser()
         if self.selfdoc is True:
@@ -481,6 +583,7 @@ class MVFcall(object):
             parser.addarg_sample_labels()
             parser.addarg_windowsize()
             parser.addarg_mincoverage()
+            parser.addarg_threads()
             return parser
         parser = generate_argparser()
         if self.selfdoc is True:
@@ -505,6 +608,7 @@ class MVFcall(object):
             parser.addarg_contig_labels()
             parser.addarg_sample_indices()
             parser.addarg_sample_labels()
+            parser.addarg_threads()
             return parser
         parser = generate_argparser()
         if self.selfdoc is True:
@@ -561,6 +665,8 @@ class MVFcall(object):
             parser.add_argument(
                 "--verbose", action="store_true",
                 help="report every line (for debugging)")
+            parser.addarg_bgzf()
+            parser.addarg_compresslevel()
             parser.addarg_overwrite()
             return parser
         parser = generate_argparser()
@@ -781,6 +887,8 @@ class MVFcall(object):
                 help=("Output file will use same headers as "
                       "this input file (default=first in list)."))
             parser.addarg_linebuffer()
+            parser.addarg_bgzf()
+            parser.addarg_compresslevel()
             parser.addarg_overwrite()
             return parser
         parser = generate_argparser()
@@ -886,6 +994,8 @@ class MVFcall(object):
                 help=("skip GFF entries with text "
                       "matching this in their 'Notes' field"))
             parser.addarg_linebuffer()
+            parser.addarg_bgzf()
+            parser.addarg_compresslevel()
             parser.addarg_overwrite()
             return parser
         parser = generate_argparser()
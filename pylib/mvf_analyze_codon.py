@@ -270,8 +270,8 @@ class PairwiseDNDS(AnalysisModule):
             for k in self.data
             if self.data[k].get('nonsynonymous_changes', 0) > 0],
             reverse=True)
-        for _, k in sorted_entries:
-            outfile.write_entry(self.data[k])
+        outfile.write_entries([self.data[k] for _, k in sorted_entries])
+        outfile.close()
         with open(self.params['out'] + '.total', 'w') as totalfile:
             for entry in self.params['totals'].iter_sorted():
                 totalfile.write(entry)
@@ -354,8 +354,8 @@ class PiDiversityWindow(AnalysisModule):
                                       'position'))
         sorted_entries = sorted([(self.data[k]['pi'], k)
                                  for k in self.data], reverse=True)
-        for _, k in sorted_entries:
-            outfile.write_entry(self.data[k])
+        outfile.write_entries([self.data[k] for _, k in sorted_entries])
+        outfile.close()
         return ''
 
 
@@ -438,8 +438,8 @@ class PairwiseProtein(AnalysisModule):
                                  for k in self.data
                                  if self.data[k]['nsites'] > 0],
                                 reverse=True)
-        for _, k in sorted_entries:
-            outfile.write_entry(self.data[k])
+        outfile.write_entries([self.data[k] for _, k in sorted_entries])
+        outfile.close()
         return ''
 
 
@@ -503,8 +503,8 @@ class PairwiseNS(AnalysisModule):
         """Write Output"""
         outfile = OutputFile(path=self.params['out'],
                              headers=('label', 'Ka', 'Ks', 'dN', 'dS'))
-        for k in self.data:
-            outfile.write_entry(self.data[k])
+        outfile.write_entries(self.data.values())
+        outfile.close()
         return ''
 
 
@@ -27,10 +27,16 @@ along with MVFtools.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+import sys
 from random import randint
 from itertools import combinations
+from multiprocessing import Pool
 from pylib.mvfbase import MultiVariantFile, OutputFile, zerodiv, same_window
 from pylib.mvfbiolib import MvfBioLib
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 MLIB = MvfBioLib()
 
@@ -57,6 +63,152 @@ def pi_diversity(seq):
                                                for x in base_count]))
 
 
+# CONTIG-PARALLEL EXECUTION
+# Analyses are split into chunk workers with the signature
+# worker(mvf, params, contigs, first), where contigs is a list of
+# contig ids (None = whole file, the serial run) and first is True if
+# the chunk starts the file. Windowed workers start chunks that do not
+# start the file from CHUNK_START, so that their first site goes
+# through the same contig-change handling as in a serial run.
+
+CHUNK_START = '\t'
+
+WORKER_MVF = {}
+
+
+def init_chunk_worker(path, index):
+    """Opens the MVF once in each worker process"""
+    WORKER_MVF['mvf'] = MultiVariantFile(path, 'read')
+    WORKER_MVF['mvf'].index = index
+    return ''
+
+
+def run_chunk_worker(task):
+    """Runs a chunk worker on the worker process MVF"""
+    worker, params, contigs, first = task
+    return worker(WORKER_MVF['mvf'], params, contigs, first)
+
+
+def run_contig_chunks(mvf, worker, params, threads=1, contigs=None,
+                      windowed=False, quiet=False):
+    """Runs an analysis worker over chunks of contigs in a process pool
+        Arguments:
+            mvf: MultiVariantFile
+            worker: chunk worker function (see above)
+            params: dict of analysis parameters passed to worker
+            threads: number of processes (1 = serial run)
+            contigs: list of contig ids to include (default=all)
+            windowed: worker returns windowed results
+                      (see merge_window_chunks)
+            quiet: suppress warnings
+        Returns list of worker results in file order
+    """
+    chunks = None
+    if threads > 1:
+        chunks = mvf.get_contig_chunks(threads * 4, contigs=contigs)
+        if chunks is None and not quiet:
+            sys.stderr.write(
+                "{} cannot be split by contig (requires an uncompressed "
+                "or BGZF file with contiguous contigs), "
+                "running serially\n".format(mvf.path))
+    if chunks is None or len(chunks) < 2:
+        return [worker(mvf, params, None, True)]
+    pool = Pool(threads, initializer=init_chunk_worker,
+                initargs=(mvf.path, mvf.index))
+    results = pool.map(run_chunk_worker,
+                       [(worker, params, chunk, j == 0)
+                        for j, chunk in enumerate(chunks)], chunksize=1)
+    pool.close()
+    pool.join()
+    if windowed:
+        # The first chunk with data starts the first window
+        for j, result in enumerate(results):
+            if result['started']:
+                if j > 0:
+                    results[j] = worker(mvf, params, chunks[j], True)
+                break
+    return results
+
+
+def merge_window_chunks(results, windowsize, combine):
+    """Merges windowed chunk results in file order
+        Arguments:
+            results: list of dicts with
+                     started: True if any site reached the window logic
+                     windows: list of (key, accumulator) closed windows
+                     pending: (key, accumulator, has_data) open window
+            windowsize: window size (0 = whole file)
+            combine: function(acc1, acc2) returning summed accumulators
+        Returns (list of closed windows, pending window or None)
+    """
+    windows = []
+    pending = None
+    for result in results:
+        if not result['started']:
+            continue
+        if pending is None:
+            windows.extend(result['windows'])
+            pending = result['pending']
+        elif windowsize == 0:
+            pending = (pending[0],
+                       combine(pending[1], result['pending'][1]),
+                       pending[2] or result['pending'][2])
+        else:
+            # The open window is closed by the next chunk's first site
+            windows.append(pending[:2])
+            windows.extend(result['windows'])
+            pending = result['pending']
+    return windows, pending
+
+
+def iter_chunk_entries(mvf, contigs):
+    """Iterates encoded entries of the whole file (contigs=None)
+       or of a chunk of contigs
+    """
+    if contigs is None:
+        return iter(mvf)
+    return mvf.iterentries(contigs=contigs, decode=False, quiet=True)
+
+
+def iter_contig_entries(mvf, contigs):
+    """Iterates encoded entries of a list of contigs
+       iterentries(contigs=...) stops at the end of each contig's first
+       run of entries, so unless a .mvfi index shows the contigs are
+       contiguous every line is read and filtered instead
+    """
+    if mvf.index is not None and mvf.index.contiguous:
+        return mvf.iterentries(contigs=contigs, decode=False, quiet=True)
+    contigs = set(contigs)
+    return (entry for entry in mvf if entry[0] in contigs)
+
+
+def add_counts(counts1, counts2):
+    """Returns the sum of two dict[key] = count
+       (keys in order of first occurrence)
+    """
+    counts = dict(counts1)
+    for key, val in counts2.items():
+        counts[key] = counts.get(key, 0) + val
+    return counts
+
+
+def sample_coverage_chunk(mvf, params, contigs, first):
+    """Counts sample coverage per contig for a chunk of contigs"""
+    data = {}
+    sample_indices = params['sample_indices']
+    sample_labels = params['sample_labels']
+    for contig, _, allelesets in mvf.iterentries(
+            contigs=(params['contig_ids'] if contigs is None else contigs),
+            subset=sample_indices, decode=True):
+        if contig not in data:
+            data[contig] = dict.fromkeys(sample_labels, 0)
+            data[contig]['contig'] = contig
+        for j, x in enumerate(sample_indices):
+            data[contig][sample_labels[x]] += int(
+                allelesets[0][j] not in 'Xx-')
+    return data
+
+
 def calc_sample_coverage(args):
     """Counts the total number of non-gap/ambiguous characters for
       each sample per contig.
@@ -81,23 +233,100 @@ def calc_sample_coverage(args):
             labels=args.contig_labels[0].split(","))
     else:
         contig_ids = mvf.get_contig_ids()
-    for contig, _, allelesets in mvf.iterentries(
-            contigs=contig_ids, subset=sample_indices,
-            decode=True):
-        if contig not in data:
-            data[contig] = dict.fromkeys(sample_labels, 0)
-            data[contig]['contig'] = contig
-        for j, x in enumerate(sample_indices):
-            data[contig][sample_labels[x]] += int(
-                allelesets[0][j] not in 'Xx-')
+    params = {'sample_indices': sample_indices,
+              'sample_labels': sample_labels,
+              'contig_ids': contig_ids}
+    for result in run_contig_chunks(mvf, sample_coverage_chunk, params,
+                                    threads=args.threads,
+                                    contigs=contig_ids, quiet=args.quiet):
+        data.update(result)
     outfile = OutputFile(path=args.out,
                          headers=(["contig"] + [sample_labels[x] for x in
                                                 sample_indices]))
-    for contig in data:
-        outfile.write_entry(data[contig])
+    outfile.write_entries(data.values())
+    outfile.close()
     return ''
 
 
+def add_dstat_patterns(data, contig, patterns, sample_indices,
+                       outgroup_indices):
+    """Add ABBA/BABA/BBAA counts for site patterns to data
+        Arguments:
+            data: dict[tetrad][contig] = [abba, baba, bbaa]
+            contig: contig id
+            patterns: dict[pattern] = count, where each pattern is
+                      the site's bases at sample_indices + outgroup_indices
+            sample_indices: list of sample columns
+            outgroup_indices: list of outgroup columns
+
+        For each pattern, samples are grouped by base as bitmasks.
+        An informative tetrad has exactly one sample sharing the
+        outgroup base and two samples sharing one other base, so
+        the counted tetrads are enumerated from those groups
+        instead of testing every combination.
+    """
+    nsample = len(sample_indices)
+    for pattern, count in patterns.items():
+        masks = {}
+        for rank in range(nsample):
+            if pattern[rank] in 'ATGC':
+                masks[pattern[rank]] = (
+                    masks.get(pattern[rank], 0) | (1 << rank))
+        if len(masks) < 2:
+            continue
+        members = dict((base, [rank for rank in range(nsample)
+                               if mask >> rank & 1])
+                       for base, mask in masks.items())
+        for outrank, outgroup in enumerate(outgroup_indices):
+            outbase = pattern[nsample + outrank]
+            if outbase not in masks:
+                continue
+            for base in members:
+                if base == outbase or len(members[base]) < 2:
+                    continue
+                for rank0 in members[outbase]:
+                    for rank1, rank2 in combinations(members[base], 2):
+                        trio = sorted((rank0, rank1, rank2))
+                        tetrad = tuple([sample_indices[x] for x in trio] +
+                                       [outgroup])
+                        if tetrad not in data:
+                            data[tetrad] = {}
+                        if contig not in data[tetrad]:
+                            data[tetrad][contig] = [0, 0, 0]
+                        # [ABBA, BABA, BBAA]
+                        data[tetrad][contig][trio.index(rank0)] += count
+    return ''
+
+
+def dstat_chunk(mvf, params, contigs, first):
+    """Counts ABBA/BABA/BBAA sites per tetrad for a chunk of contigs
+       Returns dict[tetrad][contig] = [abba, baba, bbaa]
+    """
+    data = {}
+    sample_indices = params['sample_indices']
+    outgroup_indices = params['outgroup_indices']
+    # Sites are reduced to their sample+outgroup pattern and
+    # identical patterns are counted once per contig
+    columns = sample_indices + outgroup_indices
+    codec = mvf.codec
+    current_contig = None
+    patterns = {}
+    for contig, _, allelesets in iter_contig_entries(
+            mvf, params['contig_ids'] if contigs is None else contigs):
+        if contig != current_contig:
+            add_dstat_patterns(data, current_contig, patterns,
+                               sample_indices, outgroup_indices)
+            current_contig = contig
+            patterns = {}
+        pattern = codec.decode_subset(allelesets[0], columns)
+        if pattern.count(pattern[0]) == len(pattern):
+            continue
+        patterns[pattern] = patterns.get(pattern, 0) + 1
+    add_dstat_patterns(data, current_contig, patterns,
+                       sample_indices, outgroup_indices)
+    return data
+
+
 def calc_dstat_combinations(args):
     """Calculate genome-wide D-statstics for
        all possible trio combinations of samples
@@ -129,37 +358,16 @@ def calc_dstat_combinations(args):
         contig_ids = mvf.get_contig_ids()
     if any(x in outgroup_indices for x in sample_indices):
         raise RuntimeError("Sample and Outgroup column lists cannot overlap.")
-    for contig, _, allelesets in mvf:
-        if contig not in contig_ids:
-            continue
-        alleles = mvf.decode(allelesets[0])
-        for i, j, k in combinations(sample_indices, 3):
-            for outgroup in outgroup_indices:
-                subset = [alleles[x] for x in
-                          [i, j, k, outgroup]]
-                if any(x not in 'ATGC' for x in subset):
-                    continue
-                if subset[-1] not in subset[:3]:
-                    continue
-                if len(set(subset)) != 2:
-                    continue
-                # [ABBA, BABA, BBAA]
-                val = (0 +
-                       1 * (subset[0] == subset[3]) +
-                       2 * (subset[1] == subset[3]) +
-                       4 * (subset[2] == subset[3]))
-                if val == 1 or val == 2:
-                    val -= 1
-                elif val == 4:
-                    val = 2
-                else:
-                    continue
-                tetrad = (i, j, k, outgroup)
-                if tetrad not in data:
-                    data[tetrad] = {}
-                if contig not in data[tetrad]:
-                    data[tetrad][contig] = [0, 0, 0]
-                data[tetrad][contig][val] += 1
+    params = {'sample_indices': sample_indices,
+              'outgroup_indices': outgroup_indices,
+              'contig_ids': contig_ids}
+    for result in run_contig_chunks(mvf, dstat_chunk, params,
+                                    threads=args.threads,
+                                    contigs=contig_ids, quiet=args.quiet):
+        for tetrad in result:
+            if tetrad not in data:
+                data[tetrad] = {}
+            data[tetrad].update(result[tetrad])
     # WRITE OUTPUT
     headers = ['sample0', 'sample1', 'sample2', "outgroup"]
     for xcontig in contig_ids:
@@ -200,56 +408,47 @@ def calc_dstat_combinations(args):
                                   ('{}:D'.format(contig), dstat)
                                   ])
             outfile.write_entry(entry)
+    outfile.close()
     return ''
 
 
-def calc_pattern_count(args):
-    """Count biallelic patterns spatially along
-       chromosomes (e.g,, for use in DFOIL or Dstats
-       http://www.github.com/jbpease/dfoil).
-       The last sample specified will determine the 'A'
-       versus 'B' allele.
+def pattern_count_chunk(mvf, params, contigs, first):
+    """Counts biallelic site patterns in windows for a chunk of contigs
+       (window accumulator = dict[pattern] = count)
     """
-    mvf = MultiVariantFile(args.mvf, 'read')
-    data = {}
-    current_contig = None
+    windowsize = params['windowsize']
+    sample_indices = params['sample_indices']
+    nsamples = len(sample_indices)
+    current_contig = None if first else CHUNK_START
     current_position = 0
     sitepatterns = {}
-    # sample_labels = mvf.get_sample_labels()
-    if args.sample_indices is not None:
-        sample_indices = [int(x) for x in
-                          args.sample_indices[0].split(",")]
-    elif args.sample_labels is not None:
-        sample_indices = mvf.get_sample_indices(
-            labels=args.sample_labels[0].split(","))
-    else:
-        sample_indices = mvf.get_sample_indices()
-    nsamples = len(sample_indices)
-    for contig, pos, allelesets in mvf:
+    windows = []
+    started = False
+    for contig, pos, allelesets in iter_chunk_entries(mvf, contigs):
         # Check Minimum Site Coverage
-        if check_mincoverage(args.mincoverage, allelesets[0]) is False:
+        if check_mincoverage(params['mincoverage'],
+                             allelesets[0]) is False:
             continue
+        started = True
         # Establish first contig
         if current_contig is None:
             current_contig = contig[:]
-            if args.windowsize > 0:
-                while pos > current_position + args.windowsize - 1:
-                    current_position += args.windowsize
+            if windowsize > 0:
+                while pos > current_position + windowsize - 1:
+                    current_position += windowsize
         # Check if windows are specified.
         if not same_window((current_contig, current_position),
-                           (contig, pos), args.windowsize):
-            data[(current_contig, current_position)] = dict([
-                ('contig', current_contig),
-                ('position', current_position)])
-            data[(current_contig, current_position)].update(
-                sitepatterns)
+                           (contig, pos), windowsize):
+            if current_contig != CHUNK_START:
+                windows.append(((current_contig, current_position),
+                                sitepatterns))
             sitepatterns = {}
             if contig != current_contig:
                 current_position = 0
                 current_contig = contig[:]
             else:
-                current_position += (0 if args.windowsize == -1
-                                     else args.windowsize)
+                current_position += (0 if windowsize == -1
+                                     else windowsize)
         if len(allelesets[0]) == 1:
             if allelesets[0] in 'ATGC':
                 pattern = 'A' * nsamples
@@ -267,12 +466,44 @@ def calc_pattern_count(args):
             pattern = ''.join(['A' if x == alleles[-1] else 'B'
                                for x in alleles[:-1]]) + 'A'
         sitepatterns[pattern] = sitepatterns.get(pattern, 0) + 1
-    if sitepatterns:
-        data[(current_contig, current_position)] = dict([
-            ('contig', current_contig),
-            ('position', current_position)])
-        data[(current_contig, current_position)].update(
-            sitepatterns)
+    return {'started': started, 'windows': windows,
+            'pending': ((current_contig, current_position), sitepatterns,
+                        bool(sitepatterns))}
+
+
+def calc_pattern_count(args):
+    """Count biallelic patterns spatially along
+       chromosomes (e.g,, for use in DFOIL or Dstats
+       http://www.github.com/jbpease/dfoil).
+       The last sample specified will determine the 'A'
+       versus 'B' allele.
+    """
+    mvf = MultiVariantFile(args.mvf, 'read')
+    data = {}
+    # sample_labels = mvf.get_sample_labels()
+    if args.sample_indices is not None:
+        sample_indices = [int(x) for x in
+                          args.sample_indices[0].split(",")]
+    elif args.sample_labels is not None:
+        sample_indices = mvf.get_sample_indices(
+            labels=args.sample_labels[0].split(","))
+    else:
+        sample_indices = mvf.get_sample_indices()
+    nsamples = len(sample_indices)
+    params = {'sample_indices': sample_indices,
+              'windowsize': args.windowsize,
+              'mincoverage': args.mincoverage}
+    windows, pending = merge_window_chunks(
+        run_contig_chunks(mvf, pattern_count_chunk, params,
+                          threads=args.threads, windowed=True,
+                          quiet=args.quiet),
+        args.windowsize, add_counts)
+    if pending is not None and pending[2]:
+        windows.append(pending[:2])
+    for (contig, position), sitepatterns in windows:
+        data[(contig, position)] = dict([
+            ('contig', contig), ('position', position)])
+        data[(contig, position)].update(sitepatterns)
     # WRITE OUTPUT
     headers = ['contig', 'position']
     headers.extend(
@@ -284,8 +515,8 @@ def calc_pattern_count(args):
     sorted_entries = sorted([(data[k]['contig'],
                               data[k]['position'], k)
                              for k in data])
-    for _, _, k in sorted_entries:
-        outfile.write_entry(data[k])
+    outfile.write_entries([data[k] for _, _, k in sorted_entries])
+    outfile.close()
     # WRITE LIST OUTPUT
     if args.output_lists is True:
         sorted_entries = sorted([(data[k]['contig'],
@@ -313,70 +544,52 @@ def calc_pattern_count(args):
     return ''
 
 
-def calc_character_count(args):
-    """Count the number of and relative rate of certain bases
-       spatially along chromosomes
+def character_count_chunk(mvf, params, contigs, first):
+    """Counts matching/total characters in windows for a chunk of contigs
+       (window accumulator = (match_counts, total_counts,
+                              all_match, all_total))
     """
-    mvf = MultiVariantFile(args.mvf, 'read')
-    data = {}
-    current_contig = None
+    windowsize = params['windowsize']
+    sample_indices = params['sample_indices']
+    sample_labels = params['sample_labels']
+    base_match = params['base_match']
+    base_total = params['base_total']
+    current_contig = None if first else CHUNK_START
     current_position = 0
     all_match = 0
     all_total = 0
     data_in_buffer = 0
-    # Set up sample indices
-    sample_labels = mvf.get_sample_labels()
-    if args.sample_indices is not None:
-        sample_indices = [int(x) for x in
-                          args.sample_indices[0].split(",")]
-    elif args.sample_labels is not None:
-        sample_indices = mvf.get_sample_indices(
-            labels=args.sample_labels[0].split(","))
-    else:
-        sample_indices = mvf.get_sample_indices()
-    # Set up contig ids
-    if args.contig_ids is not None:
-        contig_ids = args.contig_ids[0].split(",")
-    elif args.contig_labels is not None:
-        contig_ids = mvf.get_contig_ids(
-            labels=args.contig_labels[0].split(","))
-    else:
-        contig_ids = mvf.get_contig_ids()
+    windows = []
+    started = False
     match_counts = dict().fromkeys(
         [sample_labels[i] for i in sample_indices], 0)
     total_counts = dict().fromkeys(
         [sample_labels[i] for i in sample_indices], 0)
-    for contig, pos, allelesets in mvf:
+    for contig, pos, allelesets in iter_contig_entries(
+            mvf, params['contig_ids'] if contigs is None else contigs):
         # Check Minimum Site Coverage
-        if check_mincoverage(args.mincoverage,
+        if check_mincoverage(params['mincoverage'],
                              allelesets[0]) is False:
             continue
-        if contig not in contig_ids:
-            continue
+        started = True
         # Establish first contig
         if current_contig is None:
             current_contig = contig[:]
-            while pos > current_position + args.windowsize - 1:
-                current_position += args.windowsize
+            while pos > current_position + windowsize - 1:
+                current_position += windowsize
         # Check if windows are specified.
         if not same_window((current_contig, current_position),
-                           (contig, pos), args.windowsize):
-            data[(current_contig, current_position)] = {
-                'contig': current_contig, 'position': current_position}
-            for k in match_counts:
-                data[(current_contig, current_position)].update([
-                    (k + '.match', match_counts[k] + all_match),
-                    (k + '.total', total_counts[k] + all_total),
-                    (k + '.prop', (
-                        (float(match_counts[k] + all_match) /
-                         float(total_counts[k] + all_total)) if
-                        total_counts[k] + all_total > 0 else 0))])
+                           (contig, pos), windowsize):
+            if current_contig != CHUNK_START:
+                windows.append(((current_contig, current_position),
+                                (match_counts, total_counts,
+                                 all_match, all_total)))
             if contig != current_contig:
                 current_contig = contig[:]
                 current_position = 0
             else:
-                current_position += (0 if args.windowsize == -1
-                                     else args.windowsize)
+                current_position += (0 if windowsize == -1
+                                     else windowsize)
             match_counts = dict().fromkeys(
                 [sample_labels[i] for i in sample_indices], 0)
             total_counts = dict().fromkeys(
@@ -387,31 +600,83 @@ def calc_character_count(args):
         else:
             alleles = allelesets[0]
             if len(alleles) == 1:
-                if args.base_match is None:
+                if base_match is None:
                     all_match += 1
-                elif alleles in args.base_match:
+                elif alleles in base_match:
                     all_match += 1
-                if args.base_total is None:
+                if base_total is None:
                     all_total += 1
-                elif alleles in args.base_total:
+                elif alleles in base_total:
                     all_total += 1
             else:
                 alleles = mvf.decode(alleles)
                 for i in sample_indices:
-                    if args.base_match is None:
+                    if base_match is None:
                         match_counts[sample_labels[i]] += 1
-                    elif alleles[i] in args.base_match:
+                    elif alleles[i] in base_match:
                         match_counts[sample_labels[i]] += 1
-                    if args.base_total is None:
+                    if base_total is None:
                         total_counts[sample_labels[i]] += 1
-                    elif alleles[i] in args.base_total:
+                    elif alleles[i] in base_total:
                         total_counts[sample_labels[i]] += 1
             data_in_buffer = 1
-    if data_in_buffer:
-        data[(current_contig, current_position)] = {
-            'contig': current_contig, 'position': current_position}
+    return {'started': started, 'windows': windows,
+            'pending': ((current_contig, current_position),
+                        (match_counts, total_counts, all_match, all_total),
+                        bool(data_in_buffer))}
+
+
+def add_character_counts(counts1, counts2):
+    """Returns the sum of two character count window accumulators"""
+    return (add_counts(counts1[0], counts2[0]),
+            add_counts(counts1[1], counts2[1]),
+            counts1[2] + counts2[2], counts1[3] + counts2[3])
+
+
+def calc_character_count(args):
+    """Count the number of and relative rate of certain bases
+       spatially along chromosomes
+    """
+    mvf = MultiVariantFile(args.mvf, 'read')
+    data = {}
+    # Set up sample indices
+    sample_labels = mvf.get_sample_labels()
+    if args.sample_indices is not None:
+        sample_indices = [int(x) for x in
+                          args.sample_indices[0].split(",")]
+    elif args.sample_labels is not None:
+        sample_indices = mvf.get_sample_indices(
+            labels=args.sample_labels[0].split(","))
+    else:
+        sample_indices = mvf.get_sample_indices()
+    # Set up contig ids
+    if args.contig_ids is not None:
+        contig_ids = args.contig_ids[0].split(",")
+    elif args.contig_labels is not None:
+        contig_ids = mvf.get_contig_ids(
+            labels=args.contig_labels[0].split(","))
+    else:
+        contig_ids = mvf.get_contig_ids()
+    params = {'sample_indices': sample_indices,
+              'sample_labels': sample_labels,
+              'contig_ids': contig_ids,
+              'windowsize': args.windowsize,
+              'mincoverage': args.mincoverage,
+              'base_match': args.base_match,
+              'base_total': args.base_total}
+    windows, pending = merge_window_chunks(
+        run_contig_chunks(mvf, character_count_chunk, params,
+                          threads=args.threads, contigs=contig_ids,
+                          windowed=True, quiet=args.quiet),
+        args.windowsize, add_character_counts)
+    if pending is not None and pending[2]:
+        windows.append(pending[:2])
+    for (contig, position), (match_counts, total_counts,
+                             all_match, all_total) in windows:
+        data[(contig, position)] = {
+            'contig': contig, 'position': position}
         for k in match_counts:
-            data[(current_contig, current_position)].update([
+            data[(contig, position)].update([
                 (k + '.match', match_counts[k] + all_match),
                 (k + '.total', total_counts[k] + all_total),
                 (k + '.prop', ((float(match_counts[k] + all_match) /
@@ -426,72 +691,51 @@ def calc_character_count(args):
     sorted_entries = sorted([(data[k]['contig'],
                               data[k]['position'], k)
                              for k in data])
-    for _, _, k in sorted_entries:
-        outfile.write_entry(data[k])
+    outfile.write_entries([data[k] for _, _, k in sorted_entries])
+    outfile.close()
     return ''
 
 
-def calc_pairwise_distances(args):
-    """Count the pairwise nucleotide distance between
-       combinations of samples in a window
+def pairwise_distance_chunk(mvf, params, contigs, first):
+    """Counts pairwise base matches in windows for a chunk of contigs
+       (window accumulator = (all_match, base_matches))
     """
-    mvf = MultiVariantFile(args.mvf, 'read')
-    data = {}
-    sample_labels = mvf.get_sample_labels()
-    if args.sample_indices is not None:
-        sample_indices = [int(x) for x in
-                          args.sample_indices[0].split(",")]
-    elif args.sample_labels is not None:
-        sample_indices = mvf.get_sample_indices(
-            labels=args.sample_labels[0].split(","))
-    else:
-        sample_indices = mvf.get_sample_indices()
-    current_contig = None
+    windowsize = params['windowsize']
+    sample_indices = params['sample_indices']
+    current_contig = None if first else CHUNK_START
     current_position = 0
     data_in_buffer = False
-    sample_pairs = [tuple(x) for x in combinations(sample_indices, 2)]
-    base_matches = dict([(x, {}) for x in sample_pairs])
+    windows = []
+    started = False
+    pair_counter = PairwiseMatchCounter(
+        params['sample_pairs'], MLIB.validchars[
+            'amino' if mvf.flavor == 'prot' else 'dna+ambig'])
     all_match = {}
-    for contig, pos, allelesets in mvf:
+    for contig, pos, allelesets in iter_chunk_entries(mvf, contigs):
         # Check Minimum Site Coverage
-        if check_mincoverage(args.mincoverage, allelesets[0]) is False:
+        if check_mincoverage(params['mincoverage'],
+                             allelesets[0]) is False:
             continue
+        started = True
         # Establish first contig
         if current_contig is None:
             current_contig = contig[:]
-            while pos > current_position + args.windowsize - 1:
-                current_position += args.windowsize
+            while pos > current_position + windowsize - 1:
+                current_position += windowsize
         # Check if windows are specified.
         if not same_window((current_contig, current_position),
-                           (contig, pos), args.windowsize):
-            data[(current_contig, current_position)] = {
-                'contig': current_contig, 'position': current_position}
-            if mvf.flavor == 'dna':
-                all_diff, all_total = pairwise_distance_nuc(all_match)
-            elif mvf.flavor == 'prot':
-                all_diff, all_total = pairwise_distance_prot(all_match)
-            for samplepair in base_matches:
-                if mvf.flavor == 'dna':
-                    ndiff, ntotal = pairwise_distance_nuc(
-                        base_matches[samplepair])
-                elif mvf.flavor == 'prot':
-                    ndiff, ntotal = pairwise_distance_prot(
-                        base_matches[samplepair])
-                taxa = "{};{}".format(sample_labels[samplepair[0]],
-                                      sample_labels[samplepair[1]])
-                data[(current_contig, current_position)].update({
-                    '{};ndiff'.format(taxa): ndiff + all_diff,
-                    '{};ntotal'.format(taxa): ntotal + all_total,
-                    '{};dist'.format(taxa): zerodiv(ndiff + all_diff,
-                                                    ntotal + all_total)})
+                           (contig, pos), windowsize):
+            if current_contig != CHUNK_START:
+                windows.append(((current_contig, current_position),
+                                (all_match, pair_counter.get_matches())))
             if contig != current_contig:
                 current_contig = contig[:]
                 current_position = 0
-                while pos > current_position + args.windowsize - 1:
-                    current_position += args.windowsize
+                while pos > current_position + windowsize - 1:
+                    current_position += windowsize
             else:
-                current_position += args.windowsize
-            base_matches = dict([(x, {}) for x in sample_pairs])
+                current_position += windowsize
+            pair_counter.reset()
             all_match = {}
             data_in_buffer = False
         alleles = allelesets[0]
@@ -507,48 +751,89 @@ def calc_pairwise_distances(args):
             samplepair = (0, int(alleles[3:]))
             if any(x not in sample_indices for x in samplepair):
                 continue
-            basepair = "{}{}".format(alleles[0], alleles[2])
-            base_matches[samplepair][basepair] = (
-                base_matches[samplepair].get(basepair, 0) + 1)
+            pair_counter.add_pair(samplepair, alleles[0] + alleles[2])
             data_in_buffer = True
             continue
-        alleles = mvf.decode(alleles)
-        valid_positions = [i for i, x in enumerate(alleles)
-                           if x not in 'X-']
-        for i, j in combinations(valid_positions, 2):
-            samplepair = (i, j)
-            if any(x not in sample_indices for x in samplepair):
-                continue
-            basepair = "{}{}".format(alleles[i], alleles[j])
-            base_matches[samplepair][basepair] = (
-                base_matches[samplepair].get(basepair, 0) + 1)
+        pair_counter.add_site(mvf.decode(alleles))
         data_in_buffer = True
-    if data_in_buffer is True:
+    return {'started': started, 'windows': windows,
+            'pending': ((current_contig, current_position),
+                        (all_match, pair_counter.get_matches()),
+                        data_in_buffer)}
+
+
+def add_pairwise_matches(matches1, matches2):
+    """Returns the sum of two pairwise window accumulators"""
+    return (add_counts(matches1[0], matches2[0]),
+            dict((x, add_counts(matches1[1][x], matches2[1][x]))
+                 for x in matches1[1]))
+
+
+def pairwise_distance_entry(contig, position, all_match, base_matches,
+                            flavor, sample_labels):
+    """Returns the output entry for a window of pairwise base matches
+       (distances with ambiguous bases use randint, so windows must
+       be processed in file order for reproducible output)
+    """
+    entry = {'contig': contig, 'position': position}
+    if flavor == 'dna':
+        all_diff, all_total = pairwise_distance_nuc(all_match)
+    elif flavor == 'prot':
+        all_diff, all_total = pairwise_distance_prot(all_match)
+    for samplepair in base_matches:
+        if flavor == 'dna':
+            ndiff, ntotal = pairwise_distance_nuc(base_matches[samplepair])
+        elif flavor == 'prot':
+            ndiff, ntotal = pairwise_distance_prot(
+                base_matches[samplepair])
+        taxa = "{};{}".format(sample_labels[samplepair[0]],
+                              sample_labels[samplepair[1]])
+        entry.update({
+            '{};ndiff'.format(taxa): ndiff + all_diff,
+            '{};ntotal'.format(taxa): ntotal + all_total,
+            '{};dist'.format(taxa): zerodiv(ndiff + all_diff,
+                                            ntotal + all_total)})
+    return entry
+
+
+def calc_pairwise_distances(args):
+    """Count the pairwise nucleotide distance between
+       combinations of samples in a window
+    """
+    mvf = MultiVariantFile(args.mvf, 'read')
+    data = {}
+    sample_labels = mvf.get_sample_labels()
+    if args.sample_indices is not None:
+        sample_indices = [int(x) for x in
+                          args.sample_indices[0].split(",")]
+    elif args.sample_labels is not None:
+        sample_indices = mvf.get_sample_indices(
+            labels=args.sample_labels[0].split(","))
+    else:
+        sample_indices = mvf.get_sample_indices()
+    sample_pairs = [tuple(x) for x in combinations(sample_indices, 2)]
+    params = {'sample_indices': sample_indices,
+              'sample_pairs': sample_pairs,
+              'windowsize': args.windowsize,
+              'mincoverage': args.mincoverage}
+    windows, pending = merge_window_chunks(
+        run_contig_chunks(mvf, pairwise_distance_chunk, params,
+                          threads=args.threads, windowed=True,
+                          quiet=args.quiet),
+        args.windowsize, add_pairwise_matches)
+    if pending is not None and pending[2]:
         # Check whether, windows, contigs, or total
+        (contig, position), matches = pending[:2]
         if args.windowsize == 0:
-            current_contig = 'TOTAL'
-            current_position = 0
+            contig = 'TOTAL'
+            position = 0
         elif args.windowsize == -1:
-            current_position = 0
-        data[(current_contig, current_position)] = {
-            'contig': current_contig, 'position': current_position}
-        if mvf.flavor == 'dna':
-            all_diff, all_total = pairwise_distance_nuc(all_match)
-        elif mvf.flavor == 'prot':
-            all_diff, all_total = pairwise_distance_prot(all_match)
-        for samplepair in base_matches:
-            if mvf.flavor == 'dna':
-                ndiff, ntotal = pairwise_distance_nuc(base_matches[samplepair])
-            elif mvf.flavor == 'prot':
-                ndiff, ntotal = pairwise_distance_prot(
-                    base_matches[samplepair])
-            taxa = "{};{}".format(sample_labels[samplepair[0]],
-                                  sample_labels[samplepair[1]])
-            data[(current_contig, current_position)].update({
-                '{};ndiff'.format(taxa): ndiff + all_diff,
-                '{};ntotal'.format(taxa): ntotal + all_total,
-                '{};dist'.format(taxa): zerodiv(ndiff + all_diff,
-                                                ntotal + all_total)})
+            position = 0
+        windows.append(((contig, position), matches))
+    for (contig, position), (all_match, base_matches) in windows:
+        data[(contig, position)] = pairwise_distance_entry(
+            contig, position, all_match, base_matches, mvf.flavor,
+            sample_labels)
     headers = ['contig', 'position']
     for samplepair in sample_pairs:
         headers.extend(['{};{};{}'.format(
@@ -559,11 +844,148 @@ def calc_pairwise_distances(args):
     sorted_entries = sorted([(
         data[k]['contig'], data[k]['position'], k)
                              for k in data])
-    for _, _, k in sorted_entries:
-        outfile.write_entry(data[k])
+    outfile.write_entries([data[k] for _, _, k in sorted_entries])
+    outfile.close()
     return ''
 
 
+class PairwiseMatchCounter(object):
+    """Counts base pairs for every sample pair over a window,
+       tabulating blocks of decoded sites with NumPy
+       (or counting each site into per-pair dicts without NumPy)
+        Params:
+            sample_pairs: list of (i, j) sample column tuples
+            validchars: characters to count (pairs containing any
+                        other character are ignored)
+            block_cells: max number of sites x pairs per block
+        get_matches() returns the same dict[pair][basepair] = count
+        as counting sites one by one, with basepairs in order of
+        first occurrence (which fixes the order of random draws
+        for ambiguous bases).
+    """
+
+    def __init__(self, sample_pairs, validchars, block_cells=2 ** 22):
+        self.sample_pairs = list(dict.fromkeys(sample_pairs))
+        self.validchars = validchars
+        self.pair_index = dict((x, k) for k, x in
+                               enumerate(self.sample_pairs))
+        self.npairs = len(self.sample_pairs)
+        self.nchar = len(validchars)
+        # Full sites only contribute to pairs in column order
+        site_pairs = [k for k, (i, j) in enumerate(self.sample_pairs)
+                      if i < j]
+        if np is None:
+            self.site_pairs = [self.sample_pairs[k] for k in site_pairs]
+            self.reset()
+            return
+        self.charcodes = np.full(256, -1, dtype=np.int16)
+        for k, char in enumerate(validchars):
+            self.charcodes[ord(char)] = k
+        self.site_pair_index = np.array(site_pairs, dtype=np.int64)
+        self.cols_i = np.array([self.sample_pairs[k][0] for k in site_pairs],
+                               dtype=np.int64)
+        self.cols_j = np.array([self.sample_pairs[k][1] for k in site_pairs],
+                               dtype=np.int64)
+        self.block_rows = max(1, block_cells // max(1, len(site_pairs)))
+        self.reset()
+
+    def reset(self):
+        """Clear counts for a new window"""
+        if np is None:
+            self.matches = dict((x, {}) for x in self.sample_pairs)
+            return ''
+        ncells = self.npairs * self.nchar * self.nchar
+        self.counts = np.zeros(ncells, dtype=np.int64)
+        self.first = np.full(ncells, np.iinfo(np.int64).max, dtype=np.int64)
+        self.pair_events = {}
+        self.rows = []
+        self.row_events = []
+        self.nevents = 0
+        return ''
+
+    def add_site(self, alleles):
+        """Count all sample pairs at a decoded site"""
+        if np is None:
+            validchars = self.validchars
+            for samplepair in self.site_pairs:
+                basepair = alleles[samplepair[0]] + alleles[samplepair[1]]
+                if basepair[0] in validchars and basepair[1] in validchars:
+                    self.matches[samplepair][basepair] = (
+                        self.matches[samplepair].get(basepair, 0) + 1)
+            return ''
+        self.rows.append(alleles)
+        self.row_events.append(self.nevents)
+        self.nevents += 1
+        if len(self.rows) >= self.block_rows:
+            self._count_rows()
+        return ''
+
+    def add_pair(self, samplepair, basepair):
+        """Count a single basepair for one sample pair"""
+        if np is None:
+            if all(x in self.validchars for x in basepair):
+                self.matches[samplepair][basepair] = (
+                    self.matches[samplepair].get(basepair, 0) + 1)
+            return ''
+        k = self.pair_index[samplepair]
+        if all(x in self.validchars for x in basepair):
+            cell = ((k * self.nchar + self.validchars.index(basepair[0])) *
+                    self.nchar + self.validchars.index(basepair[1]))
+            if cell not in self.pair_events:
+                self.pair_events[cell] = [0, self.nevents]
+            self.pair_events[cell][0] += 1
+        self.nevents += 1
+        return ''
+
+    def _count_rows(self):
+        """Tabulate the buffered sites"""
+        if not self.rows:
+            return ''
+        codes = self.charcodes[np.frombuffer(
+            ''.join(self.rows).encode(), dtype=np.uint8).reshape(
+                len(self.rows), -1)]
+        codes_i = codes[:, self.cols_i].astype(np.int64)
+        codes_j = codes[:, self.cols_j].astype(np.int64)
+        valid = (codes_i >= 0) & (codes_j >= 0)
+        cells = ((self.site_pair_index * self.nchar + codes_i) *
+                 self.nchar + codes_j)[valid]
+        self.counts += np.bincount(cells, minlength=len(self.counts))
+        # Cells are in site order, so the first index is the first event
+        cells, first_index = np.unique(cells, return_index=True)
+        events = np.broadcast_to(
+            np.array(self.row_events, dtype=np.int64)[:, None],
+            valid.shape)[valid][first_index]
+        self.first[cells] = np.minimum(self.first[cells], events)
+        self.rows = []
+        self.row_events = []
+        return ''
+
+    def get_matches(self):
+        """Returns dict[samplepair][basepair] = count"""
+        if np is None:
+            return self.matches
+        self._count_rows()
+        cells = dict((int(cell), [int(self.counts[cell]),
+                                  int(self.first[cell])])
+                     for cell in np.nonzero(self.counts)[0])
+        for cell, (count, first) in self.pair_events.items():
+            if cell in cells:
+                cells[cell][0] += count
+                cells[cell][1] = min(cells[cell][1], first)
+            else:
+                cells[cell] = [count, first]
+        matches = dict((x, {}) for x in self.sample_pairs)
+        nsquare = self.nchar * self.nchar
+        for first, cell, count in sorted(
+                (first, cell, count)
+                for cell, (count, first) in cells.items()):
+            k, code = divmod(cell, nsquare)
+            matches[self.sample_pairs[k]][
+                self.validchars[code // self.nchar] +
+                self.validchars[code % self.nchar]] = count
+        return matches
+
+
 def pairwise_distance_nuc(basepairs, strict=False):
     """Calculates pairwise distances between two sequences
         strict = only use ATGC if True,
@@ -44,6 +44,18 @@ class MvfArgumentParser(argparse.ArgumentParser):
             "--quiet", action="store_true",
             help="Suppress screen output.")
 
+    def addarg_bgzf(self):
+        self.add_argument(
+            "--bgzf", action="store_true",
+            help=("Write block-gzip (BGZF) compressed output with a "
+                  ".mvfi index for random access by contig/position."))
+
+    def addarg_compresslevel(self):
+        self.add_argument(
+            "--compress-level", "--compresslevel", default=6,
+            action=int_range_action(1, 9),
+            help=("Compression level (1-9) for gzip or BGZF output."))
+
     def addarg_contigs(self):
         self.add_argument(
             "--contigs",
@@ -141,6 +153,14 @@ class MvfArgumentParser(argparse.ArgumentParser):
                     str(nmin) + " or more " if nmin is not None
                     else "")))
 
+    def addarg_threads(self, helptext=None):
+        self.add_argument(
+            "--threads", default=1, action=int_range_action(1, 'Inf'),
+            help=helptext or (
+                "Number of processes to run in parallel. Analyses split "
+                "work by contig, which requires an uncompressed or BGZF "
+                "MVF file (indexed with BuildIndex for best results)."))
+
     def addarg_windowsize(self):
         self.add_argument(
             "--windowsize", default=100000,
@@ -157,6 +177,14 @@ class MvfArgumentParser(argparse.ArgumentParser):
                   "(one per line, inclusive coordinates) "
                   "all data will be returned if left blank."))
 
+    def addarg_region_table(self):
+        self.add_argument(
+            "--region-table", "--regiontable", type=os.path.abspath,
+            help=("Path of a plain text file with lines "
+                  "'contigid,start,stop,outfile' (start/stop may be "
+                  "blank for whole contigs); writes each region to "
+                  "its own file in the --out directory in one pass."))
+
 
 def int_range_action(min_value, max_value):
     class IntRangeAction(argparse.Action):
@@ -30,7 +30,9 @@ along with MVFtools.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import gzip
+from bisect import bisect_right
 from itertools import groupby
+from pylib.mvfbgzf import BgzfReader, BgzfWriter, is_bgzf
 
 
 # ==== Math Functions ====
@@ -83,6 +85,110 @@ def fasta_iter(fasta_name):
         yield header, seq
 
 
+class IndexedFasta(object):
+    """Random access to sequences of an uncompressed FASTA file
+    Object Structure:
+        path: FASTA file path
+        names: list of sequence names (first word of the header)
+        entries: dict[name] = (length, offset, linebases, linewidth)
+        scanned: True if the index was built by scanning the file
+    Note: uses the samtools faidx index (path + '.fai') if present,
+          otherwise the file is scanned once to build it in memory
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.names = []
+        self.entries = {}
+        self.scanned = False
+        if os.path.exists(self.path + '.fai') and (
+                os.path.getmtime(self.path + '.fai') >=
+                os.path.getmtime(self.path)):
+            with open(self.path + '.fai', 'rt') as faifile:
+                for line in faifile:
+                    arr = line.split('\t')
+                    self.names.append(arr[0])
+                    self.entries[arr[0]] = tuple(int(x) for x in arr[1:5])
+        else:
+            self._scan()
+            self.scanned = True
+        self.handle = open(self.path, 'rb')
+
+    def _scan(self):
+        """Builds the sequence offset index by reading the file"""
+        offset = 0
+        name = None
+        short_line = False
+        with open(self.path, 'rb') as fastafile:
+            for line in fastafile:
+                if line.startswith(b'>'):
+                    name = line[1:].split()[0].decode()
+                    self.names.append(name)
+                    self.entries[name] = [0, offset + len(line), 0, 0]
+                    short_line = False
+                elif name is not None:
+                    entry = self.entries[name]
+                    linebases = len(line.rstrip(b'\r\n'))
+                    if entry[2] == 0:
+                        entry[2:] = [linebases, len(line)]
+                    elif short_line or linebases > entry[2]:
+                        raise RuntimeError(
+                            "FASTA sequence {} in {} has uneven line "
+                            "lengths and cannot be indexed".format(
+                                name, self.path))
+                    short_line = linebases < entry[2]
+                    entry[0] += linebases
+                offset += len(line)
+        for name in self.names:
+            self.entries[name] = tuple(self.entries[name])
+        return ''
+
+    def fetch(self, name, start=1, end=None):
+        """Returns the sequence of a region (1-based, inclusive)
+            Arguments:
+                name: sequence name
+                start: first position (default=1)
+                end: last position (default=end of sequence)
+        """
+        (length, offset, linebases, linewidth) = self.entries[name]
+        end = length if end is None else min(end, length)
+        if start > end:
+            return ''
+        first = (offset + (start - 1) // linebases * linewidth +
+                 (start - 1) % linebases)
+        last = (offset + (end - 1) // linebases * linewidth +
+                (end - 1) % linebases)
+        self.handle.seek(first)
+        return self.handle.read(last - first + 1).decode().replace(
+            '\n', '').replace('\r', '')
+
+    def header(self, name):
+        """Returns the full header line of a sequence (without '>')"""
+        offset = self.entries[name][1]
+        size = 256
+        while True:
+            start = max(0, offset - size)
+            self.handle.seek(start)
+            block = self.handle.read(offset - start).rstrip(b'\r\n')
+            if b'\n' in block or start == 0:
+                break
+            size *= 4
+        return block[block.rfind(b'\n') + 1:].decode()[1:].strip()
+
+    def write_index(self):
+        """Writes the index as a samtools faidx index (path + '.fai')"""
+        with open(self.path + '.fai', 'wt') as faifile:
+            for name in self.names:
+                faifile.write("{}\t{}\n".format(name, '\t'.join(
+                    str(x) for x in self.entries[name])))
+        return ''
+
+    def close(self):
+        """Close the file"""
+        self.handle.close()
+        return ''
+
+
 def same_window(coords1, coords2, windowsize):
     """ coords1/coords1 = a tuple or list with (contig, position)
         windowsize = the windowsize, 0=whole file (always True), -1 contigs
@@ -106,6 +212,275 @@ def mixed_sorter(x):
         return x
 
 
+# MVF Index Object
+
+class MvfIndex(object):
+    """Contig/position offset index stored alongside an MVF (path + '.mvfi')
+    Object Structure:
+        kind: 'bgzf' (virtual offsets into a BGZF file)
+              or 'plain' (byte offsets into an uncompressed file)
+        interval: number of entries between position checkpoints
+        order: list of contig ids in the order they appear in the file
+        contigs: dict[id] = dict(first=offset, last=offset, nentry=int)
+        checkpoints: dict[id] = list of (position, offset)
+        contiguous: False if any contig has more than one run of entries
+    Note: entries are assumed to be sorted by position within each contig,
+          and only the first run of entries for each contig is indexed
+          (matching the behavior of MultiVariantFile.iterentries)
+    """
+
+    def __init__(self, kind='bgzf', interval=1000):
+        self.kind = kind
+        self.interval = interval
+        self.order = []
+        self.contigs = {}
+        self.checkpoints = {}
+        self.contiguous = True
+        self._current = None
+        self._nentry = None
+
+    def add(self, contigid, pos, offset):
+        """Records the offset of an entry line
+            Arguments:
+                contigid: contig id (str)
+                pos: entry position (int)
+                offset: offset of the start of the line
+        """
+        if contigid != self._current:
+            self._current = contigid
+            if contigid in self.contigs:
+                self._nentry = None
+                self.contiguous = False
+                return ''
+            self.order.append(contigid)
+            self.contigs[contigid] = {'first': offset, 'last': offset,
+                                      'nentry': 0}
+            self.checkpoints[contigid] = []
+            self._nentry = 0
+        elif self._nentry is None:
+            return ''
+        if self._nentry % self.interval == 0:
+            self.checkpoints[contigid].append((pos, offset))
+        self._nentry += 1
+        self.contigs[contigid]['last'] = offset
+        self.contigs[contigid]['nentry'] = self._nentry
+        return ''
+
+    def seek_offset(self, contigid, start=None):
+        """Returns the offset of the last checkpoint at or before start
+           (or the start of the contig if start is None)
+        """
+        points = self.checkpoints[contigid]
+        if start is None:
+            return points[0][1]
+        j = bisect_right([x[0] for x in points], start) - 1
+        return points[max(j, 0)][1]
+
+    def write(self, path):
+        """Writes the index to path"""
+        with open(path, 'wt') as outfile:
+            outfile.write(
+                "##mvfi version=1 kind={} interval={} contiguous={}\n".format(
+                    self.kind, self.interval, int(self.contiguous)))
+            for contigid in self.order:
+                outfile.write("#c {} first={} last={} nentry={}\n".format(
+                    contigid, self.contigs[contigid]['first'],
+                    self.contigs[contigid]['last'],
+                    self.contigs[contigid]['nentry']))
+            for contigid in self.order:
+                for pos, offset in self.checkpoints[contigid]:
+                    outfile.write("{}\t{}\t{}\n".format(
+                        contigid, pos, offset))
+        return ''
+
+    @classmethod
+    def read(cls, path):
+        """Reads an index from path"""
+        index = cls()
+        with open(path, 'rt') as infile:
+            for line in infile:
+                entry = line.split()
+                if entry[0] == '##mvfi':
+                    params = dict(x.split('=') for x in entry[1:])
+                    index.kind = params['kind']
+                    index.interval = int(params['interval'])
+                    index.contiguous = params.get('contiguous', '1') == '1'
+                elif entry[0] == '#c':
+                    index.order.append(entry[1])
+                    index.contigs[entry[1]] = dict(
+                        (k, int(v)) for k, v in (
+                            x.split('=') for x in entry[2:]))
+                    index.checkpoints[entry[1]] = []
+                else:
+                    index.checkpoints[entry[0]].append(
+                        (int(entry[1]), int(entry[2])))
+        return index
+
+
+class MvfCodec(object):
+    """Compiled encoder/decoder for MVF allele strings
+        Params:
+            ncol: number of sample columns
+            flavor: MVF flavor [dna, codon, protein, dnaqual, dnaindel]
+        Compact encodings (optionally prefixed with '@' for no reference):
+            invariant: 'A'
+            refvar: 'AC'
+            onecov: 'A+C4'
+            onevar: 'AT+C4'
+            full: one character per column
+        Each string is classified once and expanded by a per-type
+        expander using row templates built from ncol.
+        Decoded compact strings are cached, since most lines in
+        a genome-scale file repeat a small set of compact strings.
+    """
+
+    cache_size = 100000
+
+    def __init__(self, ncol, flavor='dna'):
+        self.ncol = ncol
+        self.flavor = flavor
+        self._decoded = {}
+        self._subset = ()
+        self._subset_decoded = {}
+        # number of decoded columns and gap row, keyed by '@' prefix
+        self._width = {'': ncol, '@': ncol - 1}
+        self._gaprow = {'': ['-'] * ncol, '@': ['-'] * (ncol - 1)}
+        self._expanders = {'invariant': self._expand_invariant,
+                           'refvar': self._expand_refvar,
+                           'onecov': self._expand_onecov,
+                           'onevar': self._expand_onevar}
+
+    @staticmethod
+    def classify(alleles):
+        """Returns the encoding type of an allele string
+            Arguments:
+                alleles: encoded allele string
+        """
+        if alleles[0] == '@':
+            alleles = alleles[1:]
+        if len(alleles) == 1:
+            return 'invariant'
+        if len(alleles) == 2:
+            return 'refvar'
+        if alleles[1] == '+':
+            return 'onecov'
+        if alleles[2] == '+':
+            return 'onevar'
+        return 'full'
+
+    def decode(self, alleles):
+        """Decode entry into full-length alleles
+            Arguments:
+                alleles: encoded allele string
+        """
+        decoded = self._decoded.get(alleles)
+        if decoded is None:
+            kind = self.classify(alleles)
+            if kind == 'full':
+                return alleles
+            if len(self._decoded) >= self.cache_size:
+                self._decoded.clear()
+            if alleles[0] == '@':
+                decoded = '@' + self._expanders[kind](alleles[1:], '@')
+            else:
+                decoded = self._expanders[kind](alleles, '')
+            self._decoded[alleles] = decoded
+        return decoded
+
+    def decode_subset(self, alleles, subset):
+        """Decode only the subset columns of an allele string
+            Arguments:
+                alleles: encoded allele string
+                subset: list of column indices
+        """
+        subset = tuple(subset)
+        if subset != self._subset:
+            self._subset = subset
+            self._subset_decoded = {}
+        decoded = self._subset_decoded.get(alleles)
+        if decoded is None:
+            if self.classify(alleles) == 'full':
+                return ''.join([alleles[j] for j in subset])
+            if len(self._subset_decoded) >= self.cache_size:
+                self._subset_decoded.clear()
+            full = self.decode(alleles)
+            decoded = ''.join([full[j] for j in subset])
+            self._subset_decoded[alleles] = decoded
+        return decoded
+
+    def _expand_invariant(self, alleles, prefix):
+        """Expand 'A' (alleles without the '@' prefix)"""
+        return alleles * self._width[prefix]
+
+    def _expand_refvar(self, alleles, prefix):
+        """Expand 'AC' (alleles without the '@' prefix)"""
+        return alleles[0] + alleles[1] * (self._width[prefix] - 1)
+
+    def _expand_onecov(self, alleles, prefix):
+        """Expand 'A+C4' (alleles without the '@' prefix)"""
+        newalleles = self._gaprow[prefix][:]
+        newalleles[0] = alleles[0]
+        newalleles[int(alleles[3:])] = alleles[2]
+        return ''.join(newalleles)
+
+    def _expand_onevar(self, alleles, prefix):
+        """Expand 'AT+C4' (alleles without the '@' prefix)"""
+        tmp = int(alleles[4:])
+        return "{}{}{}{}".format(alleles[0], alleles[1] * (tmp - 1),
+                                 alleles[3],
+                                 alleles[1] * (self._width[prefix] - tmp - 1))
+
+    def subset_chars(self, alleles, subset):
+        """Returns the set of characters in the subset columns,
+           read from the compact encoding without decoding it
+            Arguments:
+                alleles: encoded allele string
+                subset: list of column indices
+        """
+        kind = self.classify(alleles)
+        if kind == 'full':
+            return set(alleles[j] for j in subset)
+        chars = set()
+        offset = 0
+        if alleles[0] == '@':
+            if 0 in subset:
+                chars.add('@')
+            alleles = alleles[1:]
+            offset = 1
+        cols = [j - offset for j in subset if j >= offset]
+        if kind == 'invariant':
+            if cols:
+                chars.add(alleles)
+            return chars
+        if kind == 'refvar':
+            (other, otherchar, restchar) = (0, alleles[0], alleles[1])
+        elif kind == 'onecov':
+            (other, otherchar, restchar) = (int(alleles[3:]), alleles[2],
+                                            '-')
+        else:
+            (other, otherchar, restchar) = (int(alleles[4:]), alleles[3],
+                                            alleles[1])
+        for j in cols:
+            if j == 0:
+                chars.add(alleles[0])
+            elif j == other:
+                chars.add(otherchar)
+            else:
+                chars.add(restchar)
+        return chars
+
+    def encode(self, alleles):
+        """Encode full-length alleles to MVF short form
+           (ambiguous 'N' is written as 'X' for dna)
+            Arguments:
+                alleles: unencoded allele string
+        """
+        if self.flavor == 'dna':
+            return encode_mvfstring(alleles).replace(
+                'N', 'X').replace('n', 'X')
+        return encode_mvfstring(alleles)
+
+
 # MVF Class Object
 
 class MultiVariantFile(object):
@@ -121,6 +496,11 @@ class MultiVariantFile(object):
             samples: dict[index] = dict(sample_info)
             ncol: auto-generated int(number of samples)
             labels: auto-generated tuple of sample labels
+        bgzf: write BGZF-compressed blocks and a .mvfi index (write mode)
+        compresslevel: gzip/BGZF compression level for output (default=6)
+        index: MvfIndex for random access (loaded from path + '.mvfi'
+               when present in read mode, built during write for bgzf)
+        codec: MvfCodec for encoding/decoding allele strings
     """
 
     def __init__(self, path, filemode, **kwargs):
@@ -135,12 +515,23 @@ class MultiVariantFile(object):
             raise RuntimeError("Invalid filemode {}".format(filemode))
         self.filemode = filemode
         self.entrystart = 0
+        self.bgzf = kwargs.get('bgzf', False)
+        self.compresslevel = kwargs.get('compresslevel', 6)
+        self.index = None
+        self._writer = None
+        self._writer_opened = False
+        self._codec = None
+        self._contigindex = None
+        self._sampleindex = None
         # Check for Gzip and establish file object
         self.metadata['isgzip'] = (self.path.endswith(".gz") or
-                                   kwargs.get('isgzip', False))
+                                   kwargs.get('isgzip', False) or
+                                   self.bgzf)
         # READ MODE
         if filemode in ('read', 'r', 'rb'):
             if os.path.exists(self.path):
+                if not self.metadata['isgzip'] and is_bgzf(self.path):
+                    self.metadata['isgzip'] = True
                 filehandler = (self.metadata.get('isgzip', False) and
                                gzip.open(self.path, 'rt') or
                                open(self.path, 'rt'))
@@ -155,8 +546,12 @@ class MultiVariantFile(object):
                     self.entrystart = filehandler.tell()
                     line = filehandler.readline()
                 self._process_header(header_lines)
+                self._get_sample_index()
+                self._get_contig_index()
                 # Establish number of columns
                 self.metadata['ncol'] = len(self.metadata['labels'])
+                filehandler.close()
+                self._load_index()
             else:
                 raise IOError("MVF path {} not found!".format(self.path))
         # WRITE MODE
@@ -166,13 +561,114 @@ class MultiVariantFile(object):
                 raise IOError(
                     """MVF path {} already exists, use --overwrite
                     to replace""".format(self.path))
-            filehandler = (self.metadata.get('isgzip', False) and
-                           gzip.open(self.path, 'wt') or
-                           open(self.path, 'wt'))
+            # Truncate only, the output handle is opened on first write
+            # and held until close() so gzip output is a single stream
+            filehandler = open(self.path, 'wb')
+            filehandler.close()
+            if self.bgzf:
+                self.index = MvfIndex(
+                    kind='bgzf', interval=kwargs.get('index_interval', 1000))
             self.metadata['ncol'] = kwargs.get('ncol', 2)
-        filehandler.close()
         self.flavor = kwargs['flavor'] if 'flavor' in kwargs else self.flavor
 
+    def _load_index(self):
+        """Loads the .mvfi index if present and not older than the MVF"""
+        indexpath = self.path + '.mvfi'
+        if not os.path.exists(indexpath) or (
+                os.path.getmtime(indexpath) < os.path.getmtime(self.path)):
+            return ''
+        index = MvfIndex.read(indexpath)
+        if index.kind == 'bgzf' and is_bgzf(self.path):
+            self.index = index
+        elif index.kind == 'plain' and not self.metadata['isgzip']:
+            self.index = index
+        return ''
+
+    def _open_indexed(self):
+        """Opens the MVF in binary mode for seeking to index offsets"""
+        if self.index.kind == 'bgzf':
+            return BgzfReader(self.path)
+        return open(self.path, 'rb')
+
+    def build_index(self, interval=1000):
+        """Scans the MVF entries and writes a .mvfi index
+            Arguments:
+                interval: number of entries between position checkpoints
+        """
+        self.index = self.scan_index(interval=interval)
+        self.index.write(self.path + '.mvfi')
+        return ''
+
+    def scan_index(self, interval=1000):
+        """Scans the MVF entries and returns an MvfIndex
+            Arguments:
+                interval: number of entries between position checkpoints
+        """
+        if self.metadata['isgzip'] and not is_bgzf(self.path):
+            raise RuntimeError(
+                "{} is gzip-compressed but not BGZF; only uncompressed "
+                "or BGZF (--bgzf) MVF files can be indexed".format(
+                    self.path))
+        index = MvfIndex(kind=('bgzf' if self.metadata['isgzip']
+                               else 'plain'), interval=interval)
+        if index.kind == 'bgzf':
+            filehandler = BgzfReader(self.path)
+            offset = filehandler.tell()
+            line = filehandler.readline()
+            while line:
+                if not line.startswith(b'#') and line.strip():
+                    loc = line.split(None, 1)[0].split(b':')
+                    index.add(loc[0].decode(), int(loc[1]), offset)
+                offset = filehandler.tell()
+                line = filehandler.readline()
+        else:
+            filehandler = open(self.path, 'rb')
+            filehandler.seek(self.entrystart)
+            offset = self.entrystart
+            for line in filehandler:
+                if line.strip():
+                    loc = line.split(None, 1)[0].split(b':')
+                    index.add(loc[0].decode(), int(loc[1]), offset)
+                offset += len(line)
+        filehandler.close()
+        return index
+
+    def get_contig_chunks(self, nchunks, contigs=None):
+        """Splits contigs into runs (in file order) with similar
+           numbers of entries, for processing chunks in parallel.
+           An in-memory index is scanned if no .mvfi index is loaded.
+           Returns None if the file cannot be read by contig
+           (gzip but not BGZF, or contigs are not contiguous)
+
+            Arguments:
+                nchunks: maximum number of chunks
+                contigs: list of contig ids to include (default=all)
+        """
+        if self.index is None:
+            if self.metadata['isgzip'] and not is_bgzf(self.path):
+                return None
+            self.index = self.scan_index()
+        if not self.index.contiguous:
+            return None
+        wanted = None if contigs is None else set(contigs)
+        order = [x for x in self.index.order
+                 if wanted is None or x in wanted]
+        target = float(sum(self.index.contigs[x]['nentry']
+                           for x in order)) / max(nchunks, 1)
+        chunks = []
+        chunk = []
+        nentry = 0
+        for contigid in order:
+            chunk.append(contigid)
+            nentry += self.index.contigs[contigid]['nentry']
+            if nentry >= target:
+                chunks.append(chunk)
+                chunk = []
+                nentry = 0
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
     def _process_header(self, headerlines):
         """Processes header lines into metadata
             Arguments:
@@ -243,14 +739,29 @@ class MultiVariantFile(object):
         """
         if labels is None:
             return range(len(self.metadata['labels']))
+        index = self._get_sample_index()[2]
         try:
-            if hasattr(labels, '__iter__'):
-                return [self.metadata['labels'].index(x) for x in labels]
+            if hasattr(labels, '__iter__') and not isinstance(labels, str):
+                return [index[x] for x in labels]
             else:
-                return self.metadata['labels'].index(labels)
-        except IndexError:
+                return index[labels]
+        except KeyError:
             raise IndexError(labels, "contains invalid label")
 
+    def _get_sample_index(self):
+        """Returns [labels, nlabels, dict[label] = first index],
+           rebuilt when metadata['labels'] was replaced or resized directly
+        """
+        labels = self.metadata['labels']
+        if (self._sampleindex is None or
+                self._sampleindex[0] is not labels or
+                self._sampleindex[1] != len(labels)):
+            index = {}
+            for i, label in enumerate(labels):
+                index.setdefault(label, i)
+            self._sampleindex = [labels, len(labels), index]
+        return self._sampleindex
+
     def get_sample_labels(self, indices=None):
         """Get labels for the specified named indices
             Arguments:
@@ -271,15 +782,17 @@ class MultiVariantFile(object):
         """
         if labels is None:
             return [x for x in self.metadata['contigs']]
+        index = self._get_contig_index()[2]
         try:
             if (isinstance(labels, list) or
                 isinstance(labels, tuple) or
                     isinstance(labels, set)):
+                wanted = set(x for label in labels
+                             for x in index.get(label, ()))
                 return [str(x) for x in self.metadata['contigs']
-                        if self.metadata['contigs'][x]['label'] in labels]
+                        if x in wanted]
             elif isinstance(labels, str) or isinstance(labels, int):
-                return [x for x in self.metadata['contigs']
-                        if self.metadata['contigs'][x]['label'] == str(labels)]
+                return list(index.get(str(labels), ()))
         except IndexError:
             raise IndexError("contig labels '{}' not found".format(labels))
 
@@ -299,13 +812,50 @@ class MultiVariantFile(object):
         except IndexError:
             raise IndexError("contig ids '{}' not found".format(ids))
 
+    def _get_contig_index(self):
+        """Returns [contigs, ncontigs, dict[label] = [ids], max integer id],
+           rebuilt when metadata['contigs'] was replaced or resized directly
+        """
+        contigs = self.metadata['contigs']
+        if (self._contigindex is None or
+                self._contigindex[0] is not contigs or
+                self._contigindex[1] != len(contigs)):
+            labels = {}
+            maxid = 0
+            for contigid, contigdata in contigs.items():
+                labels.setdefault(contigdata.get('label'), []).append(
+                    contigid)
+                if is_int(contigid):
+                    maxid = max(maxid, int(contigid))
+            self._contigindex = [contigs, len(contigs), labels, maxid]
+        return self._contigindex
+
+    def add_contig(self, contigid, contigdata):
+        """Adds a contig to the metadata and updates the contig indexes
+            Arguments:
+                contigid: MVF contig id
+                contigdata: dict of contig metadata (label, length, ...)
+        """
+        if contigid in self.metadata['contigs']:
+            self.metadata['contigs'][contigid] = contigdata
+            self._contigindex = None
+            return ''
+        index = self._get_contig_index()
+        self.metadata['contigs'][contigid] = contigdata
+        index[1] += 1
+        index[2].setdefault(contigdata.get('label'), []).append(contigid)
+        if is_int(contigid):
+            index[3] = max(index[3], int(contigid))
+        return ''
+
+    def get_contig_id(self, label):
+        """Returns the first contig id with the given label or None"""
+        contigids = self._get_contig_index()[2].get(label)
+        return contigids[0] if contigids else None
+
     def get_next_contig_id(self):
         """Returns the (highest integer id) + 1 or 0"""
-        maxid = 0
-        for contigid in self.metadata['contigs']:
-            if is_int(contigid):
-                maxid = max(maxid, int(contigid))
-        return str(maxid + 1)
+        return str(self._get_contig_index()[3] + 1)
 
     def __iter__(self, quiet=False):
         """Simple entry iterator
@@ -339,7 +889,7 @@ class MultiVariantFile(object):
                  or list(allele entries) with 'onlyalleles'
 
         Arguments:
-            contigs: list of contig ids to include (default=all)
+            contigs: list/set of contig ids to include (default=all)
             decode:fully decode the allele sets (T/F)
             no_invariant: set to false to skip invariant sites
             no_ambig: set to false to skip positions with 'N'
@@ -359,45 +909,52 @@ class MultiVariantFile(object):
                                       'ref', False)])
             else:
                 contigs = sorted(self.metadata['contigs'].keys())
+        contigs = set(contigs)
         subset = subset or ''
+        codec = self.codec
         current_contigid = ''
         linecount = 0
-        if self.metadata['isgzip']:
-            filehandler = gzip.open(self.path, 'rb')
-        else:
-            filehandler = open(self.path, 'r')
-        filehandler.seek(self.entrystart)
-        for line in filehandler:
+        for line in self._iter_lines(contigs):
             try:
-                if self.metadata['isgzip']:
-                    arr = line.decode().rstrip().split()
-                else:
-                    arr = line.rstrip().split()
+                arr = line.rstrip().split()
                 loc = str(arr[0]).split(':')
                 contigid = loc[0]
                 pos = int(loc[1])
                 allelesets = arr[1:]
                 if contigid != current_contigid:
                     if current_contigid in contigs:
-                        contigs.remove(current_contigid)
+                        contigs.discard(current_contigid)
                         if not contigs:
                             break
                     current_contigid = contigid[:]
                 if contigid not in contigs:
                     continue
                 if subset:
+                    # Filters are checked on the compact encodings,
+                    # a single-character (invariant) first alleleset
+                    # stays invariant for any subset
+                    if no_invariant and len(allelesets[0]) == 1:
+                        continue
+                    if no_gap:
+                        chars = codec.subset_chars(allelesets[0], subset)
+                        if '-' in chars or '@' in chars:
+                            continue
+                    if no_ambig:
+                        if any('X' in codec.subset_chars(x, subset)
+                               for x in allelesets):
+                            continue
                     try:
-                        allelesets = [''.join([alleles[j] for j in subset])
-                                      for alleles in [self.decode(x)
-                                                      for x in allelesets]]
+                        allelesets = [codec.decode_subset(x, subset)
+                                      for x in allelesets]
                     except IndexError:
                         raise RuntimeError(allelesets)
-                if no_gap:
-                    if any(x in allelesets[0] for x in '-@'):
-                        continue
-                if no_ambig:
-                    if any('X' in x for x in allelesets):
-                        continue
+                else:
+                    if no_gap:
+                        if '-' in allelesets[0] or '@' in allelesets[0]:
+                            continue
+                    if no_ambig:
+                        if any('X' in x for x in allelesets):
+                            continue
                 if no_invariant:
                     if all(len(x) == 1 for x in allelesets):
                         continue
@@ -406,24 +963,141 @@ class MultiVariantFile(object):
                             allelesets[0][2] == allelesets[0][0]):
                         continue
                     elif subset:
-                        if all(x == allelesets[0][0]
-                               for x in allelesets[0][1:]):
+                        if allelesets[0].count(allelesets[0][0]) == len(
+                                allelesets[0]):
                             continue
 
                 if subset and not decode:
-                    allelesets = [self.encode(x) for x in allelesets]
+                    allelesets = [codec.encode(x) for x in allelesets]
                 if decode and not subset:
-                    allelesets = [self.decode(x) for x in allelesets]
+                    allelesets = [codec.decode(x) for x in allelesets]
                 if onlyalleles:
                     yield allelesets
                 else:
                     yield (contigid, pos, allelesets)
-            except:
+            except Exception:
                 raise RuntimeError(
                     "Error processing MVF at line# {} = {} ".format(
                         linecount, line))
+
+    def _iter_lines(self, contigs=None):
+        """Iterates raw entry lines (str)
+           If an index is present and only some contigs are requested,
+           seeks directly to each requested contig in file order.
+            Arguments:
+                contigs: list of contig ids to include (default=all)
+        """
+        wanted = set(contigs) if contigs is not None else None
+        if self.index is not None and wanted is not None and any(
+                x not in wanted for x in self.index.order):
+            reader = self._open_indexed()
+            for contigid in [x for x in self.index.order if x in wanted]:
+                reader.seek(self.index.contigs[contigid]['first'])
+                prefix = contigid + ':'
+                for line in reader:
+                    line = line.decode()
+                    if not line.startswith(prefix):
+                        break
+                    yield line
+            reader.close()
+            return
+        if self.metadata['isgzip']:
+            filehandler = gzip.open(self.path, 'rt')
+        else:
+            filehandler = open(self.path, 'r')
+        filehandler.seek(self.entrystart)
+        for line in filehandler:
+            yield line
         filehandler.close()
 
+    def fetch(self, contigid, start=None, end=None, decode=True):
+        """Iterates entries in a single contig region
+           Uses the index (if present) to seek to the nearest position
+           checkpoint instead of reading from the start of the file.
+           Returns (str(chrom), int(pos), list(allele entries))
+
+            Arguments:
+                contigid: contig id
+                start: first position to include (default=contig start)
+                end: last position to include (default=contig end)
+                decode: fully decode the allele sets (T/F)
+        """
+        contigid = str(contigid)
+        if self.index is None:
+            for entry in self.iterentries(contigs=[contigid], decode=decode):
+                if start is not None and entry[1] < start:
+                    continue
+                if end is not None and entry[1] > end:
+                    break
+                yield entry
+            return
+        if contigid not in self.index.contigs:
+            return
+        codec = self.codec
+        reader = self._open_indexed()
+        reader.seek(self.index.seek_offset(contigid, start))
+        prefix = contigid + ':'
+        for line in reader:
+            line = line.decode()
+            if not line.startswith(prefix):
+                break
+            arr = line.rstrip().split()
+            pos = int(arr[0][len(prefix):])
+            if start is not None and pos < start:
+                continue
+            if end is not None and pos > end:
+                break
+            allelesets = arr[1:]
+            if decode:
+                allelesets = [codec.decode(x) for x in allelesets]
+            yield (contigid, pos, allelesets)
+        reader.close()
+
+    def iter_batches(self, batch_size=100000, subset=None, contigs=None,
+                     no_invariant=False, no_gap=False, no_ambig=False):
+        """Iterates decoded entries in column-oriented NumPy batches
+           Returns (contig codes, positions, alleles) per batch:
+               contig codes: int32 array of indices into get_contig_ids()
+               positions: int64 array of positions
+               alleles: uint8 array (sites x samples) of allele characters
+                        from the first alleleset of each entry
+
+            Arguments:
+                batch_size: maximum number of sites per batch
+                subset: list of column indices (default=all)
+                contigs: list of contig ids to include (default=all)
+                no_invariant/no_gap/no_ambig: filters as in iterentries
+        """
+        contig_codes = dict((contigid, j) for j, contigid in
+                            enumerate(self.get_contig_ids()))
+        codes = []
+        positions = []
+        rows = []
+        for contigid, pos, allelesets in self.iterentries(
+                decode=True, contigs=contigs, subset=subset,
+                no_invariant=no_invariant, no_gap=no_gap,
+                no_ambig=no_ambig):
+            codes.append(contig_codes[contigid])
+            positions.append(pos)
+            rows.append(allelesets[0])
+            if len(rows) == batch_size:
+                yield self._make_batch(codes, positions, rows)
+                codes = []
+                positions = []
+                rows = []
+        if rows:
+            yield self._make_batch(codes, positions, rows)
+
+    @staticmethod
+    def _make_batch(codes, positions, rows):
+        """Converts lists of entry fields to a (codes, positions,
+           alleles) batch of arrays"""
+        import numpy as np
+        alleles = np.frombuffer(''.join(rows).encode('ascii'),
+                                dtype=np.uint8).reshape(len(rows), -1)
+        return (np.array(codes, dtype=np.int32),
+                np.array(positions, dtype=np.int64), alleles)
+
     def get_header(self):
         """Returns formatted header string (with final newline)
         """
@@ -452,57 +1126,36 @@ class MultiVariantFile(object):
             header.extend(["#n {}".format(x) for x in self.metadata["notes"]])
         return '\n'.join(header) + '\n'
 
+    @property
+    def codec(self):
+        """MvfCodec for the current ncol and flavor"""
+        if (self._codec is None or
+                self._codec.ncol != self.metadata['ncol'] or
+                self._codec.flavor != self.flavor):
+            self._codec = MvfCodec(self.metadata['ncol'], self.flavor)
+        return self._codec
+
     def decode(self, alleles):
         """Decode entry into full-length alleles
             Arguments:
                 alleles = encoded allele string
         """
-        ref = True
-        ncol = self.metadata['ncol']
-        if alleles.startswith('@'):
-            alleles = alleles[1:]
-            ref = False
-            ncol -= 1
-        if len(alleles) == 1:
-            alleles = alleles[0] * ncol
-        elif len(alleles) == 2:
-            alleles = alleles[0] + (alleles[1] * (ncol - 1))
-        elif alleles[1] == '+':
-            newalleles = [alleles[0]] + ['-'] * (ncol - 1)
-            newalleles[int(alleles[3:])] = alleles[2]
-            alleles = ''.join(newalleles)
-        elif alleles[2] == '+':
-            tmp = int(alleles[4:])
-            alleles = "{}{}{}{}".format(alleles[0],
-                                        alleles[1]*(tmp - 1),
-                                        alleles[3],
-                                        alleles[1]*(ncol - tmp - 1))
-        if not ref:
-            return '@' + alleles
-        return alleles
+        return self.codec.decode(alleles)
 
     def encode(self, alleles):
         """Internal copy of encode_mvfstring
             Arguments:
                 alleles: unencoded allele string
         """
-        if self.flavor == 'dna':
-            return encode_mvfstring(alleles).replace(
-                'N', 'X').replace('n', 'X')
-        else:
-            return encode_mvfstring(alleles)
+        return self.codec.encode(alleles)
 
     def write_data(self, data):
         """Writes datastring to the MVF file
             Argunments:
                 data: string datastream
         """
-        if self.metadata['isgzip'] or self.path.endswith('.gz'):
-            with gzip.open(self.path, 'at') as outfile:
-                outfile.write(data)
-        else:
-            with open(self.path, 'at') as outfile:
-                outfile.write(data)
+        self._get_writer().write(data)
+        return ''
 
     def write_entries(self, entries, encoded=True):
         """Write MVF entries
@@ -510,12 +1163,58 @@ class MultiVariantFile(object):
                 entries: list of entry tuples (contigid, pos, alleles)
                 encoded: entries have been pre-encoded (default=True)
         """
+        if self.index is not None:
+            writer = self._get_writer()
+            for entry in entries:
+                self.index.add(str(entry[0]), entry[1], writer.tell())
+                writer.write("{}:{} {}\n".format(
+                    entry[0], entry[1], ' '.join([
+                        x if encoded else encode_mvfstring(x)
+                        for x in entry[2]])))
+            return ''
         self.write_data('\n'.join(["{}:{} {}".format(
             entry[0], entry[1], ' '.join([
                 x if encoded else encode_mvfstring(x) for x in entry[2]]))
                                    for entry in entries]) + '\n')
         return ''
 
+    def _get_writer(self):
+        """Returns the open output handle (opened on first use)"""
+        if self._writer is None:
+            self._writer_opened = True
+            if self.bgzf:
+                self._writer = BgzfWriter(self.path, 'ab',
+                                          compresslevel=self.compresslevel)
+            elif self.metadata['isgzip'] or self.path.endswith('.gz'):
+                self._writer = gzip.open(self.path, 'at',
+                                         compresslevel=self.compresslevel)
+            else:
+                self._writer = open(self.path, 'at')
+        return self._writer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        """Finishes writing the MVF file
+           (closes the output handle and writes the .mvfi index)
+        """
+        if (not self._writer_opened and
+                self.filemode in ('write', 'w', 'wb')):
+            # open the writer once so an empty gzip/BGZF output
+            # is still a well-formed compressed stream
+            self._get_writer()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self.index is not None and self.filemode in ('write', 'w', 'wb'):
+            self.index.write(self.path + '.mvfi')
+        return ''
+
 
 def encode_mvfstring(alleles):
     """Encode full-length alleles to MVF short form
@@ -524,23 +1223,81 @@ def encode_mvfstring(alleles):
     if alleles.startswith('@'):
         alleles = alleles[1:]
         denovo = True
-    if all(x == alleles[1] for x in alleles[2:]):
-        if alleles[0] == alleles[1]:
+    first = alleles[1]
+    nrest = len(alleles) - 1
+    nfirst = alleles.count(first, 1)
+    if nfirst == nrest:
+        if alleles[0] == first:
             alleles = alleles[0]
         else:
             alleles = alleles[0:2]
-    elif alleles[1:].count(alleles[1]) == len(alleles) - 2:
-        pos = [(j, x) for j, x in enumerate(alleles[1:]) if x != alleles[1]]
+    elif nfirst == nrest - 1:
+        j = nrest - len(alleles[1:].lstrip(first))
         alleles = "{}{}+{}{}".format(
-            alleles[0], alleles[1] if alleles[1] != '-' else '',
-            pos[0][1], pos[0][0] + 1)
-    elif all(x == alleles[2] for x in alleles[3:]):
+            alleles[0], first if first != '-' else '',
+            alleles[j + 1], j + 1)
+    elif alleles.count(alleles[2], 3) == nrest - 2:
         alleles = "{}{}+{}1".format(
-            alleles[0], alleles[2] if alleles[2] != '-' else '', alleles[1])
+            alleles[0], alleles[2] if alleles[2] != '-' else '', first)
     if denovo:
         return '@' + alleles
     return alleles
 
+
+def encode_mvfstring_block(seqs):
+    """Encodes every column of a block of aligned sequences at once,
+       giving the same strings as encode_mvfstring on each column.
+       Invariant, refvar and single-difference columns are classified
+       with NumPy comparisons; only mixed columns are encoded as strings.
+       Without NumPy every column is encoded with encode_mvfstring.
+        Arguments:
+            seqs: list of equal-length str, one per sample (ref first)
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is None or len(seqs) < 3 or not seqs[0]:
+        return [encode_mvfstring(''.join(x)) for x in zip(*seqs)]
+    nseq = len(seqs)
+    ncol = len(seqs[0])
+    block = ''.join(seqs).encode('latin-1')
+    if len(block) != nseq * ncol:
+        raise RuntimeError("sequences in block differ in length")
+    arr = np.frombuffer(block, dtype=np.uint8).reshape(nseq, ncol)
+    eqfirst = arr[1:] == arr[1]
+    nfirst = eqfirst.sum(axis=0)
+    codes = np.select(
+        [arr[0] == ord('@'),
+         (nfirst == nseq - 1) & (arr[0] == arr[1]),
+         nfirst == nseq - 1,
+         nfirst == nseq - 2,
+         (arr[3:] == arr[2]).all(axis=0)],
+        [0, 1, 2, 3, 4], 0).tolist()
+    # sample index of the single differing allele, for code 3
+    diffpos = ((~eqfirst).argmax(axis=0) + 1).tolist()
+    ref = arr[0].tobytes().decode('latin-1')
+    first = arr[1].tobytes().decode('latin-1')
+    second = arr[2].tobytes().decode('latin-1')
+    encoded = []
+    for i, code in enumerate(codes):
+        if code == 1:
+            encoded.append(ref[i])
+        elif code == 2:
+            encoded.append(ref[i] + first[i])
+        elif code == 3:
+            j = diffpos[i]
+            encoded.append("{}{}+{}{}".format(
+                ref[i], first[i] if first[i] != '-' else '',
+                chr(arr[j, i]), j))
+        elif code == 4:
+            encoded.append("{}{}+{}1".format(
+                ref[i], second[i] if second[i] != '-' else '', first[i]))
+        else:
+            encoded.append(encode_mvfstring(
+                arr[:, i].tobytes().decode('latin-1')))
+    return encoded
+
 # ANALYSIS BACKEND
 
 
@@ -574,38 +1331,74 @@ class Counter(dict):
 class OutputFile(object):
     """Set up Output File
         Params:
-            path: file path
+            path: file path (gzip-compressed if ending in '.gz')
             headers: list of header elements
+        The output handle is held open until close() is called
+        (or the object is used as a context manager).
     """
 
     def __init__(self, path, headers):
         self.headers = headers
         self.path = os.path.abspath(path)
+        self.handle = (gzip.open(self.path, 'wt')
+                       if self.path.endswith('.gz') else
+                       open(self.path, 'wt'))
         self.write_headers()
 
     def write_headers(self):
         """Write headers to file"""
-        with open(self.path, 'wt') as outfile:
-            outfile.write('#' + '\t'.join(self.headers) + "\n")
+        self.handle.write('#' + '\t'.join(self.headers) + "\n")
         return ''
 
+    def format_entry(self, entry):
+        """Returns entry as a tab-delimited line
+            Arguments:
+                entry: dict of values with keys matching header
+        """
+        return "\t".join([str('.' if k not in entry else entry[k])
+                          for k in self.headers]) + "\n"
+
     def write_entry(self, entry):
         """Writes entry to file
             Arguments:
                 entry: dict of values with keys matching header
         """
-        with open(self.path, 'at') as outfile:
-            outfile.write("\t".join([str('.' if k not in entry else entry[k])
-                                     for k in self.headers]) + "\n")
+        self.handle.write(self.format_entry(entry))
+        return ''
+
+    def write_entries(self, entries):
+        """Writes multiple entries to file in a single write
+            Arguments:
+                entries: iterable of dicts with keys matching header
+        """
+        self.handle.write(''.join([self.format_entry(entry)
+                                   for entry in entries]))
         return ''
 
     def write(self, data):
         """Writes data to file
         """
-        with open(self.path, 'at') as outfile:
-            outfile.write(data)
+        self.handle.write(data)
+        return ''
+
+    def flush(self):
+        """Flush buffered output to disk"""
+        self.handle.flush()
         return ''
 
+    def close(self):
+        """Flush and close the output file"""
+        if not self.handle.closed:
+            self.handle.close()
+        return ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
 
 class AnalysisModule(object):
     """General Functions for Analysis Modules
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+mvfbgzf - Blocked GNU Zip Format (BGZF) reader and writer for MVFtools
+MVFtools: Multisample Variant Format Toolkit
+James B. Pease and Ben K. Rosenzweig
+http://www.github.org/jbpease/mvftools
+
+If you use this software please cite:
+Pease JB and BK Rosenzweig. 2015.
+"Encoding Data Using Biological Principles: the Multisample Variant Format
+for Phylogenomics and Population Genomics"
+IEEE/ACM Transactions on Computational Biology and Bioinformatics. In press.
+http://www.dx.doi.org/10.1109/tcbb.2015.2509997
+
+This file is part of MVFtools.
+
+MVFtools is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MVFtools is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MVFtools.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import struct
+import zlib
+
+# BGZF files are a series of standard gzip members, each holding at most
+# 64 KB of data and carrying its compressed size in a 'BC' extra subfield.
+# Any gzip reader can stream them, but a "virtual offset" of
+# (compressed block start << 16) | (offset within the block) can be used
+# to seek directly to any line without decompressing what comes before.
+
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER = struct.Struct('<4BI2BH2BH')
+GZIP_HEADER = struct.Struct('<4BI2BH')
+BGZF_EOF = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def is_bgzf(path):
+    """Checks if the file at path starts with a BGZF block header"""
+    with open(path, 'rb') as filehandler:
+        header = filehandler.read(BGZF_HEADER.size)
+    if len(header) < BGZF_HEADER.size:
+        return False
+    (id1, id2, _, flag, _, _, _, xlen,
+     si1, si2, _) = BGZF_HEADER.unpack(header)
+    return (id1 == 31 and id2 == 139 and flag & 4 != 0 and xlen >= 6 and
+            si1 == 66 and si2 == 67)
+
+
+def make_virtual_offset(block_start, within_block):
+    """Combines a compressed block offset and uncompressed offset"""
+    return (block_start << 16) | within_block
+
+
+def split_virtual_offset(voffset):
+    """Returns (block_start, within_block) for a virtual offset"""
+    return voffset >> 16, voffset & 0xffff
+
+
+class BgzfWriter(object):
+    """BGZF compressed output file
+        Params:
+            path: output file path
+            mode: 'wb' to create/truncate or 'ab' to append
+            compresslevel: zlib compression level (default=6)
+    """
+
+    def __init__(self, path, mode='wb', compresslevel=6):
+        self.handle = open(path, mode)
+        self.compresslevel = compresslevel
+        self.buffer = bytearray()
+
+    def _write_block(self, block):
+        """Compress and write a single block"""
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        cdata = compressor.compress(block) + compressor.flush()
+        self.handle.write(BGZF_HEADER.pack(
+            31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2) +
+                          struct.pack('<H', len(cdata) + 25) + cdata +
+                          struct.pack('<2I', zlib.crc32(block) & 0xffffffff,
+                                      len(block)))
+        return ''
+
+    def write(self, data):
+        """Buffer data and write out any full blocks
+            Arguments:
+                data: str or bytes
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer.extend(data)
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+        return ''
+
+    def tell(self):
+        """Returns the virtual offset of the next byte to be written"""
+        return make_virtual_offset(self.handle.tell(), len(self.buffer))
+
+    def flush(self):
+        """Write the partial block in the buffer (if any)"""
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.handle.flush()
+        return ''
+
+    def close(self):
+        """Flush, write the BGZF end-of-file marker, and close"""
+        self.flush()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+        return ''
+
+
+class BgzfReader(object):
+    """BGZF compressed input file with virtual offset seeking
+        Params:
+            path: input file path
+    """
+
+    def __init__(self, path):
+        self.handle = open(path, 'rb')
+        self.block = b''
+        self.block_start = 0
+        self.next_block = 0
+        self.within = 0
+
+    def _load_block(self, block_start):
+        """Reads and decompresses the block starting at block_start
+           Returns False at the end of the file
+        """
+        self.handle.seek(block_start)
+        header = self.handle.read(GZIP_HEADER.size)
+        if len(header) < GZIP_HEADER.size:
+            self.block = b''
+            self.block_start = block_start
+            self.next_block = block_start
+            self.within = 0
+            return False
+        (id1, id2, _, _, _, _, _, xlen) = GZIP_HEADER.unpack(header)
+        if id1 != 31 or id2 != 139:
+            raise RuntimeError(
+                "Invalid BGZF block at offset {} of {}".format(
+                    block_start, self.handle.name))
+        extra = self.handle.read(xlen)
+        bsize = None
+        j = 0
+        while j < xlen:
+            subfield_length = struct.unpack('<H', extra[j + 2:j + 4])[0]
+            if extra[j:j + 2] == b'BC':
+                bsize = struct.unpack('<H', extra[j + 4:j + 6])[0]
+            j += 4 + subfield_length
+        if bsize is None:
+            raise RuntimeError("{} is not BGZF compressed".format(
+                self.handle.name))
+        cdata = self.handle.read(bsize - xlen - 19)
+        self.handle.read(8)
+        self.block = zlib.decompress(cdata, -15)
+        self.block_start = block_start
+        self.next_block = block_start + bsize + 1
+        self.within = 0
+        return True
+
+    def seek(self, voffset):
+        """Moves to a virtual offset"""
+        block_start, within = split_virtual_offset(voffset)
+        if block_start != self.block_start or not self.block:
+            self._load_block(block_start)
+        self.within = within
+        return ''
+
+    def tell(self):
+        """Returns the current virtual offset"""
+        if self.within == len(self.block):
+            return make_virtual_offset(self.next_block, 0)
+        return make_virtual_offset(self.block_start, self.within)
+
+    def readline(self):
+        """Returns the next line (as bytes, including newline)
+           or b'' at end of file
+        """
+        pieces = []
+        while True:
+            if self.within >= len(self.block):
+                if not self._load_block(self.next_block):
+                    break
+                continue
+            j = self.block.find(b'\n', self.within)
+            if j != -1:
+                pieces.append(self.block[self.within:j + 1])
+                self.within = j + 1
+                break
+            pieces.append(self.block[self.within:])
+            self.within = len(self.block)
+        return b''.join(pieces)
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def close(self):
+        """Close the file"""
+        self.handle.close()
+        return ''
@@ -6,9 +6,10 @@ This program is used to convert a FASTA file into MVF format.
 
 import re
 import os
-from random import randint
-from pylib.mvfbase import encode_mvfstring, is_int
-from pylib.mvfbase import MultiVariantFile, fasta_iter
+import tempfile
+from bisect import bisect_right
+from pylib.mvfbase import encode_mvfstring_block, is_int
+from pylib.mvfbase import MultiVariantFile, fasta_iter, IndexedFasta
 
 
 _LICENSE = """
@@ -38,31 +39,108 @@ You should have received a copy of the GNU General Public License
 along with MVFtools.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+# Ambiguous DNA characters written as 'X' by fasta2mvf
+AMBIG_TO_X = str.maketrans('NXOBDHVnxobdhv', 'X' * 14)
+
+
+# End coordinate of regions without a stop position
+REGION_END = 2 ** 31
+
+
+class RegionIndex(object):
+    """Merged, sorted intervals per contig, tested with a moving cursor
+       so that checking the positions of sorted entries is amortized O(1)
+    Object Structure:
+        regions: list of (contigid, start, stop, strand) as parsed
+        intervals: dict[contigid] = sorted list of [start, stop]
+                   (1-based, inclusive; stop is REGION_END if open)
+        cursor: dict[contigid] = index of the current interval
+    """
+
+    def __init__(self, regions):
+        self.regions = regions
+        self.intervals = {}
+        for contigid, start, stop, _ in regions:
+            self.intervals.setdefault(contigid, []).append(
+                [start or 1, stop or REGION_END])
+        for contigid, intervals in self.intervals.items():
+            intervals.sort()
+            merged = [intervals[0]]
+            for start, stop in intervals[1:]:
+                if start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], stop)
+                else:
+                    merged.append([start, stop])
+            self.intervals[contigid] = merged
+        self.cursor = dict.fromkeys(self.intervals, 0)
+
+    def contains(self, contigid, pos):
+        """Returns True if the position is inside a region
+            Arguments:
+                contigid: contig id
+                pos: position (1-based)
+        """
+        intervals = self.intervals.get(contigid)
+        if intervals is None:
+            return False
+        i = self.cursor[contigid]
+        if i and pos <= intervals[i - 1][1]:
+            # unsorted input, move the cursor back
+            i = max(bisect_right(intervals, [pos, REGION_END]) - 1, 0)
+        while i < len(intervals) - 1 and intervals[i][1] < pos:
+            i += 1
+        self.cursor[contigid] = i
+        return intervals[i][0] <= pos <= intervals[i][1]
+
+
+def get_region_contig(name, contigs, labelids):
+    """Returns the MVF contig id for a region contig id or label
+       ('' if not found)
+        Arguments:
+            name: contig id or label from a region file
+            contigs: MVF contig metadata dict[id] = dict(label, ...)
+            labelids: dict[contig label] = contig id
+    """
+    if name in contigs:
+        return name[:]
+    if is_int(name) and int(name) in contigs:
+        return int(name)
+    return labelids.get(name, '')
+
+
+def format_region_label(contigs, region):
+    """Returns the label of a (contigid, start, stop, strand) region"""
+    (contigid, start, stop, strand) = region
+    return "{}{}{}{}{}".format(
+        contigs[contigid]['label'],
+        "" if (start == -1 or start == 0 or start is None) else (
+            ":{}".format(start)),
+        "" if (stop == -1 or stop == 0 or stop is None) else '..',
+        "" if (stop == -1 or stop == 0 or stop is None) else stop,
+        "" if (stop == -1 or stop == 0 or stop is None) else
+        "({})".format(strand))
+
 
 def parse_regions_arg(regionfilepath, contigs):
-    """Parses the regions into coordinates"""
+    """Parses the regions into coordinates
+       Returns (RegionIndex, region label string)
+        Arguments:
+            regionfilepath: path of a 'contig[,start[,stop]]' file
+                            or None for whole contigs
+            contigs: MVF contig metadata dict[id] = dict(label, ...)
+    """
     fmt_regions = []
-    region_max_coord = {}
     if regionfilepath is None:
         fmt_regions = [(x, None, None, None) for x in contigs]
-        region_max_coord = dict.fromkeys(contigs, None)
     else:
+        labelids = dict((contigs[x]['label'], x) for x in contigs)
         with open(regionfilepath) as regfile:
             for line in regfile:
                 entry = line.rstrip().split(',')
                 if len(entry) > 4 or len(entry) < 1 or len(entry[0]) == 0:
                     print("malformed entry ({}), ignoring...".format(entry))
                     continue
-                contig = ''
-                if entry[0] in contigs:
-                    contig = entry[0][:]
-                elif is_int(entry[0]):
-                    if int(entry[0]) in contigs:
-                        contig = int(entry[0])
-                if contig == '':
-                    for cid in contigs:
-                        if contigs[cid]['label'] == entry[0]:
-                            contig = cid
+                contig = get_region_contig(entry[0], contigs, labelids)
                 assert contig in contigs
                 if len(entry) == 1:
                     fmt_regions.append((contig, None, None, '+'))
@@ -77,23 +155,336 @@ def parse_regions_arg(regionfilepath, contigs):
                         contig, int(entry[1]), int(entry[2]),
                         "+" if int(entry[2]) > int(entry[1]) else "-"))
     fmt_regions.sort()
-    for contigid, _, maxcoord, _ in fmt_regions:
-        if contigid not in region_max_coord:
-            region_max_coord[contigid] = (
-                None if maxcoord is None else maxcoord + 0)
-        elif maxcoord is None:
-            pass
-        elif maxcoord > region_max_coord[contigid]:
-            region_max_coord[contigid] = maxcoord + 0
-    regionlabel = ','.join(["{}{}{}{}{}".format(
-        contigs[x[0]]['label'],
-        "" if (x[1] == -1 or x[1] == 0 or x[1] is None) else (
-            ":{}".format(x[1])),
-        "" if (x[2] == -1 or x[2] == 0 or x[2] is None) else '..',
-        "" if (x[2] == -1 or x[2] == 0 or x[2] is None) else x[2],
-        "" if (x[2] == -1 or x[2] == 0 or x[2] is None) else
-        "({})".format(x[3])) for x in fmt_regions])
-    return fmt_regions, region_max_coord, regionlabel
+    regionlabel = ','.join([format_region_label(contigs, x)
+                            for x in fmt_regions])
+    return RegionIndex(fmt_regions), regionlabel
+
+
+def parse_region_table(tablepath, contigs):
+    """Parses a region table with 'contig,start,stop,outfile' lines
+       (start/stop may be left blank for whole contigs)
+       Returns list of (contigid, start, stop, strand, outfile)
+        Arguments:
+            tablepath: region table file path
+            contigs: MVF contig metadata dict[id] = dict(label, ...)
+    """
+    labelids = dict((contigs[x]['label'], x) for x in contigs)
+    table = []
+    outfiles = set()
+    with open(tablepath) as tablefile:
+        for line in tablefile:
+            if not line.strip() or line.startswith('#'):
+                continue
+            entry = [x.strip() for x in line.rstrip().split(',')]
+            if len(entry) != 4 or not entry[0] or not entry[3]:
+                raise RuntimeError(
+                    "Malformed region table entry '{}'".format(line.rstrip()))
+            contig = get_region_contig(entry[0], contigs, labelids)
+            if contig == '':
+                raise RuntimeError(
+                    "Region contig {} not found in MVF".format(entry[0]))
+            start = int(entry[1]) if entry[1] else None
+            stop = int(entry[2]) if entry[2] else None
+            if (start is not None and start < 1) or (
+                    stop is not None and stop < (start or 1)):
+                raise RuntimeError(
+                    "Invalid region coordinates '{}'".format(line.rstrip()))
+            if entry[3] in outfiles:
+                raise RuntimeError(
+                    "Region output {} is not unique".format(entry[3]))
+            outfiles.add(entry[3])
+            table.append((contig, start, stop, '+', entry[3]))
+    return table
+
+
+def iter_region_entries(mvf, regions, quiet=False):
+    """Iterates decoded MVF entries inside the regions.
+       With a loaded index (and contiguous contigs), seeks to the start
+       of each interval instead of reading the whole file.
+        Arguments:
+            mvf: MultiVariantFile (read mode)
+            regions: RegionIndex
+            quiet: suppress progress meter
+    """
+    if mvf.index is not None and mvf.index.contiguous:
+        for contigid in mvf.index.order:
+            for start, stop in regions.intervals.get(contigid, ()):
+                for entry in mvf.fetch(contigid, start, stop):
+                    yield entry
+        return
+    for entry in mvf.iterentries(contigs=list(regions.intervals),
+                                 quiet=quiet, decode=True):
+        if regions.contains(entry[0], entry[1]):
+            yield entry
+
+
+class SequenceTransposer(object):
+    """Transposes MVF columns into one sequence per sample.
+       Columns are gathered into per-sample bytearrays, which are moved
+       to a single temporary file (one block per sample, in sample
+       order) whenever they exceed the memory budget.
+       Blocks are transposed with NumPy when it is installed and
+       column by column otherwise.
+    Object Structure:
+        nsamples: number of samples
+        width: characters per sample in each column
+        buffers: list of bytearray, one per sample
+        length: number of characters added per sample
+        max_memory: bytes held in buffers before spilling
+        spill: temporary file of spilled blocks (or None)
+        chunks: list of [(offset, size) per sample], one per spill
+    """
+
+    block_size = 65536
+
+    def __init__(self, nsamples, width=1, max_memory=2**30, temp_dir=None):
+        self.nsamples = nsamples
+        self.width = width
+        self.buffers = [bytearray() for _ in range(nsamples)]
+        self.length = 0
+        self.max_memory = max_memory
+        self.temp_dir = temp_dir
+        self.spill = None
+        self.chunks = []
+        self._columns = []
+
+    def add(self, column):
+        """Adds one column (str of nsamples * width characters)"""
+        self._columns.append(column)
+        if len(self._columns) == self.block_size:
+            self._flush()
+        return ''
+
+    def _flush(self):
+        """Transposes pending columns into the sample buffers"""
+        if not self._columns:
+            return ''
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        columns = self._columns
+        self.length += len(columns) * self.width
+        self._columns = []
+        if np is None:
+            width = self.width
+            for i, buff in enumerate(self.buffers):
+                buff += ''.join(
+                    x[i * width:(i + 1) * width]
+                    for x in columns).encode('latin-1')
+        else:
+            block = np.frombuffer(''.join(columns).encode('latin-1'),
+                                  dtype=np.uint8).reshape(
+                                      len(columns), self.nsamples,
+                                      self.width)
+            block = np.ascontiguousarray(block.transpose(1, 0, 2))
+            for i, buff in enumerate(self.buffers):
+                buff += block[i].tobytes()
+        if sum(len(x) for x in self.buffers) > self.max_memory:
+            self._spill()
+        return ''
+
+    def _spill(self):
+        """Moves the sample buffers to the temporary file"""
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(dir=self.temp_dir)
+        chunk = []
+        for buff in self.buffers:
+            chunk.append((self.spill.tell(), len(buff)))
+            self.spill.write(buff)
+            del buff[:]
+        self.chunks.append(chunk)
+        return ''
+
+    def get_length(self):
+        """Returns the sequence length of each sample"""
+        return self.length + len(self._columns) * self.width
+
+    def get_memory(self):
+        """Returns the number of sequence bytes held in memory"""
+        return (sum(len(x) for x in self.buffers) +
+                len(self._columns) * self.nsamples * self.width)
+
+    def spill_buffers(self):
+        """Moves everything held in memory to the temporary file"""
+        self._flush()
+        if any(self.buffers):
+            self._spill()
+        return ''
+
+    def write_sequence(self, filehandler, index):
+        """Writes the full sequence of one sample
+            Arguments:
+                filehandler: binary output file handle
+                index: sample index (0-based, in column order)
+        """
+        self._flush()
+        for chunk in self.chunks:
+            offset, size = chunk[index]
+            self.spill.seek(offset)
+            filehandler.write(self.spill.read(size))
+        filehandler.write(self.buffers[index])
+        return ''
+
+    def write_fasta(self, filehandler, labels):
+        """Writes all sequences as FASTA records
+            Arguments:
+                filehandler: binary output file handle
+                labels: list of record labels, in sample order
+        """
+        for i, label in enumerate(labels):
+            filehandler.write(">{}\n".format(label).encode())
+            self.write_sequence(filehandler, i)
+            filehandler.write(b"\n")
+        return ''
+
+    def write_phylip(self, filehandler, labels, labelwidth=20):
+        """Writes all sequences as a sequential Phylip alignment
+            Arguments:
+                filehandler: binary output file handle
+                labels: list of sample labels, in sample order
+                labelwidth: labels are truncated/padded to this width
+        """
+        filehandler.write("{} {}\n".format(
+            len(labels), self.get_length()).encode())
+        for i, label in enumerate(labels):
+            label = label[:labelwidth]
+            filehandler.write("{}{}".format(
+                label, " " * (labelwidth - len(label))).encode())
+            self.write_sequence(filehandler, i)
+            filehandler.write(b"\n")
+        return ''
+
+    def close(self):
+        """Removes the temporary file"""
+        if self.spill is not None:
+            self.spill.close()
+        return ''
+
+
+def get_column_reader(flavor, output_data, sample_indices):
+    """Returns (function(allelesets) -> output column str, width),
+       width being the characters per sample in each column
+        Arguments:
+            flavor: MVF flavor
+            output_data: dna, rna, prot or None
+            sample_indices: list of sample column indices
+    """
+    if flavor == 'dna':
+        return (lambda allelesets: ''.join(
+            allelesets[0][x] for x in sample_indices).replace('X', 'N'), 1)
+    if (flavor == 'codon' and output_data == 'prot') or flavor == 'prot':
+        return (lambda allelesets: ''.join(
+            allelesets[0][x] for x in sample_indices), 1)
+    if flavor == 'codon':
+        return (lambda allelesets: ''.join(
+            allelesets[1][x] + allelesets[2][x] + allelesets[3][x]
+            for x in sample_indices).replace('X', 'N'), 3)
+    raise RuntimeError("No output available for '{}' flavor MVF".format(
+        flavor))
+
+
+def export_region_table(mvf, args, sample_indices, fileformat):
+    """Writes the alignment of each --region-table region to its own
+       file in one ordered pass over the MVF (seeking through the index
+       when present). Only regions overlapping the current position are
+       held in memory; each file is written as soon as its region closes.
+        Arguments:
+            mvf: MultiVariantFile (read mode)
+            args: mvf2fasta/mvf2phy arguments
+            sample_indices: list of sample column indices
+            fileformat: 'fasta' or 'phylip'
+    """
+    contigs = mvf.metadata['contigs']
+    table = parse_region_table(args.region_table, contigs)
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    sample_labels = [mvf.get_sample_labels(x) for x in sample_indices]
+    get_column, width = get_column_reader(mvf.flavor, args.output_data,
+                                          sample_indices)
+
+    def write_region(region, transposer):
+        """Writes a finished region and releases its buffers"""
+        with open(os.path.join(args.out, region[4]), 'wb') as outfile:
+            if fileformat == 'phylip':
+                transposer.write_phylip(
+                    outfile, sample_labels,
+                    labelwidth=(100 if args.label_type == 'long' else 20))
+            elif args.label_type == 'long':
+                regionlabel = format_region_label(contigs, region[:4])
+                transposer.write_fasta(outfile, [
+                    "{} region={}".format(x, regionlabel)
+                    for x in sample_labels])
+            else:
+                transposer.write_fasta(outfile, sample_labels)
+        transposer.close()
+        return ''
+
+    max_memory = args.max_memory * 2**20
+
+    def new_transposer():
+        """Returns an empty transposer for one region"""
+        return SequenceTransposer(
+            len(sample_indices), width=width,
+            max_memory=max_memory, temp_dir=args.temp_dir)
+
+    def check_memory():
+        """Spills the largest open regions while all open regions
+           together exceed the --max-memory budget
+           Returns the bytes still held by the open regions"""
+        sizes = [[x[1].get_memory(), x[1]] for x in opened]
+        total = sum(x[0] for x in sizes)
+        while total > max_memory:
+            largest = max(sizes, key=lambda x: x[0])
+            largest[1].spill_buffers()
+            total -= largest[0]
+            largest[0] = 0
+        return total
+
+    # Regions not yet opened, per contig, latest start first
+    pending = {}
+    for region in sorted(table, key=lambda x: -(x[1] or 1)):
+        pending.setdefault(region[0], []).append(region)
+    current_contig = None
+    waiting = []
+    opened = []
+    # bytes held by the open regions, grows by one column per region
+    # for every added column and is recounted when it passes the budget
+    memory = 0
+    for contig, pos, allelesets in iter_region_entries(
+            mvf, RegionIndex([x[:4] for x in table]), quiet=args.quiet):
+        if contig != current_contig:
+            for region, transposer in opened:
+                write_region(region, transposer)
+            for region in waiting:
+                write_region(region, new_transposer())
+            opened = []
+            memory = 0
+            current_contig = contig
+            waiting = pending.pop(contig, [])
+        if opened and any((x[0][2] or REGION_END) < pos for x in opened):
+            for region, transposer in opened:
+                if (region[2] or REGION_END) < pos:
+                    write_region(region, transposer)
+            opened = [x for x in opened if (x[0][2] or REGION_END) >= pos]
+        while waiting and (waiting[-1][1] or 1) <= pos:
+            region = waiting.pop()
+            if (region[2] or REGION_END) < pos:
+                write_region(region, new_transposer())
+            else:
+                opened.append((region, new_transposer()))
+        if opened:
+            column = get_column(allelesets)
+            for _, transposer in opened:
+                transposer.add(column)
+            memory += len(column) * len(opened)
+            if memory > max_memory:
+                memory = check_memory()
+    for region, transposer in opened:
+        write_region(region, transposer)
+    for region in waiting + [x for y in pending.values() for x in y]:
+        write_region(region, new_transposer())
+    return ''
 
 
 def mvf2fasta(args):
@@ -104,8 +495,6 @@ def mvf2fasta(args):
         raise RuntimeError(
             "--output-data {} incompatiable with '{}' flavor mvf".format(
                 args.output_data, mvf.flavor))
-    regions, max_region_coord, regionlabel = parse_regions_arg(
-        args.regions, mvf.metadata['contigs'])
     sample_labels = mvf.get_sample_labels()
     if args.sample_indices is not None:
         sample_indices = [int(x) for x in
@@ -115,62 +504,69 @@ def mvf2fasta(args):
             labels=args.sample_labels[0].split(","))
     else:
         sample_indices = mvf.get_sample_indices()
-    skipcontig = ''
-    tmp_files = dict((fn, open("{}-{}.tmp".format(
-        fn, randint(1000000, 9999999)), 'w+', args.buffer))
-        for fn in sample_labels)
-    labelwritten = dict.fromkeys(sample_labels, False)
-    for contig, pos, allelesets in mvf.iterentries(
-            contigs=[x for x in max_region_coord],
-            quiet=args.quiet, decode=True):
-        if contig == skipcontig:
-            continue
-        if (contig not in max_region_coord) or (
-                max_region_coord[contig] is not None and
-                pos > max_region_coord[contig]):
-            skipcontig = contig[:]
-            continue
-        inregion = False
-        for rcontig, rstart, rstop, _ in regions:
-            if contig == rcontig:
-                if rstart is None or pos >= rstart:
-                    if rstop is None or pos <= rstop:
-                        inregion = True
-                        break
-        if inregion is False:
-            continue
-        for col, label in zip(sample_indices, sample_labels):
-            if not labelwritten[label]:
-                if args.label_type == 'long':
-                    xlabel = "{} region={}".format(label, regionlabel)
-                elif args.label_type == 'short':
-                    xlabel = "{}".format(label)
-                tmp_files[label].write(">{}\n".format(xlabel))
-                labelwritten[label] = True
-            if mvf.flavor == 'dna':
-                tmp_files[label].write(
-                    "N" if allelesets[0][col] == 'X'
-                    else allelesets[0][col])
-            elif mvf.flavor in ('codon', 'prot') and (
-                    args.output_data == 'prot'):
-                tmp_files[label].write(allelesets[0][col])
-            elif mvf.flavor == 'codon' and args.output_data == 'dna':
-                codon = ["N" if allelesets[x][col] == 'X' else
-                         allelesets[x][col] for x in (1, 2, 3)]
-                tmp_files[label].write(''.join(codon))
-    with open(args.out, 'w') as outfile:
-        for filehandler in tmp_files.values():
-            filehandler.seek(0, 0)
-            buff = filehandler.read(args.buffer)
-            while len(buff):
-                outfile.write(buff)
-                buff = filehandler.read(args.buffer)
-            outfile.write("\n")
-            filehandler.close()
-            os.remove(os.path.join(args.temp_dir, filehandler.name))
+    if args.region_table is not None:
+        return export_region_table(mvf, args, sample_indices, 'fasta')
+    regions, regionlabel = parse_regions_arg(
+        args.regions, mvf.metadata['contigs'])
+    get_column, width = get_column_reader(mvf.flavor, args.output_data,
+                                          sample_indices)
+    transposer = SequenceTransposer(
+        len(sample_indices), width=width,
+        max_memory=args.max_memory * 2**20, temp_dir=args.temp_dir)
+    for _, _, allelesets in iter_region_entries(mvf, regions,
+                                                quiet=args.quiet):
+        transposer.add(get_column(allelesets))
+    if args.label_type == 'long':
+        labels = ["{} region={}".format(sample_labels[x], regionlabel)
+                  for x in sample_indices]
+    else:
+        labels = [sample_labels[x] for x in sample_indices]
+    with open(args.out, 'wb') as outfile:
+        transposer.write_fasta(outfile, labels)
+    transposer.close()
     return ''
 
 
+def fasta_slice(entry, start, end):
+    """Returns positions [start, end) (0-based) of a FASTA sequence,
+       padded with gaps past its end or when the sample is absent
+        Arguments:
+            entry: (length, sequence) or (length, (IndexedFasta, name))
+                   or None
+            start: first position (0-based)
+            end: position after the last (0-based)
+    """
+    if entry is None or start >= entry[0]:
+        return '-' * (end - start)
+    if isinstance(entry[1], str):
+        seq = entry[1][start:end]
+    else:
+        seq = entry[1][0].fetch(entry[1][1], start + 1, end)
+    return seq + '-' * (end - start - len(seq))
+
+
+def iter_fasta_records(fastapath, stream=False):
+    """Iterates (header, length, sequence) for a FASTA file
+        Arguments:
+            fastapath: FASTA file path
+            stream: leave sequences on disk, returning (IndexedFasta, name)
+                    in place of the sequence; the .fai index is written
+                    if it was missing and the directory is writable
+    """
+    if not stream:
+        for header, seq in fasta_iter(fastapath):
+            yield header, len(seq), seq
+        return
+    fasta = IndexedFasta(fastapath)
+    if fasta.scanned:
+        try:
+            fasta.write_index()
+        except (IOError, OSError):
+            pass
+    for name in fasta.names:
+        yield fasta.header(name), fasta.entries[name][0], (fasta, name)
+
+
 def fasta2mvf(args):
     """Main method"""
     sepchars = dict([("PIPE", "\\|"), ("TAB", "\\t"),
@@ -188,14 +584,20 @@ def fasta2mvf(args):
             (x.split(':')[0], int(x.split(":")[1].split('..')[0]),
              int(x.split(':')[1].split('..')[1]))
             for x in args.manual_coord]
-    mvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite)
+    mvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite,
+                           bgzf=args.bgzf,
+                           compresslevel=args.compress_level)
     fasta = {}
     current_contig = 0
     fsamples = []
     fcontigs = []
+    indexed = []
     for ifasta, fastapath in enumerate(args.fasta):
         print("Processing {}".format(fastapath))
-        for header, seq in fasta_iter(fastapath):
+        for header, seqlen, seq in iter_fasta_records(
+                fastapath, stream=args.stream):
+            if args.stream and seq[0] not in indexed:
+                indexed.append(seq[0])
             if args.field_sep is None:
                 header = header[:]
             if args.field_sep != '' and args.field_sep is not None:
@@ -225,7 +627,7 @@ def fasta2mvf(args):
                 fasta[contig] = {}
             if sample not in fsamples:
                 fsamples.append(sample)
-            fasta[contig][sample] = (len(seq), seq)
+            fasta[contig][sample] = (seqlen, seq)
     reflabel = None
     if args.ref_label:
         for i, samplename in enumerate(fsamples):
@@ -251,26 +653,30 @@ def fasta2mvf(args):
     nentry = 0
     mvf_alleles = {}
     for cind, contig in enumerate(fcontigs):
-        for pos in range(mvf.metadata['contigs'][cind]['length']):
-            mvf_alleles = encode_mvfstring(
-                ''.join(samp not in fasta[contig] and '-' or
-                        pos >= fasta[contig][samp][0] and '-' or
-                        fasta[contig][samp][1][pos]
-                        for samp in fsamples))
-            if mvf_alleles:
-                if args.flavor == 'dna':
-                    mvf_alleles = ''.join(["X" if x in 'NXOBDHVnxobdhv' else x
-                                           for x in mvf_alleles])
-                mvfentries.append(
-                    (cind, pos+1, (mvf_alleles,)))
-                nentry += 1
-                if nentry == args.write_buffer:
-                    mvf.write_entries(mvfentries, encoded=True)
-                    mvfentries = []
-                    nentry = 0
+        contiglen = mvf.metadata['contigs'][cind]['length']
+        # Read aligned slices of every sample, --chunk-size columns at once
+        for start in range(0, contiglen, args.chunk_size):
+            end = min(start + args.chunk_size, contiglen)
+            slices = [fasta_slice(fasta[contig].get(samp), start, end)
+                      for samp in fsamples]
+            for offset, mvf_alleles in enumerate(
+                    encode_mvfstring_block(slices)):
+                if mvf_alleles:
+                    if args.flavor == 'dna':
+                        mvf_alleles = mvf_alleles.translate(AMBIG_TO_X)
+                    mvfentries.append(
+                        (cind, start + offset + 1, (mvf_alleles,)))
+                    nentry += 1
+                    if nentry == args.write_buffer:
+                        mvf.write_entries(mvfentries, encoded=True)
+                        mvfentries = []
+                        nentry = 0
     if mvfentries:
         mvf.write_entries(mvfentries)
         mvfentries = []
+    mvf.close()
+    for fasta_index in indexed:
+        fasta_index.close()
     return ''
 
 
@@ -282,10 +688,6 @@ def mvf2phy(args):
         raise RuntimeError(
             "--outdput-data {} incompatiable with '{}' flavor mvf".format(
                 args.output_data, mvf.flavor))
-    max_region_coord = dict.fromkeys(mvf.metadata['contigs'], None)
-    if args.region is not None:
-        _, max_region_coord, _ = parse_regions_arg(
-            args.region, mvf.metadata['contigs'])
     sample_labels = mvf.get_sample_labels()
     if args.sample_indices is not None:
         sample_indices = [int(x) for x in
@@ -295,26 +697,25 @@ def mvf2phy(args):
             labels=args.sample_labels[0].split(","))
     else:
         sample_indices = mvf.get_sample_indices()
-    skipcontig = ''
-    tmp_files = dict((fn, open("{}-{}.tmp".format(
-        fn, randint(1000000, 9999999)), 'w+', args.buffer))
-        for fn in sample_labels)
-    labelwritten = dict.fromkeys(sample_labels, False)
+    if args.region_table is not None:
+        if args.partition is True:
+            raise RuntimeError(
+                "--partition cannot be used with --region-table")
+        return export_region_table(mvf, args, sample_indices, 'phylip')
+    regions, _ = parse_regions_arg(args.regions, mvf.metadata['contigs'])
+    get_column, width = get_column_reader(mvf.flavor, args.output_data,
+                                          sample_indices)
+    transposer = SequenceTransposer(
+        len(sample_indices), width=width,
+        max_memory=args.max_memory * 2**20, temp_dir=args.temp_dir)
     curcontigname = None
     curcontigstart = 1
     curcontigend = 1
     if args.partition is True:
         partprefix = "PROT" if args.output_data == "prot" else "DNA"
         partitionfile = open("{}.part".format(args.out), 'w')
-    for contig, _, allelesets in mvf.iterentries(
-            contigs=(mvf.metadata['contigs'] if args.region is None else
-                     [x for x in max_region_coord]),
-            quiet=args.quiet, decode=True):
-        if contig == skipcontig:
-            continue
-        if contig not in max_region_coord:
-            skipcontig = contig[:]
-            continue
+    for contig, _, allelesets in iter_region_entries(mvf, regions,
+                                                     quiet=args.quiet):
         if curcontigname is None:
             curcontigname = contig[:]
         elif contig != curcontigname:
@@ -325,67 +726,18 @@ def mvf2phy(args):
                             ids=curcontigname),
                         curcontigstart, curcontigend - 1))
             curcontigname = contig[:]
-            # reset start as one position after end of last
+            # the next contig starts one position after end of last
             curcontigstart = curcontigend
-            curcontigend = curcontigend + 1
-        for col, label in zip(sample_indices, sample_labels):
-            if not labelwritten[label]:
-                if args.label_type == 'long':
-                    tmp_files[label].write("{}{}".format(
-                        label[:100], " "*(100 - len(label[:100]))))
-                elif args.label_type == 'short':
-                    tmp_files[label].write("{}{}".format(
-                        label[:20], " "*(20 - len(label[:20]))))
-                labelwritten[label] = True
-            if mvf.flavor == 'dna':
-                tmp_files[label].write(
-                    allelesets[0][col] == 'X' and
-                    'N' or allelesets[0][col])
-                if label == sample_labels[0]:
-                    curcontigend += 1
-            elif ((mvf.flavor == 'codon' and args.output_data == 'prot') or (
-                    mvf.flavor == 'prot')):
-                tmp_files[label].write(allelesets[0][col])
-                if label == sample_labels[0]:
-                    curcontigend += 1
-            elif mvf.flavor == 'codon':
-                codon = ["N" if allelesets[x][col] == 'X' else
-                         allelesets[x][col] for x in (1, 2, 3)]
-                tmp_files[label].write(''.join(codon))
-                if label == sample_labels[0]:
-                    curcontigend += 3
-    first_file = True
-    totalseqlen = 0
-    with open(args.out, 'w') as outfile:
-        for filehandler in tmp_files.values():
-            # read first file to establish sequence length for phylip header
-            if first_file is True:
-                filehandler.seek(0, 0)
-                buff = filehandler.read(args.buffer)
-                while buff != '':
-                    if " " in buff:
-                        totalseqlen += len(buff.strip().split(" ")[-1])
-                    else:
-                        totalseqlen += len(buff.strip())
-                    buff = filehandler.read(args.buffer)
-                outfile.write("{} {}\n".format(
-                    len(sample_labels), totalseqlen))
-                first_file = False
-            filehandler.seek(0, 0)
-            buff = filehandler.read(args.buffer)
-            while buff != '':
-                if first_file is True:
-                    outfile.write("{} {}\n".format(
-                        len(sample_labels), len(buff.split()[1])))
-                    first_file = False
-                outfile.write(buff)
-                buff = filehandler.read(args.buffer)
-            outfile.write("\n")
-            filehandler.close()
-            os.remove(os.path.join(args.temp_dir, filehandler.name))
+        transposer.add(get_column(allelesets))
+        curcontigend += width
+    with open(args.out, 'wb') as outfile:
+        transposer.write_phylip(
+            outfile, [sample_labels[x] for x in sample_indices],
+            labelwidth=(100 if args.label_type == 'long' else 20))
+    transposer.close()
     if args.partition is True:
         if curcontigend > curcontigstart:
-            partitionfile.write("{},{},{},{}\n".format(
+            partitionfile.write("{}, {} = {}-{}\n".format(
                 partprefix, mvf.get_contig_labels(ids=curcontigname),
                 curcontigstart, curcontigend - 1))
         partitionfile.close()
@@ -685,7 +685,9 @@ def filter_mvf(args):
         sys.exit()
     # MAIN MODE
     # Set up file handler
-    outmvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite)
+    outmvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite,
+                              bgzf=args.bgzf,
+                              compresslevel=args.compress_level)
     outmvf.metadata = deepcopy(mvf.metadata)
     # reprocess header if actions are used that filter columns
     if any(x == y[0] for x in ('columns', 'collapsepriority', 'collapsemerge')
@@ -761,4 +763,5 @@ def filter_mvf(args):
     if linebuffer:
         outmvf.write_entries(linebuffer)
         linebuffer = []
+    outmvf.close()
     return ''
@@ -350,8 +350,8 @@ def calc_group_unique_allele_window(args):
         for k in data
         if data[k].get('nonsynonymous_changes', 0) > 0],
                             reverse=True)
-    for _, k in sorted_entries:
-        outfile.write_entry(data[k])
+    outfile.write_entries([data[k] for _, k in sorted_entries])
+    outfile.close()
     with open(args.out + '.total', 'w') as totalfile:
         for entry in args.totals.iter_sorted():
             totalfile.write(entry)
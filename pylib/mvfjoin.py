@@ -55,13 +55,15 @@ class MvfTransformer(object):
     def set_contig(self, localid, consensusid):
         """Set contigid transform
         """
-        self.contigs[consensusid] = localid
+        self.contigs[localid] = consensusid
         return ''
 
 
 def mvf_join(args):
     """Main method"""
-    concatmvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite)
+    concatmvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite,
+                                 bgzf=args.bgzf,
+                                 compresslevel=args.compress_level)
     # Copy the first file's metadata
     if args.main_header_file:
         if args.main_header_file not in args.mvf:
@@ -89,18 +91,11 @@ def mvf_join(args):
                 transformer.set_label(
                     i, concatmvf.metadata['labels'].index(label))
         for contigid, contigdata in iter(mvf.metadata['contigs'].items()):
-            if contigdata['label'] not in [
-                    concatmvf.metadata['contigs'][x]['label']
-                    for x in concatmvf.metadata['contigs']]:
+            newid = concatmvf.get_contig_id(contigdata['label'])
+            if newid is None:
                 newid = (contigid not in concatmvf.metadata['contigs'] and
                          contigid or concatmvf.get_next_contig_id())
-                concatmvf.metadata['contigs'][newid] = contigdata
-            else:
-                for concatid, concatdata in (
-                        concatmvf.metadata['contigs'].items()):
-                    if contigdata['label'] == concatdata['label']:
-                        newid = concatid
-                        break
+                concatmvf.add_contig(newid, contigdata)
             if newid != contigid:
                 transformer.set_contig(contigid, newid)
         transformers.append(transformer)
@@ -124,9 +119,7 @@ def mvf_join(args):
                         alleles[transformer.labels[x]] or alleles[x]
                         for x in range(len(alleles))]))
             if transformer.contigs:
-                contigid = (contigid in transformer['contigs'] and
-                            transformer['contigs'][contigid] or
-                            contigid)
+                contigid = transformer.contigs.get(contigid, contigid)
             entries.append((contigid, pos, allelesets))
             nentries += 1
             if nentries == args.line_buffer:
@@ -139,4 +132,5 @@ def mvf_join(args):
             nentries = 0
         if not args.quiet:
             sys.stderr.write("done\n")
+    concatmvf.close()
     return ''
@@ -38,7 +38,7 @@ along with MVFtools.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import gzip
 import re
-from pylib.mvfbase import encode_mvfstring, MultiVariantFile
+from pylib.mvfbase import encode_mvfstring_block, MultiVariantFile
 
 
 RE_CONTIG_NAME = re.compile("ID=(.*?),")
@@ -65,7 +65,7 @@ class MultiAlignFile(object):
         self.entrystart = 0
         # Check for Gzip and establish file object
         self.metadata['isgzip'] = (self.path.endswith(".gz") or
-                                   args.get('isgzip', False))
+                                   getattr(args, 'isgzip', False))
         # READ MODE
         filehandler = (self.metadata['isgzip'] and
                        gzip.open(self.path, 'rt') or open(self.path, 'rt'))
@@ -75,7 +75,7 @@ class MultiAlignFile(object):
             line = filehandler.readline()
         if line[0] == 'a':
             line = filehandler.readline()
-            while line.strip != '' and line[0] != 'a':
+            while line.strip() != '' and line[0] != 'a':
                 if line[0] == 's':
                     label = line[1:].strip().split()[0]
                     label = label.split('.')[0]
@@ -99,7 +99,7 @@ class MultiAlignFile(object):
                 block = {}
                 block_length = -1
                 line = filehandler.readline()
-                while line.strip != '' and line[0] != 'a':
+                while line.strip() != '' and line[0] != 'a':
                     if line[0] == 's':
                         (label, start, length,
                          _, _, seq) = (
@@ -131,7 +131,9 @@ def maf2mvf(args):
     # ESTABLISH MAF
     maf = MultiAlignFile(args)
     # ESTABLISH MVF
-    mvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite)
+    mvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite,
+                           bgzf=args.bgzf,
+                           compresslevel=args.compress_level)
     # PROCESS SAMPLE INFO
     contig_translate = {1: 1}
     samplelabels = [s.split(':')[0] for s in args.sample_tags]
@@ -151,9 +153,8 @@ def maf2mvf(args):
             if sname not in msa:
                 msa[sname] = '-'*length
         msa['contig'] = 1
-        for i in range(length):
-            mvf_alleles = encode_mvfstring(
-                ''.join(msa[s][i].strip() for s in samplelabels))
+        for i, mvf_alleles in enumerate(encode_mvfstring_block(
+                [msa[s][:length] for s in samplelabels])):
             if mvf_alleles:
                 mvfentries.append(
                     (contig_translate.get(msa['contig']),
@@ -165,4 +166,5 @@ def maf2mvf(args):
                     nentry = 0
     if mvfentries:
         mvf.write_entries(mvfentries)
+    mvf.close()
     return ''
@@ -232,7 +232,9 @@ def annotate_mvf(args):
     gff, geneids = parse_gff_annotate(args.gff, mvf.metadata['contigs'])
     if args.quiet is False:
         print("gff_processed")
-    outmvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite)
+    outmvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite,
+                              bgzf=args.bgzf,
+                              compresslevel=args.compress_level)
     outmvf.metadata = deepcopy(mvf.metadata)
     if args.nongenic_mode is False:
         outmvf.metadata['contigs'] = geneids
@@ -268,6 +270,7 @@ def annotate_mvf(args):
         outmvf.write_entries(entrybuffer)
         entrybuffer = []
         nentry = 0
+    outmvf.close()
     return ''
 
 
@@ -280,7 +283,9 @@ def translate_mvf(args):
         gff = parse_gff_translate(args.gff, args)
         if not args.quiet:
             print("gff_processed")
-    outmvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite)
+    outmvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite,
+                              bgzf=args.bgzf,
+                              compresslevel=args.compress_level)
     outmvf.metadata = deepcopy(mvf.metadata)
     outmvf.flavor = args.output_data
     outmvf.write_data(outmvf.get_header())
@@ -385,4 +390,5 @@ def translate_mvf(args):
         outmvf.write_entries(entrybuffer)
         entrybuffer = []
         nentry = 0
+    outmvf.close()
     return ''
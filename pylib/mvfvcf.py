@@ -28,10 +28,22 @@ along with MVFtools.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import sys
 import gzip
+import argparse
 import re
+import struct
+import tempfile
+from bisect import bisect_right
+from heapq import heappop, heappush
+from itertools import count
+from collections import deque
+from functools import lru_cache
 from math import log10
+from multiprocessing import Pool
 from pylib.mvfbase import encode_mvfstring, MultiVariantFile, is_int
+from pylib.mvfbase import IndexedFasta
+from pylib.mvfbgzf import BgzfReader, is_bgzf
 from pylib.mvfbiolib import MvfBioLib
 
 MLIB = MvfBioLib()
@@ -39,6 +51,351 @@ MLIB = MvfBioLib()
 RE_CONTIG_NAME = re.compile("ID=(.*?),")
 RE_CONTIG_LENGTH = re.compile("length=(.*?)>")
 
+# Sample FORMAT fields used for genotype calling (order of the index plan)
+FORMAT_FIELDS = ('GT', 'DP', 'PL', 'GL', 'GQ', 'GP')
+# Maximum number of distinct sample calls memoized per VCF file
+CALL_CACHE_SIZE = 2 ** 16
+# gVCF symbolic ALT alleles and the INFO reference block END tag
+GVCF_SYMBOLIC = ('<NON_REF>', '<*>')
+RE_END = re.compile(r"(?:^|;)END=(\d+)")
+# Placeholders for the reference base in expanded gVCF block columns
+REF_UPPER = '\x00'
+REF_LOWER = '\x01'
+# --regions entries as CONTIG:START[-END]
+RE_REGION = re.compile(r"^(.+):(\d+)(?:-(\d+))?$")
+REGION_END = 2 ** 31
+
+WORKER_VCF = {}
+
+
+def init_vcf_worker(path, kwargs):
+    """Reads the VCF header once in each worker process"""
+    WORKER_VCF['vcf'] = VariantCallFile(path, indexcontigs=False,
+                                        readindex=False)
+    WORKER_VCF['kwargs'] = kwargs
+    return ''
+
+
+def parse_vcf_lines(lines):
+    """Parses a buffer of VCF lines in a worker process
+       Returns (list of records without per-sample fields,
+                (call cache hits, misses) for this buffer)
+    """
+    vcf = WORKER_VCF['vcf']
+    (hits, misses) = vcf.get_call_cache_stats()
+    records = []
+    for line in lines:
+        vcfrecord = vcf._parse_entry(line, **WORKER_VCF['kwargs'])
+        if vcfrecord == -1:
+            continue
+        del vcfrecord['samples']
+        records.append(vcfrecord)
+    info = vcf.get_call_cache_stats()
+    return (records, (info[0] - hits, info[1] - misses))
+
+
+def call_genotype(genotype, first, gtfirst, depth, plstr, glstr, gqstr,
+                  nogp, alleles, thresholds):
+    """Determine the allele and quality for one VCF sample
+        Arguments:
+            genotype, depth, plstr, glstr, gqstr: GT/DP/PL/GL/GQ field
+                strings (-1 if absent)
+            first: first sample field string
+            gtfirst: True if GT is the first FORMAT field
+            nogp: True if the GP field is absent or '.'
+            alleles: string of REF and ALT bases
+            thresholds: (mask_depth, mask_qual, low_qual, low_depth)
+        Returns (allele, quality, depth)
+    """
+    (mask_depth, mask_qual, low_qual, low_depth) = thresholds
+    if genotype != -1 and '|' in genotype:
+        genotype = genotype.replace('|', '/')
+        if gtfirst:
+            first = genotype
+    if first in ('./.', '.'):
+        return ('-', 0, 0)
+    try:
+        sample_depth = int(depth)
+        if sample_depth == 0:
+            return ('-', 0, 0)
+    except Exception as exception:
+        sample_depth = -1
+    # Fixed sites
+    if nogp and all(x in (-1, '.') for x in (plstr, glstr, gqstr)):
+        quality = -1
+        allele = genotype if genotype != -1 else 'X'
+        if '/' in allele:
+            allele = [int(x) for x in allele.split('/')]
+            allele = MLIB.joinbases[''.join([alleles[x] for x in allele])]
+        else:
+            allele = 'X'
+    # Low coverage
+    elif -1 < sample_depth < mask_depth:
+        quality = -1
+        allele = 'X'
+    # Invariant sites
+    elif len(alleles) == 1:
+        allele = alleles[0]
+        quality = -1 if gqstr == -1 else int(gqstr)
+    # Variant site
+    elif plstr in (-1, '.') and genotype in ('0/0', '1/1'):
+        allele = (alleles[0] if genotype == '0/0' else alleles[1])
+        quality = gqstr
+    elif len(alleles) <= 4:
+        if plstr == -1 and glstr != -1:
+            plvalues = [float(x) if x != '.' else -1
+                        for x in glstr.split(',')]
+        else:
+            plvalues = [float(x) if x != '.' else -1
+                        for x in plstr.split(',')]
+        if all(0 <= x <= 1 for x in plvalues) and sum([
+                x for x in plvalues]) == 1:
+            plvalues = [x == 0 and 1 or x != 1 and
+                        int(-10 * log10(x)) or 0 for x in plvalues]
+        maxpl = max(plvalues) if 0 not in plvalues else 0
+        imaxpl = (-1 if plvalues.count(maxpl) != 1 else
+                  plvalues.index(maxpl))
+        allele = ('X' if imaxpl == -1 else
+                  MLIB.joinbases[''.join(
+                      [alleles[x] for x in MLIB.vcf_gtcodes[imaxpl]])])
+        quality = gqstr
+    # Fail-safe check (you should never see a ! in the MVF)
+    else:
+        allele = '!'
+        quality = -1
+    quality = int(float(quality)) if quality != '.' else 60
+    if -1 < quality < mask_qual:
+        return ('X', quality, sample_depth)
+    elif (-1 < quality < low_qual or
+          (-1 < sample_depth < low_depth)):
+        allele = allele.lower()
+    if allele in 'NnBbDdHhVvXx':
+        allele = 'X'
+    return (allele, quality, sample_depth)
+
+
+class VcfTabixIndex(object):
+    """Tabix (.tbi) or CSI (.csi) index of a bgzipped VCF file
+    Object Structure:
+        path: index file path
+        kind: 'tbi' or 'csi'
+        min_shift: bit size of the smallest bins (14 for .tbi)
+        depth: number of bin levels below the root (5 for .tbi)
+        names: list of contig names in index order
+        bins: list (per contig) of dict[bin] = list of (start, end) chunk
+              virtual offsets
+        linear: list (per contig) of minimum virtual offsets for each
+                16 kb window (.tbi only)
+    """
+
+    def __init__(self, path, names_only=False):
+        self.path = path
+        self.kind = 'csi' if path.endswith('.csi') else 'tbi'
+        self.min_shift = 14
+        self.depth = 5
+        self.names = []
+        self.bins = []
+        self.linear = []
+        with gzip.open(path, 'rb') as indexfile:
+            magic = indexfile.read(4)
+            if magic not in (b'TBI\1', b'CSI\1'):
+                raise RuntimeError("{} is not a tabix or CSI index".format(
+                    path))
+            if self.kind == 'tbi':
+                (nref, ) = struct.unpack('<i', indexfile.read(4))
+            else:
+                (self.min_shift, self.depth, l_aux) = struct.unpack(
+                    '<3i', indexfile.read(12))
+                if l_aux < 28:
+                    raise RuntimeError("{} has no contig names".format(path))
+            (l_nm, ) = struct.unpack('<24xi', indexfile.read(28))
+            self.names = [x.decode() for x in
+                          indexfile.read(l_nm).split(b'\0') if x]
+            if names_only:
+                return
+            if self.kind == 'csi':
+                indexfile.read(l_aux - 28 - l_nm)
+                (nref, ) = struct.unpack('<i', indexfile.read(4))
+            data = indexfile.read()
+        j = 0
+        pseudobin = ((1 << (self.depth * 3 + 3)) - 1) // 7 + 1
+        for _ in range(nref):
+            bins = {}
+            (nbin, ) = struct.unpack_from('<i', data, j)
+            j += 4
+            for _ in range(nbin):
+                (binid, ) = struct.unpack_from('<I', data, j)
+                j += 4 if self.kind == 'tbi' else 12
+                (nchunk, ) = struct.unpack_from('<i', data, j)
+                j += 4
+                chunks = struct.unpack_from('<{}Q'.format(nchunk * 2),
+                                            data, j)
+                j += 16 * nchunk
+                if binid != pseudobin:
+                    bins[binid] = list(zip(chunks[0::2], chunks[1::2]))
+            self.bins.append(bins)
+            if self.kind == 'tbi':
+                (nintv, ) = struct.unpack_from('<i', data, j)
+                j += 4
+                self.linear.append(struct.unpack_from(
+                    '<{}Q'.format(nintv), data, j))
+                j += 8 * nintv
+
+    @classmethod
+    def find(cls, vcfpath, names_only=False):
+        """Returns the index for vcfpath (.tbi preferred over .csi)
+           or None if there is no index newer than the VCF
+        """
+        for ext in ('.tbi', '.csi'):
+            indexpath = vcfpath + ext
+            if not os.path.exists(indexpath) or (
+                    os.path.getmtime(indexpath) < os.path.getmtime(vcfpath)):
+                continue
+            try:
+                return cls(indexpath, names_only=names_only)
+            except RuntimeError:
+                continue
+        return None
+
+    def reg2bins(self, beg, end):
+        """Returns the bins overlapping the 0-based region [beg, end)"""
+        bins = []
+        end -= 1
+        shift = self.min_shift + self.depth * 3
+        offset = 0
+        for level in range(self.depth + 1):
+            bins.extend(range(offset + (beg >> shift),
+                              offset + (end >> shift) + 1))
+            offset += 1 << (level * 3)
+            shift -= 3
+        return bins
+
+    def query(self, name, start, end):
+        """Returns the merged (start, end) virtual offset chunks that
+           may contain records in a contig region
+            Arguments:
+                name: contig name
+                start, end: 1-based inclusive region coordinates
+        """
+        if name not in self.names:
+            return []
+        rid = self.names.index(name)
+        maxcoord = 1 << (self.min_shift + self.depth * 3)
+        beg = max(start - 1, 0)
+        end = min(end, maxcoord)
+        if beg >= end:
+            return []
+        minoffset = 0
+        if self.kind == 'tbi' and beg >> 14 < len(self.linear[rid]):
+            minoffset = self.linear[rid][beg >> 14]
+        chunks = sorted(chunk for binid in self.reg2bins(beg, end)
+                        for chunk in self.bins[rid].get(binid, [])
+                        if chunk[1] > minoffset)
+        merged = []
+        for chunk in chunks:
+            if merged and chunk[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk[1])
+            else:
+                merged.append([max(chunk[0], minoffset), chunk[1]])
+        return merged
+
+
+def read_index_contigs(path):
+    """Reads the contig names from a tabix (.tbi) or CSI (.csi) index
+        Arguments:
+            path: VCF file path (index is path + '.tbi' or '.csi')
+        Returns list of contig names (empty if no usable index is found)
+    """
+    index = VcfTabixIndex.find(path, names_only=True)
+    return index.names if index is not None else []
+
+
+def parse_vcf_regions(items):
+    """Parses region arguments into merged intervals
+        Arguments:
+            items: list of 'CONTIG' or 'CONTIG:START-END' strings
+                   (1-based, inclusive) or paths to BED files
+        Returns dict[contig] = sorted list of [start, end]
+                (1-based, inclusive; end is REGION_END for whole contigs)
+    """
+    intervals = {}
+    for item in items:
+        if os.path.isfile(item):
+            with open(item, 'rt') as bedfile:
+                for line in bedfile:
+                    arr = line.split()
+                    if not arr or arr[0] in ('track', 'browser') or (
+                            arr[0].startswith('#')):
+                        continue
+                    intervals.setdefault(arr[0], []).append(
+                        [int(arr[1]) + 1, int(arr[2])])
+            continue
+        match = RE_REGION.match(item.replace(',', ''))
+        if match is None:
+            intervals.setdefault(item, []).append([1, REGION_END])
+            continue
+        (contig, start, end) = match.groups()
+        intervals.setdefault(contig, []).append(
+            [int(start), int(end) if end else REGION_END])
+    for contig in intervals:
+        merged = []
+        for start, end in sorted(intervals[contig]):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        intervals[contig] = merged
+    return intervals
+
+
+def clip_to_regions(intervals, start, end):
+    """Returns the parts of [start, end] inside the region intervals
+        Arguments:
+            intervals: sorted list of [start, end] from parse_vcf_regions
+            start, end: 1-based inclusive coordinates
+        Returns list of (start, end) tuples
+    """
+    j = max(bisect_right(intervals, [start, REGION_END]) - 1, 0)
+    clipped = []
+    for rstart, rend in intervals[j:]:
+        if rstart > end:
+            break
+        if rend >= start:
+            clipped.append((max(start, rstart), min(end, rend)))
+    return clipped
+
+
+def check_region_contigs(regions, labels, quiet=False):
+    """Warns for each --regions contig that is not a VCF contig
+        Arguments:
+            regions: dict[contig] = list of [start, end] from
+                     parse_vcf_regions
+            labels: collection of VCF contig labels
+            quiet: suppress warnings
+    """
+    if quiet:
+        return ''
+    for contig in regions:
+        if contig not in labels:
+            sys.stderr.write(
+                "--regions contig {} not found in any --vcf input, "
+                "no records will be converted for it\n".format(contig))
+    return ''
+
+
+def vcf_line_end(line, pos):
+    """Returns the last position covered by a raw VCF line
+       (the INFO END of a gVCF reference block, otherwise POS)
+        Arguments:
+            line: raw VCF data line
+            pos: POS of the line
+    """
+    arr = line.split('\t', 8)
+    if len(arr) < 8:
+        return pos
+    blockend = RE_END.search(arr[7])
+    return max(pos, int(blockend.group(1))) if blockend is not None else pos
+
 
 class VariantCallFile(object):
     """Variant Call Format Handler
@@ -47,13 +404,21 @@ class VariantCallFile(object):
         metadata = dict of associated data including (but not limited to):
             contigs: dict[id] = dict(metadata)
             samples: dict[index] = dict(sample_info)
+            contigsource: where contigs were found ('header', 'index'
+                          (.tbi/.csi), 'scan' (full file pre-scan) or None)
+        format_plans = dict[FORMAT string] = tuple of FORMAT_FIELDS indices
+        call_cache = bounded LRU-memoized call_genotype
     """
 
-    def __init__(self, path, indexcontigs=True):
+    def __init__(self, path, indexcontigs=True, readindex=True,
+                 call_cache_size=CALL_CACHE_SIZE):
         if not path:
             raise IOError(path, " path not found for VCF file")
         self.path = os.path.abspath(path)
         self.metadata = {'contigs': {}, 'samples': []}
+        self.format_plans = {}
+        self.call_cache = lru_cache(maxsize=call_cache_size)(call_genotype)
+        self.worker_cache_stats = [0, 0]
         if path.endswith(".gz"):
             filehandler = gzip.open(self.path, 'rt')
         else:
@@ -67,9 +432,19 @@ class VariantCallFile(object):
             header_lines.append(line.rstrip())
             self.entrystart = filehandler.tell() - 1
             line = filehandler.readline()
+        filehandler.close()
         self._process_header(header_lines)
-        if not self.metadata['contigs'] and indexcontigs:
-            self._index_contigs()
+        self.metadata['contigsource'] = 'header'
+        if not self.metadata['contigs'] and readindex:
+            for tempid, label in enumerate(read_index_contigs(self.path)):
+                self.metadata['contigs'][tempid] = {
+                    'label': label, 'length': 0}
+            self.metadata['contigsource'] = 'index'
+        if not self.metadata['contigs']:
+            self.metadata['contigsource'] = None
+            if indexcontigs:
+                self._index_contigs()
+                self.metadata['contigsource'] = 'scan'
 
     def _process_header(self, headerlines):
         """Process VCF header information
@@ -134,13 +509,15 @@ class VariantCallFile(object):
             Arguments:
                 args: dict passthrough object from toplevel argparse options
         """
-        if self.path.endswith('.gz'):
-            filehandler = gzip.open(self.path, 'rt')
-        else:
-            filehandler = open(self.path, 'rt')
+        lines = self._iter_lines(regions=args.regions, quiet=args.quiet,
+                                 gvcf=args.gvcf)
+        if args.threads > 1:
+            for vcfrecord in self._iter_parallel(lines, args):
+                yield vcfrecord
+            return
         nline = 0
         linebuffer = []
-        for line in filehandler:
+        for line in lines:
             nline += 1
             linebuffer.append(line)
             if nline == args.line_buffer:
@@ -158,8 +535,150 @@ class VariantCallFile(object):
             yield vcfrecord
             linebuffer = []
             nline = 0
+
+    def _iter_lines(self, regions=None, quiet=False, gvcf=False):
+        """Iterate raw VCF lines, optionally only those in regions
+           A bgzipped VCF with a .tbi/.csi index is read only at the
+           index bins overlapping the regions, otherwise the whole file
+           is read and filtered.
+            Arguments:
+                regions: dict[contig] = list of [start, end] from
+                         parse_vcf_regions (default=all lines)
+                quiet: suppress warnings
+                gvcf: also keep reference blocks starting before a
+                      region whose END reaches into it
+        """
+        index = None
+        if regions:
+            if not is_bgzf(self.path):
+                if not quiet:
+                    sys.stderr.write(
+                        "{} is not bgzipped, reading the whole file "
+                        "for --regions\n".format(self.path))
+            else:
+                index = VcfTabixIndex.find(self.path)
+                if index is None and not quiet:
+                    sys.stderr.write(
+                        "No .tbi/.csi index found for bgzipped {}, "
+                        "reading the whole file for --regions\n".format(
+                            self.path))
+        if index is not None:
+            reader = BgzfReader(self.path)
+            lastoffset = -1
+            for contig in [x for x in index.names if x in regions]:
+                for start, end in regions[contig]:
+                    for offset, line in self._iter_region_lines(
+                            reader, index, contig, start, end, gvcf=gvcf):
+                        # blocks spanning several regions are read again
+                        if offset > lastoffset:
+                            lastoffset = offset
+                            yield line
+            reader.close()
+            return
+        if self.path.endswith('.gz'):
+            filehandler = gzip.open(self.path, 'rt')
+        else:
+            filehandler = open(self.path, 'rt')
+        for line in filehandler:
+            if regions:
+                if line.startswith('#'):
+                    continue
+                arr = line.split(None, 2)
+                if arr[0] not in regions:
+                    continue
+                pos = int(arr[1])
+                if not clip_to_regions(
+                        regions[arr[0]], pos,
+                        vcf_line_end(line, pos) if gvcf else pos):
+                    continue
+            yield line
         filehandler.close()
 
+    @staticmethod
+    def _iter_region_lines(reader, index, contig, start, end, gvcf=False):
+        """Iterate the raw VCF lines of one region using the index
+            Arguments:
+                reader: BgzfReader of the VCF
+                index: VcfTabixIndex of the VCF
+                contig: contig name
+                start, end: 1-based inclusive region coordinates
+                gvcf: also yield reference blocks whose END reaches start
+            Yields (virtual offset, line) tuples
+        """
+        for chunkstart, chunkend in index.query(contig, start, end):
+            reader.seek(chunkstart)
+            while reader.tell() < chunkend:
+                offset = reader.tell()
+                line = reader.readline().decode()
+                if not line:
+                    break
+                arr = line.split('\t', 2)
+                if arr[0] != contig:
+                    continue
+                pos = int(arr[1])
+                if pos > end:
+                    break
+                if pos >= start or (
+                        gvcf and vcf_line_end(line, pos) >= start):
+                    yield offset, line
+
+    def _iter_parallel(self, lines, args):
+        """Parse --line-buffer blocks of lines in a process pool
+           and yield the records in input order
+            Arguments:
+                lines: iterable of raw VCF lines
+                args: dict passthrough object from toplevel argparse options
+        """
+        pool = Pool(args.threads, initializer=init_vcf_worker,
+                    initargs=(self.path, vars(args)))
+        # Keep a bounded number of blocks in flight
+        pending = deque()
+        linebuffer = []
+        try:
+            for line in lines:
+                linebuffer.append(line)
+                if len(linebuffer) == args.line_buffer:
+                    pending.append(pool.apply_async(parse_vcf_lines,
+                                                    (linebuffer,)))
+                    linebuffer = []
+                    if len(pending) == args.threads * 2:
+                        for vcfrecord in self._collect(pending.popleft()):
+                            yield vcfrecord
+            if linebuffer:
+                pending.append(pool.apply_async(parse_vcf_lines,
+                                                (linebuffer,)))
+            while pending:
+                for vcfrecord in self._collect(pending.popleft()):
+                    yield vcfrecord
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _collect(self, result):
+        """Get a worker result and add its call cache statistics
+            Arguments:
+                result: AsyncResult from parse_vcf_lines
+            Returns list of records
+        """
+        (records, (hits, misses)) = result.get()
+        self.worker_cache_stats[0] += hits
+        self.worker_cache_stats[1] += misses
+        return records
+
+    def _compile_format(self, formatstr):
+        """Get the field-index plan for a FORMAT string (cached)
+            Arguments:
+                formatstr: colon-separated FORMAT column string
+            Returns tuple of indices for FORMAT_FIELDS (-1 if absent)
+        """
+        plan = self.format_plans.get(formatstr)
+        if plan is None:
+            tagindex = dict((tag, i) for i, tag in
+                            enumerate(formatstr.split(':')))
+            plan = tuple(tagindex.get(tag, -1) for tag in FORMAT_FIELDS)
+            self.format_plans[formatstr] = plan
+        return plan
+
     def _parse_entry(self, vcfline, **kwargs):
         """Reads and processes a VCF multi-sample record
             Arguments:
@@ -181,120 +700,495 @@ class VariantCallFile(object):
         record['contig'] = arr[0]
         record['coord'] = int(arr[1])
         record['alleles'] = [arr[3]]
+        symbolic = 0
         if arr[4] != '.':
             for altbase in arr[4].split(','):
-                if len(altbase) > 1:  # and not indel:
+                if kwargs.get('gvcf') and altbase in GVCF_SYMBOLIC:
+                    # gVCF unobserved allele, calls including it are 'X'
+                    altbase = 'X'
+                    symbolic += 1
+                elif len(altbase) > 1:  # and not indel:
                     return -1
                 record['alleles'].append(altbase)
-        record['tagindex'] = {}
-        tags = arr[8].split(':')
-        record['samples'] = []
-        for elem in arr[9:]:
-            record['samples'].append(dict(
-                zip(tags, elem.split(':'))))
-        if "INDEL" in vcfline:  # and indel:
-            pass
+        if symbolic == len(record['alleles']) - 1 and kwargs.get('gvcf'):
+            blockend = RE_END.search(arr[7])
+            if blockend is not None:
+                record['end'] = int(blockend.group(1))
+        record['tagindex'] = self._compile_format(arr[8])
+        record['samples'] = [elem.split(':') for elem in arr[9:]]
         if record['alleles'][0] in 'NnXxBbDdHhVv':
             record['genotypes'] = ['X']
             record['qscores'] = ['@']
         else:
             record['genotypes'] = [record['alleles'][0]]
             record['qscores'] = ['h']
-        for j in range(len(record['samples'])):
+        thresholds = (kwargs.get("mask_depth", 1),
+                      kwargs.get("mask_qual", 10),
+                      kwargs.get("low_qual", 20),
+                      kwargs.get("low_depth", 3))
+        alleles = ''.join(record['alleles'])
+        for fields in record['samples']:
             (allele, quality, _) = (
-                self._call_allele(record['samples'][j],
-                                  record['alleles'],
-                                  **kwargs))
+                self._call_allele(fields, record['tagindex'],
+                                  alleles, thresholds))
             if kwargs.get("out_flavor") in ("dnaqual", 'dnaqual-indel'):
                 record['qscores'].append(chr(min(quality, 40) + 64))
             record['genotypes'].append(allele)
+        if 'end' in record:
+            # Block calls for later positions, with 'A' standing in for
+            # the (unknown) reference base
+            record['blockcalls'] = [
+                self._call_allele(fields, record['tagindex'],
+                                  'A' + alleles[1:], thresholds)[0]
+                for fields in record['samples']]
         if kwargs.get("alleles_from"):
             info = dict(field.split('=') for field in arr[7].split(';'))
             record['genotypes'].extend(
                 info.get(label, '-') for label in kwargs.get("alleles_from"))
         return record
 
-    def _call_allele(self, sample, alleles, **kwargs):
-        """Determine the allele from a VCF entry
+    def _call_allele(self, fields, plan, alleles, thresholds):
+        """Determine the allele from a VCF entry (memoized)
             Arguments:
-                sample: list of entry string elements
-                alleles: alleles for all samples across lines
-                indices: locations in each sample string of information fields
-                **kwargs: passthrough arguments
+                fields: list of sample field strings (split on ':')
+                plan: FORMAT field-index plan from _compile_format
+                alleles: string of REF and ALT bases
+                thresholds: (mask_depth, mask_qual, low_qual, low_depth)
             Returns (allele, quality, depth)
         """
-        # phased = False
-        if '|' in sample.get('GT', ''):
-            # phased = True
-            sample['GT'] = sample['GT'].replace('|', '/')
-        if list(sample.values())[0] in ('./.', '.'):
-            return ('-', 0, 0)
-        try:
-            sample_depth = int(sample['DP'])
-            if sample_depth == 0:
-                return ('-', 0, 0)
-        except Exception as exception:
-            sample_depth = -1
-        # Fixed sites
-        if all(sample.get(x, -1) in (-1, '.')
-               for x in ('PL', 'GL', 'GQ', 'GP')):
-            quality = -1
-            allele = sample.get('GT', 'X')
-            if '/' in allele:
-                allele = [int(x) for x in allele.split('/')]
-                allele = MLIB.joinbases[''.join([alleles[x] for x in allele])]
-            elif '|' in allele:
-                allele = [int(x) for x in allele.split('|')]
-                allele = MLIB.joinbases[''.join([alleles[x] for x in allele])]
+        nfield = len(fields)
+        (genotype, depth, plstr, glstr, gqstr, gpstr) = [
+            fields[i] if -1 < i < nfield else -1 for i in plan]
+        return self.call_cache(genotype, fields[0], plan[0] == 0, depth,
+                               plstr, glstr, gqstr, gpstr in (-1, '.'),
+                               alleles, thresholds)
+
+    def get_call_cache_stats(self):
+        """Returns (hits, misses) of the genotype call cache,
+           including any worker processes
+        """
+        info = self.call_cache.cache_info()
+        return (info.hits + self.worker_cache_stats[0],
+                info.misses + self.worker_cache_stats[1])
+
+
+def add_vcf_contig(mvf, contig_translate, vlabel, vcontig):
+    """Adds a VCF contig to the MVF metadata under a new MVF contig id
+        Arguments:
+            mvf: output MultiVariantFile
+            contig_translate: dict[vcf label] = [mvf id, mvf label]
+            vlabel: VCF contig label
+            vcontig: VCF contig metadata dict (label, length)
+    """
+    if vlabel in contig_translate or mvf.get_contig_id(vlabel) is not None:
+        return ''
+    if ((is_int(vlabel) or len(vlabel) < 3) and
+            vlabel not in mvf.metadata['contigs']):
+        newid = vlabel[:]
+    else:
+        newid = mvf.get_next_contig_id()
+    mvf.add_contig(newid, vcontig.copy())
+    contig_translate[vlabel] = [newid, vlabel]
+    return ''
+
+
+def check_contig_labels(mvf):
+    """Raises RuntimeError if any MVF contig id is another contig's label"""
+    labelids = {}
+    for xid, contigdata in mvf.metadata['contigs'].items():
+        labelids.setdefault(contigdata['label'], []).append(xid)
+    for newid in mvf.metadata['contigs']:
+        for xid in labelids.get(newid, ()):
+            if xid != newid:
+                raise RuntimeError("Error contig id {} is the same as"
+                                   " the label for another contig"
+                                   " ({} {})".format(
+                                       newid, xid, newid))
+    return ''
+
+
+def merge_vcf_contigs(vcfs):
+    """Combines the contigs of several VCFs by label
+        Arguments:
+            vcfs: list of VariantCallFile
+        Returns dict[tempid] = dict(label, length) in order of first
+        appearance (length is the maximum across files)
+    """
+    contigs = {}
+    for vcf in vcfs:
+        for vcontig in vcf.metadata['contigs'].values():
+            if vcontig['label'] in contigs:
+                contigs[vcontig['label']]['length'] = max(
+                    contigs[vcontig['label']]['length'], vcontig['length'])
             else:
-                allele = 'X'
-        # Low coverage
-        elif -1 < sample_depth < kwargs.get("mask_depth", 1):
-            quality = -1
-            allele = 'X'
-        # Invariant sites
-        elif len(alleles) == 1:
-            allele = alleles[0]
-            if sample.get("GQ", -1) == -1:
-                quality = -1
+                contigs[vcontig['label']] = vcontig.copy()
+    return dict(enumerate(contigs.values()))
+
+
+def block_template(vcfrecord, qual):
+    """Makes the sample columns of a gVCF reference block reusable at
+       any position: reference calls become placeholders for the
+       reference base (upper/lower case)
+        Arguments:
+            vcfrecord: gVCF block record (with 'end' and 'blockcalls')
+            qual: include quality scores
+        Returns (genotype template string, quality string)
+    """
+    calls = [REF_UPPER if x == 'A' else REF_LOWER if x == 'a' else x
+             for x in vcfrecord['blockcalls']]
+    return (''.join(calls),
+            ''.join(vcfrecord['qscores'][1:]) if qual else '')
+
+
+def merge_vcf_entries(vcfs, args, reference=None):
+    """Merges the records of several coordinate-sorted VCFs
+       (k-way heap merge holding one record per input)
+       With a reference, gVCF reference blocks (records with 'end') stay
+       active until their END position, filling their samples at the
+       records of other inputs from the REF base of those records.
+       Positions covered only by blocks are filled span by span from the
+       reference sequence, or skipped if no reference is given.
+        Arguments:
+            vcfs: list of VariantCallFile
+            args: dict passthrough object from toplevel argparse options
+            reference: IndexedFasta used to expand gVCF blocks
+        Yields one record per position with genotypes and qscores for
+        the samples of all VCFs in order ('-' for VCFs without a record)
+    """
+    # Contigs are ordered by the VCF headers/indices, then by appearance
+    ranks = {}
+    for vcf in vcfs:
+        for vcontig in vcf.metadata['contigs'].values():
+            ranks.setdefault(vcontig['label'], len(ranks))
+    qual = args.out_flavor in ("dnaqual", 'dnaqual-indel')
+    gaps = [('-' * len(vcf.metadata['samples']),
+             '@' * len(vcf.metadata['samples']) if qual else '')
+            for vcf in vcfs]
+    # Worker pools are not started per input when merging
+    vcfargs = argparse.Namespace(**dict(vars(args), threads=1))
+    entries = [vcf.iterentries(vcfargs) for vcf in vcfs]
+    heap = []
+    sequence = count()
+    # Input index -> (gVCF block record, template) covering the position
+    active = {}
+
+    def push_next(i):
+        vcfrecord = next(entries[i], None)
+        if vcfrecord is not None:
+            rank = ranks.setdefault(vcfrecord['contig'], len(ranks))
+            heappush(heap, (rank, vcfrecord['coord'], i, next(sequence),
+                            vcfrecord))
+        return ''
+
+    def make_columns(records):
+        columns = []
+        for i, vcfrecord in enumerate(records):
+            if vcfrecord is not None:
+                columns.append((''.join(vcfrecord['genotypes'][1:]),
+                                ''.join(vcfrecord['qscores'][1:])
+                                if qual else ''))
+            elif i in active:
+                columns.append(active[i][1])
             else:
-                quality = int(sample['GQ'])
-        # Variant site
-        elif (sample.get('PL', -1) in (-1, '.')) and (
-                sample['GT'] in ('0/0', '1/1')):
-            allele = (alleles[0] if sample['GT'] == '0/0' else alleles[1])
-            quality = (-1 if sample.get("GQ", -1) == -1 else sample['GQ'])
-        elif len(alleles) <= 4:
-            if sample.get('PL', -1) == -1 and sample.get('GL', -1) != -1:
-                plvalues = [float(x) if x != '.' else -1
-                            for x in sample['GL'].split(',')]
+                columns.append(gaps[i])
+        return (''.join(x[0] for x in columns),
+                ''.join(x[1] for x in columns))
+
+    def fill(template, base):
+        base = base.upper() if base.upper() in 'ACGT' else 'X'
+        return {'genotypes': [base + template[0].replace(
+            REF_UPPER, base).replace(
+                REF_LOWER, base.lower() if base != 'X' else 'X')],
+                'qscores': [('h' if base != 'X' else '@') + template[1]]}
+
+    def region_spans(contig, start, end):
+        # Blocks starting before a --regions interval are written from
+        # its start and only up to its end
+        if not args.regions:
+            return [(start, end)]
+        return clip_to_regions(args.regions.get(contig, []), start, end)
+
+    def expand():
+        # Block-only positions are written only with a reference sequence
+        return bool(active) and reference is not None and all(
+            x[0]['contig'] in reference.entries for x in active.values())
+
+    for i in range(len(vcfs)):
+        push_next(i)
+    lastkey = None
+    while heap or expand():
+        if heap and lastkey is not None and heap[0][:2] < lastkey:
+            raise RuntimeError(
+                "VCF records are not in the same contig/position order "
+                "({} {}); add ##contig header lines or sort the "
+                "inputs".format(heap[0][4]['contig'], heap[0][1]))
+        key = (lastkey[0], lastkey[1] + 1) if expand() else heap[0][:2]
+        # Without a reference, blocks are skipped up to the next record
+        for i in [x for x in active
+                  if ranks[active[x][0]['contig']] != key[0] or
+                  active[x][0]['end'] < key[1]]:
+            del active[i]
+        records = [None] * len(vcfs)
+        while heap and heap[0][:2] == key:
+            (_, _, i, _, vcfrecord) = heappop(heap)
+            if records[i] is None:
+                records[i] = vcfrecord
+                if vcfrecord.get('end', 0) > vcfrecord['coord']:
+                    active[i] = (vcfrecord,
+                                 block_template(vcfrecord, qual))
+            push_next(i)
+        first = [x for x in records if x is not None]
+        contig = (first[0] if first else
+                  list(active.values())[0][0])['contig']
+        if region_spans(contig, key[1], key[1]):
+            if first:
+                merged = fill(make_columns(records),
+                              first[0]['genotypes'][0])
+                merged['genotypes'][0] = (first[0]['genotypes'][0] +
+                                          merged['genotypes'][0][1:])
+                merged['qscores'][0] = (first[0]['qscores'][0] +
+                                        merged['qscores'][0][1:])
             else:
-                plvalues = [float(x) if x != '.' else -1
-                            for x in sample['PL'].split(',')]
-            if all(0 <= x <= 1 for x in plvalues) and sum([
-                    x for x in plvalues]) == 1:
-                plvalues = [x == 0 and 1 or x != 1 and
-                            int(-10 * log10(x)) or 0 for x in plvalues]
-            maxpl = max(plvalues) if 0 not in plvalues else 0
-            imaxpl = (-1 if plvalues.count(maxpl) != 1 else
-                      plvalues.index(maxpl))
-            allele = ('X' if imaxpl == -1 else
-                      MLIB.joinbases[''.join(
-                          [alleles[x] for x in MLIB.vcf_gtcodes[imaxpl]])])
-            quality = sample['GQ'] if sample.get('GQ', -1) != -1 else -1
-        # Fail-safe check (you should never see a ! in the MVF)
+                merged = fill(make_columns(records),
+                              reference.fetch(contig, key[1], key[1]) or 'N')
+            merged['contig'] = contig
+            merged['coord'] = key[1]
+            yield merged
+        lastkey = key
+        if not expand():
+            continue
+        # Positions up to the next record or block end only have blocks
+        spanend = min(x[0]['end'] for x in active.values())
+        if heap and heap[0][0] == key[0]:
+            spanend = min(spanend, heap[0][1] - 1)
+        if spanend > key[1]:
+            template = make_columns([None] * len(vcfs))
+            reflength = reference.entries[contig][0]
+            for start, end in region_spans(contig, key[1] + 1,
+                                           min(spanend, reflength)):
+                for j, base in enumerate(
+                        reference.fetch(contig, start, end)):
+                    merged = fill(template, base)
+                    merged['contig'] = contig
+                    merged['coord'] = start + j
+                    yield merged
+            lastkey = (key[0], max(key[1], min(spanend, reflength)))
+            if spanend > reflength:
+                # Blocks extend past the end of the reference sequence
+                active.clear()
+        for i in [x for x in active if active[x][0]['end'] <= lastkey[1]]:
+            del active[i]
+
+
+def iter_mvf_entries(vcfrecords, args, contig_translate, contig_lengths,
+                     add_contig=None):
+    """Encodes VCF records as MVF entries
+        Arguments:
+            vcfrecords: iterable of VCF records
+            args: dict passthrough object from toplevel argparse options
+            contig_translate: dict[vcf label] = [mvf id, mvf label]
+                              (None to keep the VCF contig labels)
+            contig_lengths: dict[vcf label] = maximum position, updated
+                            in order of first appearance
+            add_contig: function called with each new VCF contig label
+        Yields (contig, pos, tuple of encoded allele strings)
+    """
+    for vcfrecord in vcfrecords:
+        vlabel = vcfrecord['contig']
+        if vlabel not in contig_lengths:
+            if add_contig is not None:
+                add_contig(vlabel)
+            contig_lengths[vlabel] = 0
+        if vcfrecord['coord'] > contig_lengths[vlabel]:
+            contig_lengths[vlabel] = vcfrecord['coord']
+        mvf_alleles = encode_mvfstring(''.join(vcfrecord['genotypes']))
+        if args.out_flavor in ('dnaqual',):
+            qual_alleles = encode_mvfstring(''.join(vcfrecord['qscores']))
+        if mvf_alleles:
+            yield ((vlabel if contig_translate is None else
+                    contig_translate.get(vlabel)[0]),
+                   vcfrecord['coord'],
+                   ((mvf_alleles, qual_alleles) if
+                    args.out_flavor in ('dnaqual',) else
+                    (mvf_alleles,)))
+
+
+def iter_vcf_records(vcfs, args, reference=None):
+    """Returns the record iterator for the VCF inputs
+       (merged by position if there are several inputs or gVCF blocks)
+    """
+    if len(vcfs) == 1 and not args.gvcf:
+        return vcfs[0].iterentries(args)
+    return merge_vcf_entries(vcfs, args, reference=reference)
+
+
+def write_body_entries(bodyfile, entries):
+    """Writes encoded MVF entries to a temporary body file"""
+    bodyfile.write(''.join(["{}:{} {}\n".format(
+        entry[0], entry[1], ' '.join(entry[2])) for entry in entries]))
+    return ''
+
+
+def append_mvf_body(mvf, bodyfile, line_buffer, translate=None):
+    """Appends the entries of a temporary body file to the MVF
+        Arguments:
+            mvf: output MultiVariantFile (header already written)
+            bodyfile: open text file of 'contig:pos alleles' lines
+            line_buffer: number of entries per write
+            translate: dict[body contig] = MVF contig id (optional)
+    """
+    bodyfile.seek(0)
+    if mvf.index is None and not translate:
+        block = bodyfile.read(2 ** 20)
+        while block:
+            mvf.write_data(block)
+            block = bodyfile.read(2 ** 20)
+        return ''
+    # Re-read entries so the BGZF index records their offsets
+    entries = []
+    for line in bodyfile:
+        (location, alleles) = line.rstrip('\n').split(' ', 1)
+        (contigid, pos) = location.rsplit(':', 1)
+        if translate:
+            contigid = translate[contigid]
+        entries.append((contigid, int(pos), alleles.split(' ')))
+        if len(entries) == line_buffer:
+            mvf.write_entries(entries, encoded=True)
+            entries = []
+    if entries:
+        mvf.write_entries(entries, encoded=True)
+    return ''
+
+
+def convert_vcf_shard(task):
+    """Converts one VCF shard to a temporary MVF body file
+       (run in a worker process for --shards)
+        Arguments:
+            task: (VCF path, dict of arguments, contig_translate or None
+                   to write VCF contig labels, temporary file directory)
+        Returns dict(path=body file path, contig_lengths=dict,
+                     stats=(call cache hits, misses))
+    """
+    (path, kwargs, contig_translate, tempdir) = task
+    args = argparse.Namespace(**kwargs)
+    vcf = VariantCallFile(path, indexcontigs=False, readindex=False)
+    reference = (IndexedFasta(args.gvcf_reference)
+                 if args.gvcf and args.gvcf_reference else None)
+    contig_lengths = {}
+    bodyfile = tempfile.NamedTemporaryFile(
+        mode='wt', dir=tempdir, suffix='.mvftmp', delete=False)
+    entries = []
+    for entry in iter_mvf_entries(iter_vcf_records([vcf], args, reference),
+                                  args, contig_translate, contig_lengths):
+        entries.append(entry)
+        if len(entries) == args.line_buffer:
+            write_body_entries(bodyfile, entries)
+            entries = []
+    write_body_entries(bodyfile, entries)
+    bodyfile.close()
+    return {'path': bodyfile.name, 'contig_lengths': contig_lengths,
+            'stats': vcf.get_call_cache_stats()}
+
+
+def convert_vcf_entries(mvf, vcfs, args, contig_translate, learn_contigs):
+    """Converts the VCF records and writes the MVF header and entries
+        Arguments:
+            mvf: output MultiVariantFile (metadata set)
+            vcfs: list of VariantCallFile inputs
+            args: dict passthrough object from toplevel argparse options
+            contig_translate: dict[vcf label] = [mvf id, mvf label]
+            learn_contigs: add contigs as they appear and write the
+                           header after the entries are converted
+        Returns (call cache hits, misses)
+    """
+    contig_lengths = {}
+    add_contig = None
+    if learn_contigs:
+        # Entries are held in a temporary file until contigs are known
+        bodyfile = tempfile.TemporaryFile(
+            mode='w+t', dir=os.path.dirname(mvf.path))
+
+        def add_contig(vlabel):
+            return add_vcf_contig(mvf, contig_translate, vlabel,
+                                  {'label': vlabel, 'length': 0})
+    else:
+        mvf.write_data(mvf.get_header())
+    reference = (IndexedFasta(args.gvcf_reference)
+                 if args.gvcf and args.gvcf_reference else None)
+    mvfentries = []
+    for entry in iter_mvf_entries(iter_vcf_records(vcfs, args, reference),
+                                  args, contig_translate, contig_lengths,
+                                  add_contig=add_contig):
+        mvfentries.append(entry)
+        if len(mvfentries) == args.line_buffer:
+            if learn_contigs:
+                write_body_entries(bodyfile, mvfentries)
+            else:
+                mvf.write_entries(mvfentries, encoded=True)
+            mvfentries = []
+    if mvfentries:
+        if learn_contigs:
+            write_body_entries(bodyfile, mvfentries)
         else:
-            allele = '!'
-            quality = -1
-        quality = int(float(quality)) if quality != '.' else 60
-        if -1 < quality < kwargs.get("mask_qual", 10):
-            return ('X', quality, sample_depth)
-        elif (-1 < quality < kwargs.get("low_qual", 20) or
-              (-1 < sample_depth < kwargs.get("low_depth", 3))):
-            allele = allele.lower()
-        if allele in 'NnBbDdHhVvXx':
-            allele = 'X'
-        return (allele, quality, sample_depth)
+            mvf.write_entries(mvfentries, encoded=True)
+    if learn_contigs:
+        for vlabel, length in contig_lengths.items():
+            contig = mvf.metadata['contigs'][contig_translate[vlabel][0]]
+            contig['length'] = max(contig['length'], length)
+        check_contig_labels(mvf)
+        mvf.write_data(mvf.get_header())
+        append_mvf_body(mvf, bodyfile, args.line_buffer)
+        bodyfile.close()
+    return tuple(sum(x) for x in zip(
+        *[vcf.get_call_cache_stats() for vcf in vcfs]))
+
+
+def convert_vcf_shards(mvf, args, contig_translate, learn_contigs):
+    """Converts each --vcf shard in a worker process and concatenates
+       the encoded entries after a combined header
+        Arguments:
+            mvf: output MultiVariantFile (metadata set)
+            args: dict passthrough object from toplevel argparse options
+            contig_translate: dict[vcf label] = [mvf id, mvf label]
+            learn_contigs: add contigs found in the shards to the header
+        Returns (call cache hits, misses)
+    """
+    kwargs = dict(vars(args), threads=1)
+    tasks = [(path, kwargs, None if learn_contigs else contig_translate,
+              os.path.dirname(mvf.path)) for path in args.vcf]
+    results = []
+    try:
+        if args.threads > 1 and len(tasks) > 1:
+            pool = Pool(min(args.threads, len(tasks)))
+            try:
+                results = pool.map(convert_vcf_shard, tasks, chunksize=1)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for task in tasks:
+                results.append(convert_vcf_shard(task))
+        translate = None
+        if learn_contigs:
+            for result in results:
+                for vlabel, length in result['contig_lengths'].items():
+                    add_vcf_contig(mvf, contig_translate, vlabel,
+                                   {'label': vlabel, 'length': 0})
+                    contig = mvf.metadata['contigs'][
+                        contig_translate[vlabel][0]]
+                    contig['length'] = max(contig['length'], length)
+            check_contig_labels(mvf)
+            translate = dict((x, contig_translate[x][0])
+                             for x in contig_translate)
+        mvf.write_data(mvf.get_header())
+        for result in results:
+            with open(result['path'], 'rt') as bodyfile:
+                append_mvf_body(mvf, bodyfile, args.line_buffer,
+                                translate=translate)
+    finally:
+        for result in results:
+            os.remove(result['path'])
+    return tuple(sum(x) for x in zip(*[x['stats'] for x in results]))
 
 
 def vcf2mvf(args=None):
@@ -302,12 +1196,30 @@ def vcf2mvf(args=None):
     sepchars = dict([("TAB", "\t"), ("SPACE", " "), ("DBLSPACE", "  "),
                      ("COMMA", ","), ("MIXED", None)])
     args.fieldsep = sepchars[args.field_sep]
+    if args.regions:
+        args.regions = parse_vcf_regions(args.regions)
     # ESTABLISH VCF
-    vcf = VariantCallFile(args.vcf, indexcontigs=(not args.no_autoindex))
+    vcfs = [VariantCallFile(path, indexcontigs=False,
+                            readindex=(not args.no_autoindex))
+            for path in args.vcf]
+    vcf = vcfs[0]
+    if args.shards:
+        if any(x.metadata['samples'] != vcf.metadata['samples']
+               for x in vcfs):
+            raise RuntimeError("--shards VCF inputs must have the same "
+                               "samples in the same order")
+    elif len(vcfs) > 1 and args.alleles_from:
+        raise RuntimeError("--alleles-from requires a single --vcf input")
+    # Without ##contig header lines, contigs are added (and their lengths
+    # measured) as they appear and the MVF header is written at the end
+    learn_contigs = any(x.metadata['contigsource'] != 'header'
+                        for x in vcfs)
     # ESTABLISH MVF
-    mvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite)
+    mvf = MultiVariantFile(args.out, 'write', overwrite=args.overwrite,
+                           bgzf=args.bgzf,
+                           compresslevel=args.compress_level)
     # PROCESS CONTIG INFO
-    vcfcontigs = vcf.metadata['contigs'].copy()
+    vcfcontigs = merge_vcf_contigs(vcfs)
     contig_translate = {}
     if args.contig_ids:
         for cid, cvcf, cmvf in (x.split(';') for x in args.contig_ids):
@@ -315,46 +1227,45 @@ def vcf2mvf(args=None):
                 cid = int(cid)
             except ValueError:
                 pass
-            assert cvcf in [vcfcontigs[x]['label'] for x in vcfcontigs]
-            for vid in vcfcontigs:
-                if vcfcontigs[vid]['label'] == cvcf:
-                    contig_translate[cvcf] = [cid, cmvf]
-                    if cid in mvf.metadata['contigs']:
-                        raise RuntimeError(
-                            'Contig id {} is not unique'.format(cid))
-                    mvf.metadata['contigs'][cid] = vcfcontigs[vid].copy()
-                    if cmvf in mvf.get_contig_labels():
-                        raise RuntimeError(
-                            'Contig label {} is not unique'.format(cmvf))
-                    mvf.metadata['contigs'][cid]['label'] = cmvf[:]
+            vcontig = [vcfcontigs[x] for x in vcfcontigs
+                       if vcfcontigs[x]['label'] == cvcf]
+            if not learn_contigs:
+                assert vcontig
+            contig_translate[cvcf] = [cid, cmvf]
+            if cid in mvf.metadata['contigs']:
+                raise RuntimeError(
+                    'Contig id {} is not unique'.format(cid))
+            if mvf.get_contig_id(cmvf) is not None:
+                raise RuntimeError(
+                    'Contig label {} is not unique'.format(cmvf))
+            contigdata = (vcontig[0].copy() if vcontig else
+                          {'length': 0})
+            contigdata['label'] = cmvf[:]
+            mvf.add_contig(cid, contigdata)
     for vcid in vcfcontigs:
-        vlabel = vcfcontigs[vcid]['label']
-        if vlabel not in mvf.get_contig_labels():
-            if ((is_int(vlabel) or len(vlabel) < 3) and
-                    vlabel not in mvf.get_contig_ids()):
-                newid = vlabel[:]
-            else:
-                newid = mvf.get_next_contig_id()
-            mvf.metadata['contigs'][newid] = vcfcontigs[vcid].copy()
-            contig_translate[vlabel] = [newid, vlabel]
-    new_contigs = [(x, mvf.metadata['contigs'][x]['label'])
-                   for x in mvf.metadata['contigs']]
-    for i, (newid, newlabel) in enumerate(new_contigs):
-        for j, (xid, xlabel) in enumerate(new_contigs):
-            if i == j:
-                continue
-            if newid == xlabel:
-                raise RuntimeError("Error contig id {} is the same as"
-                                   " the label for another contig"
-                                   " ({} {})".format(
-                                       newid, xid, xlabel))
-            if newlabel == xid:
-                raise RuntimeError("Error contig label {} is the same"
-                                   "as the id for another contig"
-                                   "({} {})".format(
-                                       newlabel, xid, xlabel))
+        add_vcf_contig(mvf, contig_translate, vcfcontigs[vcid]['label'],
+                       vcfcontigs[vcid])
+    if not learn_contigs:
+        check_contig_labels(mvf)
     # PROCESS SAMPLE INFO
-    samplelabels = [args.ref_label] + vcf.metadata['samples'][:]
+    inputlabels = [list(x.metadata['samples'])
+                   for x in (vcfs[:1] if args.shards else vcfs)]
+    seen = set()
+    repeated = set()
+    for labels in inputlabels:
+        repeated.update(seen.intersection(labels))
+        seen.update(labels)
+    if repeated:
+        # Labels shared between inputs get the input file stem appended
+        for vcf, labels in zip(vcfs, inputlabels):
+            stem = os.path.basename(vcf.path)
+            for ext in ('.gz', '.bgz', '.vcf'):
+                if stem.endswith(ext):
+                    stem = stem[:-len(ext)]
+            labels[:] = [label + '_' + stem if label in repeated else label
+                         for label in labels]
+    samplelabels = [args.ref_label] + [
+        label for labels in inputlabels for label in labels]
     if args.alleles_from:
         args.alleles_from = args.alleles_from.split(':')
         samplelabels += args.alleles_from
@@ -371,34 +1282,36 @@ def vcf2mvf(args=None):
                     break
             if labelmatched is not False:
                 del unmatched[labelmatched]
+    seen = set()
+    for label in samplelabels:
+        if label in seen:
+            raise RuntimeError(
+                'Sample label {} is not unique, use --sample-replace '
+                'or --ref-label to rename it'.format(label))
+        seen.add(label)
     mvf.metadata['labels'] = samplelabels[:]
     for i, label in enumerate(samplelabels):
         mvf.metadata['samples'][i] = {'label': label}
     mvf.metadata['ncol'] = len(mvf.metadata['labels'])
     mvf.metadata['sourceformat'] = vcf.metadata['sourceformat']
-    # WRITE MVF HEADER
-    mvf.write_data(mvf.get_header())
-    mvfentries = []
-    nentry = 0
-    for vcfrecord in vcf.iterentries(args):
-        # try:
-        mvf_alleles = encode_mvfstring(''.join(vcfrecord['genotypes']))
-        if args.out_flavor in ('dnaqual',):
-            qual_alleles = encode_mvfstring(''.join(vcfrecord['qscores']))
-        if mvf_alleles:
-            mvfentries.append(
-                (contig_translate.get(vcfrecord['contig'])[0],
-                 vcfrecord['coord'],
-                 ((mvf_alleles, qual_alleles) if
-                  args.out_flavor in ('dnaqual',) else
-                  (mvf_alleles,))))
-            nentry += 1
-            if nentry == args.line_buffer:
-                mvf.write_entries(mvfentries, encoded=True)
-                mvfentries = []
-                nentry = 0
-        # except Exception as exception:
-    if mvfentries:
-        mvf.write_entries(mvfentries)
-        mvfentries = []
+    if args.regions and not learn_contigs:
+        check_region_contigs(args.regions, set(
+            x['label'] for x in vcfcontigs.values()), quiet=args.quiet)
+    if args.shards:
+        stats = convert_vcf_shards(mvf, args, contig_translate,
+                                   learn_contigs)
+    else:
+        stats = convert_vcf_entries(mvf, vcfs, args, contig_translate,
+                                    learn_contigs)
+    if args.regions and learn_contigs:
+        # contigs are only known once the records have been read
+        check_region_contigs(args.regions, contig_translate,
+                             quiet=args.quiet)
+    mvf.close()
+    if not args.quiet:
+        (hits, misses) = stats
+        sys.stderr.write(
+            "Genotype call cache: {} hits, {} misses "
+            "({:.1f}% hit rate)\n".format(
+                hits, misses, 100.0 * hits / max(hits + misses, 1)))
     return ''
@@ -37,7 +37,7 @@ from datetime import datetime
 from io import StringIO
 from itertools import combinations
 from Bio import Phylo
-from pylib.mvfbase import MultiVariantFile, same_window
+from pylib.mvfbase import MultiVariantFile, OutputFile, same_window
 from pylib.mvfbiolib import MvfBioLib
 MLIB = MvfBioLib()
 
@@ -314,35 +314,6 @@ class WindowData(object):
         return duplicates
 
 
-class OutputFile(object):
-    """Set up Output File
-        Params:
-            path: file path
-            headers: list of header elements
-    """
-
-    def __init__(self, path, headers):
-        self.headers = headers
-        self.path = os.path.abspath(path)
-        self.write_headers()
-
-    def write_headers(self):
-        """Write headers to file"""
-        with open(self.path, 'w') as outfile:
-            outfile.write('#' + '\t'.join(self.headers) + "\n")
-        return ''
-
-    def write_entry(self, entry):
-        """Writes entry to file
-            Arguments:
-                entry: dict of values with keys matching header
-        """
-        with open(self.path, 'a') as outfile:
-            outfile.write("\t".join([str(entry.get(k, '.'))
-                                     for k in self.headers]) + "\n")
-        return ''
-
-
 def verify_raxml(params):
     """verify raxml path"""
     out = str(subprocess.check_output([params['raxmlpath'], "-v"]))
@@ -573,4 +544,6 @@ def infer_window_tree(args):
                        reverse=True)
     for rank, [value, topo] in enumerate(topo_list):
         topofile.write_entry({'rank': rank, 'count': value, 'topology': topo})
+    treefile.close()
+    topofile.close()
     return ''
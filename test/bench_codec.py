@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_codec - Compare the MvfCodec decoder/encoder with the original
+per-call MultiVariantFile.decode and encode_mvfstring implementations
+MVFtools: Multisample Variant Format Toolkit
+http://www.github.org/jbpease/mvftools
+
+Usage: python3 test/bench_codec.py [--mvf test/test.mvf ...]
+
+Each input is checked for identical output between the old and new
+functions before timing. A synthetic genome-like sample (mostly
+invariant with some refvar/onecov/onevar/full lines) is benchmarked
+in addition to any MVF inputs.
+"""
+
+import os
+import sys
+import argparse
+import random
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pylib.mvfbase import MultiVariantFile, MvfCodec  # noqa: E402
+from pylib.mvfbase import encode_mvfstring  # noqa: E402
+
+
+def legacy_decode(alleles, ncol):
+    """Original MultiVariantFile.decode"""
+    ref = True
+    if alleles.startswith('@'):
+        alleles = alleles[1:]
+        ref = False
+        ncol -= 1
+    if len(alleles) == 1:
+        alleles = alleles[0] * ncol
+    elif len(alleles) == 2:
+        alleles = alleles[0] + (alleles[1] * (ncol - 1))
+    elif alleles[1] == '+':
+        newalleles = [alleles[0]] + ['-'] * (ncol - 1)
+        newalleles[int(alleles[3:])] = alleles[2]
+        alleles = ''.join(newalleles)
+    elif alleles[2] == '+':
+        tmp = int(alleles[4:])
+        alleles = "{}{}{}{}".format(alleles[0],
+                                    alleles[1]*(tmp - 1),
+                                    alleles[3],
+                                    alleles[1]*(ncol - tmp - 1))
+    if not ref:
+        return '@' + alleles
+    return alleles
+
+
+def legacy_encode(alleles):
+    """Original encode_mvfstring"""
+    denovo = False
+    if alleles.startswith('@'):
+        alleles = alleles[1:]
+        denovo = True
+    if all(x == alleles[1] for x in alleles[2:]):
+        if alleles[0] == alleles[1]:
+            alleles = alleles[0]
+        else:
+            alleles = alleles[0:2]
+    elif alleles[1:].count(alleles[1]) == len(alleles) - 2:
+        pos = [(j, x) for j, x in enumerate(alleles[1:]) if x != alleles[1]]
+        alleles = "{}{}+{}{}".format(
+            alleles[0], alleles[1] if alleles[1] != '-' else '',
+            pos[0][1], pos[0][0] + 1)
+    elif all(x == alleles[2] for x in alleles[3:]):
+        alleles = "{}{}+{}1".format(
+            alleles[0], alleles[2] if alleles[2] != '-' else '', alleles[1])
+    if denovo:
+        return '@' + alleles
+    return alleles
+
+
+def synthetic_alleles(ncol, nlines, seed=1):
+    """Generate genome-like encoded allele strings"""
+    rng = random.Random(seed)
+    bases = 'ACGT'
+    alleles = []
+    for _ in range(nlines):
+        roll = rng.random()
+        ref = rng.choice(bases)
+        alt = rng.choice(bases.replace(ref, ''))
+        if roll < 0.80:
+            alleles.append(ref)
+        elif roll < 0.88:
+            alleles.append(ref + alt)
+        elif roll < 0.92:
+            alleles.append("{}+{}{}".format(
+                ref, alt, rng.randint(1, ncol - 1)))
+        elif roll < 0.96:
+            alleles.append("{}{}+{}{}".format(
+                ref, ref, alt, rng.randint(1, ncol - 1)))
+        else:
+            alleles.append(''.join(rng.choice(bases + '-X')
+                                   for _ in range(ncol)))
+    return alleles
+
+
+def run_benchmark(label, alleles, ncol, number):
+    """Verify and time decode/encode over a list of allele strings"""
+    codec = MvfCodec(ncol)
+    decoded = [legacy_decode(x, ncol) for x in alleles]
+    for old, new, x in zip(decoded, [codec.decode(x) for x in alleles],
+                           alleles):
+        assert old == new, "decode mismatch {}: {} != {}".format(x, old, new)
+    for x in decoded:
+        if len(x.lstrip('@')) < 2:
+            continue
+        assert legacy_encode(x) == encode_mvfstring(x), (
+            "encode mismatch {}".format(x))
+    times = [
+        timeit(lambda: [legacy_decode(x, ncol) for x in alleles],
+               number=number),
+        timeit(lambda: [codec.decode(x) for x in alleles], number=number),
+        timeit(lambda: [legacy_encode(x) for x in decoded], number=number),
+        timeit(lambda: [encode_mvfstring(x) for x in decoded],
+               number=number)]
+    print("{}\tncol={}\tn={}\tdecode {:.4f}s -> {:.4f}s\t"
+          "encode {:.4f}s -> {:.4f}s".format(
+              label, ncol, len(alleles), *times))
+    return ''
+
+
+def main(arguments=None):
+    """Main method"""
+    testdir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--mvf", nargs='*',
+        default=[os.path.join(testdir, x) for x in ('test.mvf', 'test3.mvf')],
+        help="Input MVF files to verify and benchmark.")
+    parser.add_argument("--number", type=int, default=20,
+                        help="Number of timing repeats.")
+    parser.add_argument("--nlines", type=int, default=20000,
+                        help="Number of synthetic lines.")
+    args = parser.parse_args(args=arguments)
+    for path in args.mvf:
+        mvf = MultiVariantFile(path, 'read')
+        alleles = [x for _, _, allelesets in mvf.iterentries(decode=False)
+                   for x in allelesets]
+        run_benchmark(os.path.basename(path), alleles,
+                      mvf.metadata['ncol'], args.number * 100)
+    for ncol in (5, 50):
+        run_benchmark("synthetic", synthetic_alleles(ncol, args.nlines),
+                      ncol, args.number)
+    return ''
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+check_pairwise - Compare CalcPairwiseDistances output between the NumPy
+PairwiseMatchCounter and its pure-Python fallback
+MVFtools: Multisample Variant Format Toolkit
+http://www.github.org/jbpease/mvftools
+
+Usage: python3 test/check_pairwise.py [--mvf test/test.mvf ...]
+
+Each input is run with the same random seed (ambiguous bases are
+resolved with randint) for several window sizes, once with NumPy and once
+with the module's NumPy import disabled, and the output files are
+checked for identical contents.
+"""
+
+import os
+import sys
+import argparse
+import random
+import tempfile
+from argparse import Namespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pylib import mvfanalysis  # noqa: E402
+
+
+def run_pairwise(path, outpath, windowsize, seed, numpy_module):
+    """Run calc_pairwise_distances with the given numpy module (or None)
+       and return the output file contents
+    """
+    saved = mvfanalysis.np
+    mvfanalysis.np = numpy_module
+    random.seed(seed)
+    try:
+        mvfanalysis.calc_pairwise_distances(Namespace(
+            mvf=path, out=outpath, sample_indices=None, sample_labels=None,
+            windowsize=windowsize, mincoverage=None, threads=1,
+            quiet=True))
+    finally:
+        mvfanalysis.np = saved
+    with open(outpath, 'rt') as outfile:
+        return outfile.read()
+
+
+def main(arguments=None):
+    """Main method"""
+    testdir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--mvf", nargs='*',
+        default=[os.path.join(testdir, x) for x in ('test.mvf', 'test3.mvf')],
+        help="Input MVF files to compare.")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Random seed for ambiguous bases.")
+    args = parser.parse_args(args=arguments)
+    if mvfanalysis.np is None:
+        raise RuntimeError("NumPy is required to compare both paths")
+    tempdir = tempfile.mkdtemp()
+    try:
+        for path in args.mvf:
+            for windowsize in (100000, 3, 1):
+                outpath = os.path.join(tempdir, 'pairwise.txt')
+                expected = run_pairwise(path, outpath, windowsize,
+                                        args.seed, mvfanalysis.np)
+                found = run_pairwise(path, outpath, windowsize,
+                                     args.seed, None)
+                assert expected == found, (
+                    "pairwise mismatch {} windowsize={}".format(
+                        path, windowsize))
+                print("{}\twindowsize={}\tidentical".format(
+                    os.path.basename(path), windowsize))
+    finally:
+        for name in os.listdir(tempdir):
+            os.remove(os.path.join(tempdir, name))
+        os.rmdir(tempdir)
+    return ''
+
+
+if __name__ == "__main__":
+    main()